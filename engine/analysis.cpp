@@ -0,0 +1,179 @@
+#include "analysis.h"
+
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
+// The envelope resolution. Short enough to place an onset within a few milliseconds, long enough to average out the
+// individual periods of low notes. A multiple of 4.
+static const size_t k_block_size = 256;
+
+// Blocks quieter than this are treated as this loud, which keeps digital silence from skewing the noise floor
+static const float k_min_energy_db = -120.0f;
+
+// The noise floor is this quantile of the block energies. Takes usually open and close with silence, so even a mostly
+// full take has enough quiet blocks to find it.
+static const double k_noise_floor_quantile = 0.1;
+
+// Sound must be this far above the noise floor to count at all
+static const float k_threshold_above_noise_db = 10.0f;
+
+// Sound more than this far below the loudest block is ignored, so that bleed from the metronome or a quiet room doesn't
+// count as sound in a loud take
+static const float k_threshold_below_peak_db = 45.0f;
+
+// An onset is a rise of at least this much over the quietest recent block
+static const float k_onset_rise_db = 9.0f;
+static const double k_onset_history_seconds = 0.05;
+
+// Onsets closer together than this are treated as a single onset
+static const double k_onset_refractory_seconds = 0.05;
+
+// The suggested start leaves this much before the first onset so its attack isn't cut off
+static const double k_pre_roll_seconds = 0.01;
+
+// The suggested end leaves this much after the sound drops below the threshold so its release isn't cut off
+static const double k_release_seconds = 0.05;
+
+// Onsets within this fraction of a measure of a downbeat are considered to be on it
+static const double k_measure_tolerance = 1.0 / 16.0;
+
+// Uses several independent accumulators so the compiler can vectorize the loop without reordering a single sum.
+// count must be a multiple of 4.
+static float sum_of_squares(const float *samples, size_t count) {
+    float sums[4] = { 0.0f, 0.0f, 0.0f, 0.0f };
+    for (size_t i = 0; i < count; i += 4) {
+        sums[0] += samples[i] * samples[i];
+        sums[1] += samples[i + 1] * samples[i + 1];
+        sums[2] += samples[i + 2] * samples[i + 2];
+        sums[3] += samples[i + 3] * samples[i + 3];
+    }
+
+    return (sums[0] + sums[1]) + (sums[2] + sums[3]);
+}
+
+// Returns the mean energy of each block in dB. The last block may be partial.
+static std::vector<float> compute_energy_envelope(const float *samples, size_t sample_count) {
+    std::vector<float> envelope((sample_count + k_block_size - 1) / k_block_size);
+    for (size_t block_index = 0; block_index < envelope.size(); ++block_index) {
+        size_t block_start = block_index * k_block_size;
+        size_t block_count = std::min(k_block_size, sample_count - block_start);
+        size_t vector_count = block_count & ~size_t(3);
+        float energy = sum_of_squares(samples + block_start, vector_count);
+        for (size_t i = vector_count; i < block_count; ++i) {
+            energy += samples[block_start + i] * samples[block_start + i];
+        }
+
+        float mean_energy = energy / static_cast<float>(block_count);
+        envelope[block_index] = mean_energy > 0.0f
+            ? std::max(10.0f * log10f(mean_energy), k_min_energy_db)
+            : k_min_energy_db;
+    }
+
+    return envelope;
+}
+
+s_clip_boundaries find_clip_boundaries(
+    const float *samples,
+    size_t sample_count,
+    double samples_per_measure,
+    uint32_t sample_rate) {
+    s_clip_boundaries result = { 0, sample_count, false, false };
+
+    std::vector<float> envelope = compute_energy_envelope(samples, sample_count);
+    if (envelope.empty()) {
+        return result;
+    }
+
+    std::vector<float> sorted_envelope = envelope;
+    auto noise_floor_iter = sorted_envelope.begin()
+        + static_cast<ptrdiff_t>(static_cast<double>(sorted_envelope.size() - 1) * k_noise_floor_quantile);
+    std::nth_element(sorted_envelope.begin(), noise_floor_iter, sorted_envelope.end());
+    float noise_floor = *noise_floor_iter;
+    float peak = *std::max_element(envelope.begin(), envelope.end());
+    if (peak - noise_floor < k_threshold_above_noise_db) {
+        // Either silence or sound throughout, so there are no boundaries to find
+        return result;
+    }
+
+    float threshold = std::max(noise_floor + k_threshold_above_noise_db, peak - k_threshold_below_peak_db);
+
+    auto seconds_to_blocks = [&](double seconds) {
+        return std::max<size_t>(static_cast<size_t>(std::lround(seconds * sample_rate / k_block_size)), 1);
+    };
+
+    size_t history_block_count = seconds_to_blocks(k_onset_history_seconds);
+    size_t refractory_block_count = seconds_to_blocks(k_onset_refractory_seconds);
+
+    // A take which is already sounding when it begins has an onset at its first block
+    size_t first_onset_block = SIZE_MAX;
+    size_t last_onset_block = SIZE_MAX;
+    size_t last_sounding_block = SIZE_MAX;
+    for (size_t block_index = 0; block_index < envelope.size(); ++block_index) {
+        float energy = envelope[block_index];
+        if (energy < threshold) {
+            continue;
+        }
+
+        last_sounding_block = block_index;
+        if (last_onset_block != SIZE_MAX && block_index - last_onset_block < refractory_block_count) {
+            continue;
+        }
+
+        size_t history_start = block_index - std::min(block_index, history_block_count);
+        bool is_onset = block_index == 0;
+        if (!is_onset) {
+            float history_min = *std::min_element(
+                envelope.begin() + static_cast<ptrdiff_t>(history_start),
+                envelope.begin() + static_cast<ptrdiff_t>(block_index));
+            is_onset = energy - history_min >= k_onset_rise_db;
+        }
+
+        if (is_onset) {
+            if (first_onset_block == SIZE_MAX) {
+                first_onset_block = block_index;
+            }
+
+            last_onset_block = block_index;
+        }
+    }
+
+    if (first_onset_block == SIZE_MAX) {
+        // Sound which swells in too slowly to register an onset starts where it crosses the threshold
+        first_onset_block = std::find_if(envelope.begin(), envelope.end(), [&](float x) { return x >= threshold; })
+            - envelope.begin();
+        last_onset_block = first_onset_block;
+    }
+
+    size_t first_onset = first_onset_block * k_block_size;
+    size_t last_onset = last_onset_block * k_block_size;
+    size_t pre_roll = static_cast<size_t>(k_pre_roll_seconds * sample_rate);
+    size_t release = static_cast<size_t>(k_release_seconds * sample_rate);
+    result.m_start_sample_index = first_onset - std::min(first_onset, pre_roll);
+    result.m_end_sample_index = std::min((last_sounding_block + 1) * k_block_size + release, sample_count);
+
+    if (samples_per_measure <= 0.0) {
+        return result;
+    }
+
+    // Measures are counted the same way the UI counts them, with a partial last measure rounding up
+    size_t measure_count = static_cast<size_t>(ceil(static_cast<double>(sample_count) / samples_per_measure));
+    double tolerance = samples_per_measure * k_measure_tolerance;
+    result.m_has_intro = static_cast<double>(first_onset) > tolerance;
+    result.m_has_outro = measure_count > 0
+        && static_cast<double>(last_onset) < static_cast<double>(measure_count - 1) * samples_per_measure - tolerance;
+
+    // Keep at least one measure which is neither intro nor outro. A missing outro is the more likely mistake since
+    // sound can ring into the last measure without a new onset.
+    size_t main_measure_count = measure_count - std::min<size_t>(measure_count, result.m_has_intro + result.m_has_outro);
+    if (main_measure_count == 0 && result.m_has_outro) {
+        result.m_has_outro = false;
+        ++main_measure_count;
+    }
+
+    if (main_measure_count == 0 && result.m_has_intro) {
+        result.m_has_intro = false;
+    }
+
+    return result;
+}
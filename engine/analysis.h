@@ -0,0 +1,22 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+
+// Suggested trim points and intro/outro flags for a recorded take
+struct s_clip_boundaries {
+    size_t m_start_sample_index;
+    size_t m_end_sample_index;
+    bool m_has_intro;
+    bool m_has_outro;
+};
+
+// Finds where the sound in a take begins and ends from its energy envelope. Sample 0 is assumed to lie on a measure
+// boundary, as it does for recordings made against the metronome. The take has an intro if its first onset comes
+// clearly after the first downbeat, and an outro if nothing starts in its last measure. The start and end trim off the
+// silence around the sound. Takes with no clear sound are left untrimmed with neither an intro nor an outro.
+s_clip_boundaries find_clip_boundaries(
+    const float *samples,
+    size_t sample_count,
+    double samples_per_measure,
+    uint32_t sample_rate);
@@ -0,0 +1,396 @@
+#include "archive.h"
+
+#include <algorithm>
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+
+#ifdef _WIN32
+#define NOMINMAX
+#include <windows.h>
+#else
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
+// File layout, all values little endian:
+//   header: signature, version, index offset, index size
+//   clip sample blocks, each starting on a k_block_alignment boundary
+//   index: sample rate, clip count, metadata size, then (key, offset, sample count) for each clip, then the metadata
+//
+// Appending adds sample blocks and a new index after the current end of the file, so older indices (and any sample
+// blocks no longer referenced) are left behind as dead space. Once there's enough of it, the archive is compacted
+// instead: every clip is written to a temporary file which then replaces the archive.
+
+static const uint8_t k_signature[] = { 'S', 'S', 'P', 'A' };
+static const uint32_t k_version = 1;
+static const size_t k_header_size = 24;
+static const size_t k_index_header_size = 16;
+static const size_t k_index_clip_size = 24;
+
+// Page-aligned so that each clip's mapped pages belong to that clip alone
+static const uint64_t k_block_alignment = 4096;
+
+// An archive is compacted when saving would leave at least this much dead space, making up at least this fraction of
+// the file. The minimum size keeps small projects from being rewritten on every save.
+static const uint64_t k_compact_min_dead_size = 16 * 1024 * 1024;
+static const double k_compact_min_dead_fraction = 0.5;
+
+// Chunk size for copying clips out of an archive being compacted
+static const size_t k_copy_buffer_size = 1024 * 1024;
+
+static void write_u32(std::vector<uint8_t> &buffer, uint32_t value) {
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        buffer.push_back(static_cast<uint8_t>(value >> (i * 8)));
+    }
+}
+
+static void write_u64(std::vector<uint8_t> &buffer, uint64_t value) {
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        buffer.push_back(static_cast<uint8_t>(value >> (i * 8)));
+    }
+}
+
+static uint32_t read_u32(const uint8_t *data) {
+    uint32_t value = 0;
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        value |= static_cast<uint32_t>(data[i]) << (i * 8);
+    }
+    return value;
+}
+
+static uint64_t read_u64(const uint8_t *data) {
+    uint64_t value = 0;
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        value |= static_cast<uint64_t>(data[i]) << (i * 8);
+    }
+    return value;
+}
+
+static bool is_native_little_endian() {
+    uint16_t value = 1;
+    uint8_t first_byte;
+    memcpy(&first_byte, &value, sizeof(first_byte));
+    return first_byte == 1;
+}
+
+static uint64_t align_up(uint64_t value, uint64_t alignment) {
+    return (value + alignment - 1) / alignment * alignment;
+}
+
+static bool parse_header(const uint8_t *data, uint64_t &index_offset, uint64_t &index_size) {
+    if (memcmp(data, k_signature, sizeof(k_signature)) != 0 || read_u32(data + 4) != k_version) {
+        return false;
+    }
+
+    index_offset = read_u64(data + 8);
+    index_size = read_u64(data + 16);
+    return true;
+}
+
+// file_size is the size of the whole archive, used to validate clip extents
+static bool parse_index(const uint8_t *data, size_t size, uint64_t file_size, s_archive_index &index) {
+    if (size < k_index_header_size) {
+        return false;
+    }
+
+    uint32_t sample_rate = read_u32(data);
+    uint32_t clip_count = read_u32(data + 4);
+    uint64_t metadata_size = read_u64(data + 8);
+    uint64_t clips_size = static_cast<uint64_t>(clip_count) * k_index_clip_size;
+    if (clips_size > size - k_index_header_size || metadata_size != size - k_index_header_size - clips_size) {
+        return false;
+    }
+
+    std::vector<s_archive_clip> clips(clip_count);
+    const uint8_t *clip_data = data + k_index_header_size;
+    for (uint32_t i = 0; i < clip_count; ++i) {
+        s_archive_clip &clip = clips[i];
+        clip.m_key = static_cast<int64_t>(read_u64(clip_data));
+        clip.m_offset = read_u64(clip_data + 8);
+        clip.m_sample_count = read_u64(clip_data + 16);
+        clip_data += k_index_clip_size;
+
+        if (clip.m_offset % k_block_alignment != 0
+            || clip.m_offset > file_size
+            || clip.m_sample_count > (file_size - clip.m_offset) / sizeof(float)) {
+            return false;
+        }
+    }
+
+    index.m_sample_rate = sample_rate;
+    index.m_clips.swap(clips);
+    index.m_metadata.assign(reinterpret_cast<const char *>(clip_data), static_cast<size_t>(metadata_size));
+    return true;
+}
+
+bool read_archive_index(const char *filename, s_archive_index &index) {
+    // $TODO support big endian platforms
+    if (!is_native_little_endian()) {
+        return false;
+    }
+
+    std::ifstream file;
+    file.open(filename, std::ios::binary | std::ios::ate);
+    if (!file.is_open()) {
+        return false;
+    }
+
+    uint64_t file_size = static_cast<uint64_t>(file.tellg());
+    if (file_size < k_header_size) {
+        return false;
+    }
+
+    uint8_t header[k_header_size];
+    file.seekg(0);
+    file.read(reinterpret_cast<char *>(header), sizeof(header));
+
+    uint64_t index_offset;
+    uint64_t index_size;
+    if (file.fail()
+        || !parse_header(header, index_offset, index_size)
+        || index_offset > file_size
+        || index_size > file_size - index_offset) {
+        return false;
+    }
+
+    std::vector<uint8_t> index_data(static_cast<size_t>(index_size));
+    file.seekg(static_cast<std::streamoff>(index_offset));
+    file.read(reinterpret_cast<char *>(index_data.data()), index_data.size());
+    return !file.fail() && parse_index(index_data.data(), index_data.size(), file_size, index);
+}
+
+bool parse_archive_index(const uint8_t *data, size_t size, s_archive_index &index) {
+    if (!is_native_little_endian() || size < k_header_size) {
+        return false;
+    }
+
+    uint64_t index_offset;
+    uint64_t index_size;
+    if (!parse_header(data, index_offset, index_size) || index_offset > size || index_size > size - index_offset) {
+        return false;
+    }
+
+    return parse_index(data + index_offset, static_cast<size_t>(index_size), size, index);
+}
+
+static std::string get_old_filename(const char *filename) {
+    return std::string(filename) + ".old";
+}
+
+// Flushes a file's data through to the disk, which fstream::flush() doesn't do
+static bool sync_file(const char *filename) {
+#ifdef _WIN32
+    HANDLE file_handle = CreateFileA(
+        filename,
+        GENERIC_WRITE,
+        FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+        nullptr,
+        OPEN_EXISTING,
+        FILE_ATTRIBUTE_NORMAL,
+        nullptr);
+    if (file_handle == INVALID_HANDLE_VALUE) {
+        return false;
+    }
+
+    bool result = FlushFileBuffers(file_handle) != 0;
+    CloseHandle(file_handle);
+    return result;
+#else
+    int file_descriptor = ::open(filename, O_RDWR);
+    if (file_descriptor < 0) {
+        return false;
+    }
+
+    bool result = fsync(file_descriptor) == 0;
+    ::close(file_descriptor);
+    return result;
+#endif
+}
+
+// Replaces destination with source
+static bool replace_file(const char *source, const char *destination) {
+#ifdef _WIN32
+    // Windows can't replace a file which is mapped, as the archive usually is, but it can rename one which was opened
+    // with FILE_SHARE_DELETE, as c_mapped_file does. So the archive is moved aside first. It can't be deleted until
+    // nothing maps it, so write_archive deletes it on a later save. If the process dies between the two moves, the
+    // previous version of the project is left in the .old file.
+    std::string old_filename = get_old_filename(destination);
+    if (!MoveFileExA(destination, old_filename.c_str(), MOVEFILE_REPLACE_EXISTING)) {
+        return false;
+    }
+
+    if (!MoveFileExA(source, destination, 0)) {
+        MoveFileExA(old_filename.c_str(), destination, 0);
+        return false;
+    }
+
+    DeleteFileA(old_filename.c_str());
+    return true;
+#else
+    // Existing mappings keep the old file's data alive until they're closed
+    return std::rename(source, destination) == 0;
+#endif
+}
+
+// Returns whether appending the clips to an archive of the given size would leave enough dead space to compact it
+static bool should_compact(
+    uint64_t file_size,
+    const std::string &metadata,
+    const std::vector<s_archive_clip_write> &clips) {
+    uint64_t index_size = k_index_header_size + clips.size() * k_index_clip_size + metadata.size();
+    uint64_t live_size = align_up(k_header_size, k_block_alignment) + index_size;
+    uint64_t appended_size = file_size + index_size;
+    for (const s_archive_clip_write &clip : clips) {
+        uint64_t data_size = align_up(clip.m_sample_count * sizeof(float), k_block_alignment);
+        live_size += data_size;
+        if (clip.m_samples) {
+            appended_size += data_size;
+        }
+    }
+
+    uint64_t dead_size = appended_size - std::min(appended_size, live_size);
+    return dead_size >= k_compact_min_dead_size
+        && static_cast<double>(dead_size) >= static_cast<double>(appended_size) * k_compact_min_dead_fraction;
+}
+
+// Writes clip data, then an index, then the header which points at it. If source_filename is provided, clips without
+// samples are copied from that archive, otherwise they're already stored at their offsets in the archive being
+// appended to.
+static bool write_archive_file(
+    const char *filename,
+    bool append,
+    const char *source_filename,
+    uint32_t sample_rate,
+    const std::string &metadata,
+    std::vector<s_archive_clip_write> &clips) {
+    std::ifstream source_file;
+    if (source_filename) {
+        source_file.open(source_filename, std::ios::binary);
+        if (!source_file.is_open()) {
+            return false;
+        }
+    }
+
+    std::fstream file;
+    file.open(filename, append
+        ? std::ios::binary | std::ios::in | std::ios::out
+        : std::ios::binary | std::ios::out | std::ios::trunc);
+    if (!file.is_open()) {
+        return false;
+    }
+
+    uint64_t offset = 0;
+    if (append) {
+        file.seekp(0, std::ios::end);
+        offset = static_cast<uint64_t>(file.tellp());
+    }
+
+    static const uint8_t k_padding[k_block_alignment] = { 0 };
+    auto write_padding = [&](uint64_t alignment) {
+        uint64_t padding = align_up(offset, alignment) - offset;
+        file.write(reinterpret_cast<const char *>(k_padding), static_cast<std::streamsize>(padding));
+        offset += padding;
+    };
+
+    if (offset < k_header_size) {
+        // The real header is written once everything it points to is in place
+        file.write(reinterpret_cast<const char *>(k_padding), static_cast<std::streamsize>(k_header_size - offset));
+        offset = k_header_size;
+    }
+
+    std::vector<char> copy_buffer;
+    for (s_archive_clip_write &clip : clips) {
+        size_t data_size = static_cast<size_t>(clip.m_sample_count) * sizeof(float);
+        if (clip.m_samples) {
+            write_padding(k_block_alignment);
+            clip.m_offset = offset;
+            file.write(reinterpret_cast<const char *>(clip.m_samples), static_cast<std::streamsize>(data_size));
+            offset += data_size;
+        } else if (source_filename) {
+            write_padding(k_block_alignment);
+            source_file.seekg(static_cast<std::streamoff>(clip.m_offset));
+            clip.m_offset = offset;
+            copy_buffer.resize(k_copy_buffer_size);
+            for (size_t copied_size = 0; copied_size < data_size; copied_size += copy_buffer.size()) {
+                std::streamsize chunk_size = static_cast<std::streamsize>(
+                    std::min(copy_buffer.size(), data_size - copied_size));
+                source_file.read(copy_buffer.data(), chunk_size);
+                file.write(copy_buffer.data(), chunk_size);
+            }
+
+            if (source_file.fail()) {
+                return false;
+            }
+
+            offset += data_size;
+        }
+    }
+
+    std::vector<uint8_t> index;
+    write_u32(index, sample_rate);
+    write_u32(index, static_cast<uint32_t>(clips.size()));
+    write_u64(index, metadata.size());
+    for (const s_archive_clip_write &clip : clips) {
+        write_u64(index, static_cast<uint64_t>(clip.m_key));
+        write_u64(index, clip.m_offset);
+        write_u64(index, clip.m_sample_count);
+    }
+    index.insert(index.end(), metadata.begin(), metadata.end());
+
+    write_padding(sizeof(uint64_t));
+    uint64_t index_offset = offset;
+    file.write(reinterpret_cast<const char *>(index.data()), static_cast<std::streamsize>(index.size()));
+
+    // Make sure the new data is on the disk before the header refers to it
+    file.flush();
+    if (file.fail() || !sync_file(filename)) {
+        return false;
+    }
+
+    std::vector<uint8_t> header;
+    header.insert(header.end(), k_signature, k_signature + sizeof(k_signature));
+    write_u32(header, k_version);
+    write_u64(header, index_offset);
+    write_u64(header, index.size());
+
+    file.seekp(0);
+    file.write(reinterpret_cast<const char *>(header.data()), static_cast<std::streamsize>(header.size()));
+    file.flush();
+    return !file.fail() && sync_file(filename);
+}
+
+bool write_archive(
+    const char *filename,
+    bool append,
+    uint32_t sample_rate,
+    const std::string &metadata,
+    std::vector<s_archive_clip_write> &clips) {
+    if (!is_native_little_endian()) {
+        return false;
+    }
+
+    // A previous compaction may have had to leave the old archive behind, see replace_file
+    std::remove(get_old_filename(filename).c_str());
+
+    if (append) {
+        std::ifstream file(filename, std::ios::binary | std::ios::ate);
+        uint64_t file_size = file.is_open() ? static_cast<uint64_t>(file.tellg()) : 0;
+        file.close();
+
+        if (should_compact(file_size, metadata, clips)) {
+            std::string temp_filename = std::string(filename) + ".tmp";
+            std::vector<s_archive_clip_write> compacted_clips = clips;
+            if (write_archive_file(temp_filename.c_str(), false, filename, sample_rate, metadata, compacted_clips)
+                && replace_file(temp_filename.c_str(), filename)) {
+                clips.swap(compacted_clips);
+                return true;
+            }
+
+            // The archive is untouched, so fall back to appending and leave the dead space for a later save
+            std::remove(temp_filename.c_str());
+        }
+    }
+
+    return write_archive_file(filename, append, nullptr, sample_rate, metadata, clips);
+}
@@ -0,0 +1,53 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <string>
+#include <vector>
+
+// A project archive is a single file holding every clip's samples plus the project's JSON metadata. Sample blocks are
+// page-aligned float data so the whole archive can be mapped once and each clip used as a view into the mapping.
+//
+// Saving normally appends to an archive: it writes only clips which aren't already stored in the archive, followed by a
+// new index, and then points the header at the new index. The new data is synced to disk before the header is
+// rewritten, and until then the old index stays valid, so an interrupted save leaves the previous version of the
+// project intact. Once clips which are no longer referenced make up a large fraction of the file, the archive is
+// compacted by writing every clip to a temporary file which then replaces the archive.
+
+struct s_archive_clip {
+    int64_t m_key;              // Caller-defined key, e.g. the project's clip ID
+    uint64_t m_offset;          // Byte offset of the clip's samples within the archive
+    uint64_t m_sample_count;
+};
+
+struct s_archive_index {
+    uint32_t m_sample_rate = 0;
+    std::vector<s_archive_clip> m_clips = {};
+    std::string m_metadata = {};
+};
+
+// Reads just the header and index of an archive
+bool read_archive_index(const char *filename, s_archive_index &index);
+
+// Parses the index of an archive which is already in memory (e.g. mapped). Every clip extent is checked to lie within
+// the data and to be suitably aligned for use in place.
+bool parse_archive_index(const uint8_t *data, size_t size, s_archive_index &index);
+
+// A clip to store in an archive. If m_samples is null, the clip is already stored in the archive being appended to and
+// m_offset gives its location. Otherwise its samples are written and m_offset is filled in. Compacting the archive
+// moves every clip, so all offsets are updated in that case.
+struct s_archive_clip_write {
+    int64_t m_key;
+    const float *m_samples;
+    uint64_t m_offset;
+    uint64_t m_sample_count;
+};
+
+// Writes an archive. If append is true, new clip data and a new index are added to the end of the existing archive,
+// otherwise the file is replaced. Appending may compact the archive instead, which replaces the file.
+bool write_archive(
+    const char *filename,
+    bool append,
+    uint32_t sample_rate,
+    const std::string &metadata,
+    std::vector<s_archive_clip_write> &clips);
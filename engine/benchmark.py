@@ -0,0 +1,193 @@
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+
+import engine
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+# Measures playback mixer throughput on synthetic arrangements. Playback runs on the engine's virtual output device as
+# fast as possible, so this needs no sound card and measures only the engine.
+
+SAMPLE_RATE = 44100
+CLIP_POOL_SIZE = 8          # Distinct clips recorded per clip length, arrangements cycle through them
+SEED = 1234
+
+BYTES_PER_SAMPLE = {
+    "float32": 4,
+    "int16": 2,
+    "float16": 2
+}
+
+FULL_GRID = {
+    "track_count": [1, 8, 32, 128],
+    "clip_seconds": [0.5, 4.0, 30.0],
+    "density": [0.5, 1.0, 2.0],
+    "frames_per_buffer": [32, 128, 512, 4096]
+}
+
+QUICK_GRID = {
+    "track_count": [1, 32],
+    "clip_seconds": [4.0],
+    "density": [1.0],
+    "frames_per_buffer": [128, 1024]
+}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the playback mixer on synthetic arrangements")
+    parser.add_argument("--output", default = "benchmark_results.json", help = "JSON file to write results to")
+    parser.add_argument("--seconds", type = float, default = 10.0, help = "Length of audio rendered per run")
+    parser.add_argument("--quick", action = "store_true", help = "Run a small grid")
+    parser.add_argument(
+        "--clip-format",
+        choices = list(BYTES_PER_SAMPLE.keys()),
+        default = "float32",
+        help = "How clip samples are stored in memory")
+    args = parser.parse_args()
+
+    grid = QUICK_GRID if args.quick else FULL_GRID
+
+    engine.initialize(True)
+    engine.set_sample_rate(SAMPLE_RATE)
+    engine.set_metronome_samples_per_beat(0.0)
+    input_device_index = engine.get_input_device_count() - 1
+    output_device_index = engine.get_output_device_count() - 1
+
+    clip_pools = {
+        clip_seconds: record_clip_pool(input_device_index, output_device_index, clip_seconds)
+        for clip_seconds in grid["clip_seconds"]
+    }
+
+    for clip_ids in clip_pools.values():
+        for clip_id in clip_ids:
+            engine.set_clip_storage_format(clip_id, args.clip_format)
+
+    results = []
+    runs = list(itertools.product(
+        grid["track_count"],
+        grid["clip_seconds"],
+        grid["density"],
+        grid["frames_per_buffer"]))
+    for run_index, (track_count, clip_seconds, density, frames_per_buffer) in enumerate(runs):
+        clip_ids = clip_pools[clip_seconds]
+        playback_clip_count = build_arrangement(track_count, clip_ids, density, args.seconds)
+        result = {
+            "track_count": track_count,
+            "clip_seconds": clip_seconds,
+            "density": density,
+            "frames_per_buffer": frames_per_buffer,
+            "playback_clip_count": playback_clip_count
+        }
+        result.update(run_playback(output_device_index, frames_per_buffer, args.seconds))
+        results.append(result)
+
+        print("[{}/{}] tracks={} clip={}s density={} frames_per_buffer={}: {:.0f} samples/s, p99 callback {:.3f}".format(
+            run_index + 1,
+            len(runs),
+            track_count,
+            clip_seconds,
+            density,
+            frames_per_buffer,
+            result["samples_per_second"],
+            result["stats"]["callback_duration_p99"]))
+
+    output = {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": sys.version,
+        "sample_rate": SAMPLE_RATE,
+        "seconds_per_run": args.seconds,
+        "clip_format": args.clip_format,
+        "clip_memory_bytes": sum(
+            engine.get_clip_sample_count(clip_id) * BYTES_PER_SAMPLE[args.clip_format]
+            for clip_ids in clip_pools.values()
+            for clip_id in clip_ids),
+        "process_peak_memory_bytes": get_process_peak_memory(),
+        "results": results
+    }
+
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent = 2)
+
+    print("Results written to {}".format(args.output))
+    engine.shutdown()
+
+# Records clips of sines through the virtual devices so the benchmark doesn't depend on any files
+def record_clip_pool(input_device_index, output_device_index, clip_seconds):
+    frames_per_buffer = 1024
+    clip_ids = []
+    for i in range(CLIP_POOL_SIZE):
+        engine.set_virtual_input(110.0 * (i + 1))
+        engine.set_virtual_device(False, int(clip_seconds * SAMPLE_RATE))
+        clip_id = engine.start_recording_clip(input_device_index, output_device_index, frames_per_buffer)
+        engine.wait_virtual_device()
+        engine.stop_recording_clip()
+        clip_ids.append(clip_id)
+
+    engine.set_virtual_input(None)
+    return clip_ids
+
+# Places clips on each track at random so that on average density clips play at once per track. Returns the number of
+# playback clips.
+def build_arrangement(track_count, clip_ids, density, seconds):
+    rng = random.Random(SEED)
+    total_sample_count = int(seconds * SAMPLE_RATE)
+
+    # A clip of length L starting uniformly in [-L, T) overlaps the run for L * T / (L + T) seconds on average
+    clip_seconds = engine.get_clip_sample_count(clip_ids[0]) / SAMPLE_RATE
+    clips_per_track = max(round(density * (clip_seconds + seconds) / clip_seconds), 1)
+
+    engine.playback_builder_begin()
+    playback_clip_count = 0
+    for track_index in range(track_count):
+        for i in range(clips_per_track):
+            clip_id = clip_ids[(track_index + i) % len(clip_ids)]
+            clip_sample_count = engine.get_clip_sample_count(clip_id)
+            playback_start_sample_index = rng.randrange(-clip_sample_count + 1, total_sample_count)
+            engine.playback_builder_add_clip(clip_id, 0, clip_sample_count, playback_start_sample_index, 0.1)
+            playback_clip_count += 1
+
+    engine.playback_builder_finalize()
+    return playback_clip_count
+
+def run_playback(output_device_index, frames_per_buffer, seconds):
+    sample_count = int(seconds * SAMPLE_RATE)
+    # The output isn't needed, so don't let capturing it count towards the memory use
+    engine.set_virtual_device(False, sample_count, False)
+    engine.reset_stats()
+
+    start_time = time.perf_counter()
+    engine.start_playback(output_device_index, frames_per_buffer, 0)
+    engine.wait_virtual_device()
+    elapsed_time = time.perf_counter() - start_time
+    engine.stop_playback()
+
+    stats = engine.get_stats()
+    rendered_sample_count = stats["callback_count"] * frames_per_buffer
+
+    return {
+        "elapsed_seconds": elapsed_time,
+        "samples_per_second": rendered_sample_count / elapsed_time,
+        "realtime_factor": rendered_sample_count / SAMPLE_RATE / elapsed_time,
+        "stats": stats
+    }
+
+# Returns the peak resident set size of the process over all runs so far, or None if it can't be queried. The peak never
+# goes down, so it's only meaningful for the process as a whole rather than for any one run.
+def get_process_peak_memory():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # Reported in kilobytes on Linux
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,67 @@
     nullptr                                 \
 }
 
+// Functions which operate on an engine. They're methods of engine.Engine, and also module-level functions which use the
+// default engine.
+#define ENGINE_METHODS                                                    \
+    ENGINE_FUNCTION(set_sample_rate, METH_VARARGS),                       \
+    ENGINE_FUNCTION(resample_clips, METH_VARARGS),                        \
+    ENGINE_FUNCTION(start_time_stretch, METH_VARARGS),                    \
+    ENGINE_FUNCTION(finish_time_stretch, METH_NOARGS),                    \
+    ENGINE_FUNCTION(cancel_time_stretch, METH_NOARGS),                    \
+    ENGINE_FUNCTION(load_clip, METH_VARARGS),                             \
+    ENGINE_FUNCTION(save_clip, METH_VARARGS),                             \
+    ENGINE_FUNCTION(get_archive_metadata, METH_VARARGS),                  \
+    ENGINE_FUNCTION(load_archive, METH_VARARGS),                          \
+    ENGINE_FUNCTION(save_archive, METH_VARARGS),                          \
+    ENGINE_FUNCTION(delete_clip, METH_VARARGS),                           \
+    ENGINE_FUNCTION(set_clip_storage_format, METH_VARARGS),               \
+    ENGINE_FUNCTION(get_clip_storage_format, METH_VARARGS),               \
+    ENGINE_FUNCTION(start_recording_clip, METH_VARARGS),                  \
+    ENGINE_FUNCTION(stop_recording_clip, METH_VARARGS),                   \
+    ENGINE_FUNCTION(get_recorded_sample_count, METH_NOARGS),              \
+    ENGINE_FUNCTION(get_latest_recorded_samples, METH_VARARGS),           \
+    ENGINE_FUNCTION(get_recorded_peak_blocks, METH_VARARGS),              \
+    ENGINE_FUNCTION(get_clip_sample_count, METH_VARARGS),                 \
+    ENGINE_FUNCTION(get_clip_samples, METH_VARARGS),                      \
+    ENGINE_FUNCTION(analyze_clip_boundaries, METH_VARARGS),               \
+    ENGINE_FUNCTION(playback_builder_begin, METH_NOARGS),                 \
+    ENGINE_FUNCTION(playback_builder_add_bus, METH_VARARGS),              \
+    ENGINE_FUNCTION(playback_builder_add_clip, METH_VARARGS),             \
+    ENGINE_FUNCTION(playback_builder_enable_render_cache, METH_VARARGS),  \
+    ENGINE_FUNCTION(playback_builder_set_end_sample_index, METH_VARARGS), \
+    ENGINE_FUNCTION(playback_builder_finalize, METH_NOARGS),              \
+    ENGINE_FUNCTION(get_render_cache_status, METH_NOARGS),                \
+    ENGINE_FUNCTION(clear_render_cache, METH_NOARGS),                     \
+    ENGINE_FUNCTION(start_playback, METH_VARARGS),                        \
+    ENGINE_FUNCTION(stop_playback, METH_VARARGS),                         \
+    ENGINE_FUNCTION(is_stopping, METH_NOARGS),                            \
+    ENGINE_FUNCTION(wait_for_stop, METH_NOARGS),                          \
+    ENGINE_FUNCTION(render_playback, METH_VARARGS),                       \
+    ENGINE_FUNCTION(preview_clip, METH_VARARGS),                          \
+    ENGINE_FUNCTION(stop_preview, METH_NOARGS),                           \
+    ENGINE_FUNCTION(set_loop, METH_VARARGS),                              \
+    ENGINE_FUNCTION(clear_loop, METH_NOARGS),                             \
+    ENGINE_FUNCTION(set_bus_gain, METH_VARARGS),                          \
+    ENGINE_FUNCTION(set_bus_muted, METH_VARARGS),                         \
+    ENGINE_FUNCTION(set_bus_soloed, METH_VARARGS),                        \
+    ENGINE_FUNCTION(get_playback_sample_index, METH_NOARGS),              \
+    ENGINE_FUNCTION(get_playback_position, METH_VARARGS),                 \
+    ENGINE_FUNCTION(poll_events, METH_NOARGS),                            \
+    ENGINE_FUNCTION(set_metronome_samples_per_beat, METH_VARARGS),        \
+    ENGINE_FUNCTION(get_stats, METH_NOARGS),                              \
+    ENGINE_FUNCTION(get_meters, METH_NOARGS),                             \
+    ENGINE_FUNCTION(reset_stats, METH_NOARGS),                            \
+    ENGINE_FUNCTION(set_trace_enabled, METH_VARARGS),                     \
+    ENGINE_FUNCTION(drain_trace, METH_NOARGS),                            \
+    ENGINE_FUNCTION(set_virtual_device, METH_VARARGS),                    \
+    ENGINE_FUNCTION(set_virtual_input, METH_VARARGS),                     \
+    ENGINE_FUNCTION(wait_virtual_device, METH_NOARGS),                    \
+    ENGINE_FUNCTION(get_virtual_output, METH_NOARGS),                     \
+    ENGINE_FUNCTION(clear_virtual_output, METH_NOARGS)
+
 PyMethodDef functions[] = {
-    ENGINE_FUNCTION(initialize, METH_NOARGS),
+    ENGINE_FUNCTION(initialize, METH_VARARGS),
     ENGINE_FUNCTION(shutdown, METH_NOARGS),
     ENGINE_FUNCTION(get_input_device_count, METH_NOARGS),
     ENGINE_FUNCTION(get_default_input_device_index, METH_NOARGS),
@@ -17,26 +76,20 @@ PyMethodDef functions[] = {
     ENGINE_FUNCTION(get_output_device_count, METH_NOARGS),
     ENGINE_FUNCTION(get_default_output_device_index, METH_NOARGS),
     ENGINE_FUNCTION(get_output_device_name, METH_VARARGS),
-    ENGINE_FUNCTION(set_sample_rate, METH_VARARGS),
-    ENGINE_FUNCTION(load_clip, METH_VARARGS),
-    ENGINE_FUNCTION(save_clip, METH_VARARGS),
-    ENGINE_FUNCTION(delete_clip, METH_VARARGS),
-    ENGINE_FUNCTION(start_recording_clip, METH_VARARGS),
-    ENGINE_FUNCTION(stop_recording_clip, METH_NOARGS),
-    ENGINE_FUNCTION(get_recorded_sample_count, METH_NOARGS),
-    ENGINE_FUNCTION(get_latest_recorded_samples, METH_VARARGS),
-    ENGINE_FUNCTION(get_clip_sample_count, METH_VARARGS),
-    ENGINE_FUNCTION(get_clip_samples, METH_VARARGS),
-    ENGINE_FUNCTION(playback_builder_begin, METH_NOARGS),
-    ENGINE_FUNCTION(playback_builder_add_clip, METH_VARARGS),
-    ENGINE_FUNCTION(playback_builder_finalize, METH_NOARGS),
-    ENGINE_FUNCTION(start_playback, METH_VARARGS),
-    ENGINE_FUNCTION(stop_playback, METH_NOARGS),
-    ENGINE_FUNCTION(get_playback_sample_index, METH_NOARGS),
-    ENGINE_FUNCTION(set_metronome_samples_per_beat, METH_VARARGS),
+    ENGINE_METHODS,
+    ENGINE_FUNCTION(get_time, METH_NOARGS),
     nullptr
 };
 
+PyMethodDef engine_methods[] = {
+    ENGINE_METHODS,
+    nullptr
+};
+
+PyTypeObject engine_type = {
+    PyVarObject_HEAD_INIT(nullptr, 0)
+};
+
 PyModuleDef engine_module = {
     PyModuleDef_HEAD_INIT,
     "engine",
@@ -50,5 +103,28 @@ PyModuleDef engine_module = {
 };
 
 PyMODINIT_FUNC PyInit_engine() {
-    return PyModule_Create(&engine_module);
+    engine_type.tp_name = "engine.Engine";
+    engine_type.tp_basicsize = sizeof(s_engine_object);
+    engine_type.tp_flags = Py_TPFLAGS_DEFAULT;
+    engine_type.tp_doc = "An engine with its own clips, playback and stream";
+    engine_type.tp_new = engine_new;
+    engine_type.tp_dealloc = engine_dealloc;
+    engine_type.tp_methods = engine_methods;
+    if (PyType_Ready(&engine_type) < 0) {
+        return nullptr;
+    }
+
+    PyObject *module = PyModule_Create(&engine_module);
+    if (!module) {
+        return nullptr;
+    }
+
+    Py_INCREF(&engine_type);
+    if (PyModule_AddObject(module, "Engine", reinterpret_cast<PyObject *>(&engine_type)) < 0) {
+        Py_DECREF(&engine_type);
+        Py_DECREF(module);
+        return nullptr;
+    }
+
+    return module;
 }
@@ -1,10 +1,28 @@
 #include "libengine.h"
+#include "analysis.h"
+#include "archive.h"
+#include "lossless.h"
+#include "mapped_file.h"
+#include "mix.h"
+#include "parallel.h"
+#include "render_cache.h"
+#include "resampler.h"
+#include "time_stretch.h"
+#include "trace.h"
+#include "virtual_device.h"
 #include "wav.h"
 
 #include <portaudio.h>
 
 #include <algorithm>
 #include <atomic>
+#include <cassert>
+#include <chrono>
+#include <cmath>
+#include <cstring>
+#include <deque>
+#include <functional>
+#include <memory>
 #include <string>
 #include <thread>
 #include <unordered_map>
@@ -14,25 +32,85 @@ struct s_device {
     int32_t m_portaudio_device_index = 0;
     std::string m_name = {};
     PaTime m_suggested_latency = 0;
+    bool m_virtual = false;     // Backed by the engine's virtual device rather than portaudio
 };
 
 using t_clip_id = int32_t;
 
 struct s_clip {
+    // Samples are either owned by the clip or point directly into a memory-mapped file
     std::vector<float> m_samples = {};
+    std::shared_ptr<c_mapped_file> m_mapped_file = nullptr;
+    const float *m_mapped_samples = nullptr;
+    size_t m_mapped_sample_count = 0;
+
+    // Clips stored at reduced precision are mixed from m_packed_samples. Mapped clips are always float32.
+    e_sample_format m_format = e_sample_format::k_float32;
+    std::vector<uint16_t> m_packed_samples = {};
+    float m_packed_scale = 1.0f;
+
+    // Peak and mean square of each k_peak_block_size block of samples, so the mixer can skip silence and buses can be
+    // metered. Mapped clips leave these empty until they're first played, see update_playback_clip_levels.
+    std::vector<float> m_block_peaks = {};
+    std::vector<float> m_block_mean_squares = {};
+
+    size_t get_sample_count() const {
+        if (m_mapped_file) {
+            return m_mapped_sample_count;
+        }
+
+        return m_format == e_sample_format::k_float32 ? m_samples.size() : m_packed_samples.size();
+    }
+
+    const float *get_block_peaks() const { return m_block_peaks.empty() ? nullptr : m_block_peaks.data(); }
+
+    s_mix_source get_mix_source() const {
+        if (m_format == e_sample_format::k_float32) {
+            return { m_mapped_file ? m_mapped_samples : m_samples.data(), m_format, 1.0f, get_block_peaks() };
+        }
+
+        return { m_packed_samples.data(), m_format, m_packed_scale, get_block_peaks() };
+    }
+
+    // Returns the samples at the highest precision available, decoding into decoded_samples if necessary
+    const float *get_float_samples(std::vector<float> &decoded_samples) const {
+        if (m_mapped_file) {
+            return m_mapped_samples;
+        } else if (m_format == e_sample_format::k_float32) {
+            return m_samples.data();
+        }
+
+        decoded_samples.resize(get_sample_count());
+        decode_samples(get_mix_source(), 0, decoded_samples.size(), decoded_samples.data());
+        return decoded_samples.data();
+    }
+
+    void update_block_levels() {
+        std::vector<float> decoded_samples;
+        compute_block_levels(get_float_samples(decoded_samples), get_sample_count(), m_block_peaks, m_block_mean_squares);
+    }
 };
 
+static const char *k_sample_format_names[] = { "float32", "int16", "float16" };
+static_assert(
+    sizeof(k_sample_format_names) / sizeof(k_sample_format_names[0]) == static_cast<size_t>(e_sample_format::k_count),
+    "Sample format names out of date");
+
 // Amount of time in a single recording buffer
 static const float k_recording_buffer_length_seconds = 5.0f;
 
 // Amount of time remaining in the current recording buffer before we allocate the next one
 static const float k_recording_buffer_padding_seconds = 1.0f;
 
+// Offline renders are mixed in pieces of this size, like a stream's buffers
+static const size_t k_render_frames_per_buffer = 1024;
+
 struct s_recording_buffer {
     std::vector<float> m_samples = {};
     std::atomic<size_t> m_usage = 0;
     s_recording_buffer *m_prev = nullptr;
     std::atomic<s_recording_buffer *> m_next = nullptr;
+    bool m_low_reported = false; // Only accessed by the audio thread
 };
 
 class c_recording_allocator {
@@ -44,6 +122,7 @@ public:
     void save_recorded_samples(std::vector<float> &buffer);
     void clear();
     s_recording_buffer *get_first_buffer() { return m_first_buffer; }
+    size_t get_recording_buffer_padding() const { return m_recording_buffer_padding; }
 
 private:
     void thread_main();
@@ -56,12 +135,41 @@ private:
     std::atomic<bool> m_terminate = false;
 };
 
+// Levels measured by the audio thread over each callback. The peak is held until get_meters reads it so that
+// transients between reads aren't missed.
+struct s_meter {
+    std::atomic<float> m_peak = 0.0f;
+    std::atomic<float> m_rms = 0.0f;
+};
+
+// A group of playback clips, such as a track or a category, whose gain, mute and solo can change during playback
+struct s_bus {
+    std::atomic<float> m_gain = 1.0f;
+    std::atomic<bool> m_muted = false;
+    std::atomic<bool> m_soloed = false;
+    s_meter m_meter;
+
+    // Snapshot taken by the audio thread at the start of each callback
+    float m_block_gain = 1.0f;      // 0 if muted
+    bool m_block_soloed = false;    // Soloed and not muted
+
+    // Levels of the bus's clips accumulated by the audio thread over a callback. The peak is an upper bound, see
+    // accumulate_bus_levels.
+    float m_block_peak = 0.0f;
+    float m_block_energy = 0.0f;
+};
+
 struct s_playback_clip {
     t_clip_id m_clip_id = 0;
     int32_t m_start_sample_index = 0;
     int32_t m_end_sample_index = 0;
     int32_t m_playback_start_sample_index = 0;
     float m_gain = 0.0f;
+    std::vector<int32_t> m_bus_indices = {};    // The clip's gain is multiplied by the gain of each of these buses
+
+    // Gain changes are ramped across a callback to avoid clicks
+    float m_current_gain = 0.0f;
+    float m_target_gain = 0.0f;
 
     s_playback_clip *m_prev_active_playback_clip = nullptr;
     s_playback_clip *m_next_active_playback_clip = nullptr;
@@ -78,26 +186,154 @@ struct s_playback_event {
     int32_t m_sample_index = 0;
 };
 
-struct s_engine_state {
-    bool m_portaudio_initialized = false;
-    std::vector<s_device> m_input_devices = {};
-    std::vector<s_device> m_output_devices = {};
-    int32_t m_default_input_device_index = -1;
-    int32_t m_default_output_device_index = -1;
+// The event cursor and the clips which are active when playback starts from a particular sample index
+struct s_playback_seek_point {
+    size_t m_next_playback_event_index = 0;
+    std::vector<size_t> m_active_playback_clip_indices = {};
+};
+
+// A range of playback whose mixed output can come from the render cache
+struct s_render_cache_segment {
+    int32_t m_start_sample_index = 0;
+    int32_t m_end_sample_index = 0;
+    std::shared_ptr<s_render_cache_entry> m_entry = nullptr;
+};
+
+// Sent from Python to the audio thread to start or stop the preview voice
+struct s_preview_command {
+    bool m_start = false;           // Stops the preview if false
+    s_mix_source m_source = {};
+    int32_t m_start_sample_index = 0;
+    int32_t m_end_sample_index = 0;
+    float m_gain = 0.0f;
+};
+
+// A one-shot player which is mixed over the playback, only accessed by the audio thread
+struct s_preview_voice {
+    bool m_active = false;
+    s_mix_source m_source = {};
+    int32_t m_sample_index = 0;
+    int32_t m_end_sample_index = 0;
+    float m_gain = 0.0f;
+};
+
+// One clip being time-stretched in the background. The stretched clip is built up by a worker thread and only added to
+// the engine's clips once the whole stretch has finished.
+struct s_time_stretch_task {
+    const s_clip *m_source_clip = nullptr;
+    s_clip m_clip = {};
+};
+
+// Callback durations are measured as a fraction of the buffer period. The histogram has k_stats_histogram_bucket_count
+// buckets of width k_stats_histogram_bucket_width, and the last bucket also counts everything beyond it.
+static const size_t k_stats_histogram_bucket_count = 400;
+static const double k_stats_histogram_bucket_width = 0.005;
+
+// Durations are stored as integer parts per million of the buffer period so they can be kept in plain atomics
+static const double k_stats_duration_scale = 1000000.0;
+
+// Only the audio thread writes these (except for resets), and nothing on the audio thread takes a lock
+struct s_engine_stats {
+    std::atomic<uint64_t> m_callback_count = 0;
+    std::atomic<uint64_t> m_total_callback_duration = 0;
+    std::atomic<uint64_t> m_min_callback_duration = UINT64_MAX;
+    std::atomic<uint64_t> m_max_callback_duration = 0;
+    std::atomic<uint32_t> m_callback_duration_histogram[k_stats_histogram_bucket_count] = {};
+
+    std::atomic<uint64_t> m_input_underflows = 0;
+    std::atomic<uint64_t> m_input_overflows = 0;
+    std::atomic<uint64_t> m_output_underflows = 0;
+    std::atomic<uint64_t> m_output_overflows = 0;
+    std::atomic<uint64_t> m_recording_underflows = 0;
+    std::atomic<int32_t> m_active_clip_high_water = 0;
+};
+
+enum class e_trace_event_name : uint8_t {
+    k_recording_callback,
+    k_playback_callback,
+    k_metronome,
+    k_recording_copy,
+    k_mix,
+    k_cached_mix,
+    k_clip_start,
+    k_clip_stop,
+    k_preview,
+
+    k_count
+};
+
+static const char *k_trace_event_names[] = {
+    "recording_callback",
+    "playback_callback",
+    "metronome",
+    "recording_copy",
+    "mix",
+    "cached_mix",
+    "clip_start",
+    "clip_stop",
+    "preview"
+};
+
+static_assert(
+    sizeof(k_trace_event_names) / sizeof(k_trace_event_names[0]) == static_cast<size_t>(e_trace_event_name::k_count),
+    "Trace event name mismatch");
+
+// Things the audio thread reports to Python, which reads them all at once each frame
+enum class e_engine_event : uint8_t {
+    k_playback_end,             // Playback reached the end sample index
+    k_xrun,                     // The device reported an underflow or overflow, the argument holds the status flags
+    k_recording_underflow,      // The recording ran out of buffer space and input was lost
+    k_recording_buffer_low,     // The recording buffer is nearly full and the next one isn't ready yet
+    k_loop_wrapped,             // Playback reached the loop end and jumped back, the argument holds the loop start
+
+    k_count
+};
+
+static const char *k_engine_event_names[] = {
+    "playback_end",
+    "xrun",
+    "recording_underflow",
+    "recording_buffer_low",
+    "loop_wrapped"
+};
+
+static_assert(
+    sizeof(k_engine_event_names) / sizeof(k_engine_event_names[0]) == static_cast<size_t>(e_engine_event::k_count),
+    "Engine event name mismatch");
+
+struct s_engine_event {
+    e_engine_event m_event;
+    int32_t m_sample_index;
+    int32_t m_argument;
+};
 
+// Each engine has its own clips, playback and stream. This is the state of one engine.
+struct s_engine_state {
     int32_t m_sample_rate = 0;
 
     t_clip_id m_next_clip_id = 0;
     std::unordered_map<t_clip_id, s_clip> m_clips = {};
 
-    // The current portaudio stream
+    // The current stream, which runs on either portaudio or the virtual device
     PaStream *m_stream = nullptr;
+    bool m_stream_virtual = false;
+
+    // A stop which was started without waiting runs on its own thread. Until it's finished, the engine still counts as
+    // playing or recording.
+    std::thread *m_stream_stop_thread = nullptr;
+    std::atomic<bool> m_stream_stop_complete = false;
+    const char *m_stream_stop_error = nullptr;
+
+    // Only created if virtual devices were requested on initialization. Each engine gets its own.
+    std::unique_ptr<c_virtual_device> m_virtual_device = nullptr;
+
+    // Set while render_playback is mixing without the GIL
+    bool m_rendering = false;
 
     bool m_recording = false;
     t_clip_id m_recording_clip_id = -1;
     c_recording_allocator m_recording_allocator = {};
     std::atomic<s_recording_buffer *> m_current_recording_buffer = nullptr;
-    int32_t m_recording_underflows = 0;
 
     // At time t, it takes n samples until the first metronome tick comes out the speakers (playback latency)
     // The sound data from time t+n is recorded m samples later (recording latency)
@@ -105,27 +341,141 @@ struct s_engine_state {
     int32_t m_recording_playback_latency = 0;
     int32_t m_samples_until_recording_begins = 0;
 
+    // Clips being auditioned over the playback. Clips can't be deleted or changed while playing, so the voice can keep
+    // pointers to their samples.
+    c_spsc_ring<s_preview_command, 16> m_preview_commands = {};
+    s_preview_voice m_preview_voice = {};
+
+    // Levels of the stream's input (while recording) and output, including the metronome and preview
+    s_meter m_input_meter = {};
+    s_meter m_output_meter = {};
+
+    std::deque<s_bus> m_buses = {};                             // Buses which clips in the current playback route through
+    std::atomic<uint32_t> m_bus_version = 0;                    // Incremented whenever a bus changes
+    bool m_solo_active = false;                                 // Whether any bus was soloed at the start of the callback
     std::vector<s_playback_clip> m_playback_clips = {};         // List of all clips in the current playback
     std::vector<s_playback_event> m_playback_events = {};       // Ordered list of start and stop events for clips
     s_playback_clip *m_first_active_playback_clip = nullptr;    // Linked list of active playback clips
+    int32_t m_active_playback_clip_count = 0;
 
     bool m_playing = false;
     std::atomic<int32_t> m_playback_sample_index = 0;
     size_t m_next_playback_event_index = 0;
-
+    int32_t m_playback_end_sample_index = -1;    // Defaults to the end of the last clip when the playback is finalized
+    bool m_playback_end_reported = false;
+
+    // When looping, playback jumps from the loop end back to the loop start within the callback. The seek point for the
+    // loop start is found ahead of time so the audio thread doesn't need to search the events.
+    int32_t m_loop_start_sample_index = -1;     // -1 when not looping
+    int32_t m_loop_end_sample_index = -1;
+    s_playback_seek_point m_loop_seek_point = {};
+
+    // The stream frame at the start of the latest callback's buffer, its length, and the time at which that buffer is
+    // heard, used to extrapolate the audible position. Frames count every sample streamed since the stream started, so
+    // unlike the playback sample index they don't jump back when a loop wraps. The audio thread publishes them with a
+    // sequence lock so they're always read together.
+    int32_t m_playback_first_sample_index = 0;
+    int64_t m_playback_frame_index = 0;
+    std::atomic<uint32_t> m_playback_timestamp_sequence = 0;
+    std::atomic<int64_t> m_playback_timestamp_frame_index = 0;
+    std::atomic<int32_t> m_playback_timestamp_frame_count = 0;
+    std::atomic<int64_t> m_playback_timestamp_time = INT64_MIN;  // From get_trace_time(), INT64_MIN until published
+
+    // Pre-mixed segments of the current playback. They're only used while the buses are as they were when the playback
+    // was finalized, since bus changes alter the mix.
+    c_render_cache m_render_cache = {};
+    double m_render_cache_samples_per_segment = 0.0;
+    std::vector<s_render_cache_segment> m_render_cache_segments = {};
+    uint32_t m_render_cache_bus_version = 0;
+
+    // Published by set_metronome_samples_per_beat with a sequence lock so that a tempo and its beats per measure always
+    // take effect together
+    std::atomic<uint32_t> m_metronome_settings_sequence = 0;
     std::atomic<double> m_metronome_samples_per_beat = 0.0;
+    std::atomic<int32_t> m_metronome_beats_per_measure = 0;
+
+    // Clicks are rendered once per sample rate rather than synthesized in the audio callback
+    int32_t m_metronome_click_sample_rate = 0;
+    std::vector<float> m_metronome_click = {};
+    std::vector<float> m_metronome_accented_click = {};
+
+    // Audio thread metronome state: the latest settings it has read, the next beat which is tracked incrementally, and
+    // the click which is currently sounding
+    double m_metronome_block_samples_per_beat = 0.0;
+    int32_t m_metronome_block_beats_per_measure = 0;
+    double m_metronome_active_samples_per_beat = 0.0;   // Negative to resynchronize with the beat grid
+    int64_t m_metronome_next_beat_index = 0;
+    double m_metronome_next_beat_sample = 0.0;
+    const float *m_metronome_click_samples = nullptr;
+    int32_t m_metronome_click_length = 0;
     int32_t m_metronome_sample = 0;
+
+    s_engine_stats m_stats = {};
+
+    // Audio thread timing events, only recorded while tracing is enabled
+    std::atomic<bool> m_trace_enabled = false;
+    c_trace_ring m_trace_ring = {};
+
+    // Events for Python, cleared whenever a stream starts. Stops which finish in the background are reported alongside
+    // them but aren't queued by the audio thread, so they're tracked separately.
+    c_spsc_ring<s_engine_event, 1024> m_event_ring = {};
+    bool m_stream_stopped_event_pending = false;
+
+    // A time stretch started by start_time_stretch. Its source clips can't be changed or deleted until it has been
+    // finished or canceled.
+    std::thread *m_time_stretch_thread = nullptr;
+    std::vector<s_time_stretch_task> m_time_stretch_tasks = {};
+    std::atomic<size_t> m_time_stretch_completed_count = 0;
+    std::atomic<bool> m_time_stretch_terminate = false;
+    size_t m_time_stretch_reported_count = 0;   // The progress last reported by poll_events, SIZE_MAX before the first
 };
 
 static const double k_metronome_pitch_hz = 1760.0;
+static const double k_metronome_accented_pitch_hz = 3520.0;
 static const double k_metronome_time_seconds = 0.05;
 static const double k_metronome_amplitude = 0.5;
 static const double k_pi = 3.141592653589793238463;
 
-static s_engine_state g_engine_state;
+// Devices are shared by all engines
+struct s_device_state {
+    bool m_portaudio_initialized = false;
+    bool m_virtual_devices_enabled = false;
+    std::vector<s_device> m_input_devices = {};
+    std::vector<s_device> m_output_devices = {};
+    int32_t m_default_input_device_index = -1;
+    int32_t m_default_output_device_index = -1;
+
+    std::vector<s_engine_state *> m_engine_instances = {};  // Engines created through engine.Engine
+};
+
+static s_device_state g_device_state;
+
+// Used by the module-level functions
+static s_engine_state g_default_engine_state;
 
-static void activate_playback_clip(size_t playback_clip_index);
-static void deactivate_playback_clip(size_t playback_clip_index);
+// Engine methods operate on their own state, and module-level functions operate on the default engine
+static s_engine_state &get_engine_state(PyObject *self) {
+    if (self && PyObject_TypeCheck(self, &engine_type)) {
+        return *reinterpret_cast<s_engine_object *>(self)->m_state;
+    }
+
+    return g_default_engine_state;
+}
+
+static void set_clip_format(s_clip &clip, e_sample_format format);
+static void find_playback_seek_point(s_engine_state &state, int32_t sample_index, s_playback_seek_point &seek_point);
+static void seek_playback(s_engine_state &state, int32_t sample_index);
+static void apply_playback_seek_point(s_engine_state &state, const s_playback_seek_point &seek_point);
+static void wrap_playback_loop(s_engine_state &state);
+static void activate_playback_clip(s_engine_state &state, size_t playback_clip_index);
+static void deactivate_playback_clip(s_engine_state &state, size_t playback_clip_index);
+static void update_bus_gains(s_engine_state &state);
+static float get_playback_clip_target_gain(s_engine_state &state, const s_playback_clip &playback_clip);
+static void update_render_cache(s_engine_state &state);
+static const s_render_cache_segment *find_render_cache_segment(
+    s_engine_state &state,
+    int32_t sample_index,
+    int32_t &end_sample_index);
 
 static int recording_stream_main(
     const void *input,
@@ -143,35 +493,92 @@ static int playback_stream_main(
     PaStreamCallbackFlags status_flags,
     void *user_data);
 
-static void add_metronome_track(float *output, size_t frame_count);
+static void mix_playback(s_engine_state &state, float *output, size_t frame_count);
+static void accumulate_bus_levels(s_engine_state &state, int32_t sample_index, int32_t sample_count);
+static void update_meter(s_meter &meter, float peak, float sum_of_squares, size_t sample_count);
+static void reset_meters(s_engine_state &state);
+static void mix_preview(s_engine_state &state, float *output, size_t frame_count);
+
+static bool start_stream(
+    s_engine_state &state,
+    const s_device *input_device,
+    const s_device &output_device,
+    int32_t frames_per_buffer,
+    PaStreamCallback *callback,
+    const std::function<bool()> &virtual_device_ready = nullptr);
+static const char *stop_stream(s_engine_state &state, bool immediate);
+static void begin_stream_stop(s_engine_state &state, bool immediate);
+static bool update_stream_stop(s_engine_state &state, bool wait);
+static void finish_recording(s_engine_state &state);
+static void stop_time_stretch(s_engine_state &state);
+static void trace(s_engine_state &state, e_trace_phase phase, e_trace_event_name name, int32_t argument = 0);
+static void post_event(s_engine_state &state, e_engine_event event, int32_t sample_index, int32_t argument = 0);
+static void reset_metronome(s_engine_state &state);
+static void update_playback_clip_levels(s_engine_state &state);
+static void record_callback_flags(s_engine_state &state, PaStreamCallbackFlags status_flags);
+static void reset_playback_timestamp(s_engine_state &state, int32_t sample_index);
+static void publish_playback_timestamp(
+    s_engine_state &state,
+    const PaStreamCallbackTimeInfo *time_info,
+    unsigned long frame_count);
+static bool read_playback_timestamp(s_engine_state &state, int64_t &frame_index, int32_t &frame_count, int64_t &time);
+static void record_callback_duration(
+    s_engine_state &state,
+    std::chrono::steady_clock::time_point start_time,
+    unsigned long frame_count);
+static void add_metronome_track(s_engine_state &state, float *output, size_t frame_count);
+
+// Common error checks, which expect the engine's state in a local named state
+// A stop which has finished in the background is completed first, so callers see the engine as soon as it's stopped
+#define ERROR_IF_RECORDING                                                                        \
+do {                                                                                              \
+    if (!update_stream_stop(state, false)) {                                                      \
+        return nullptr;                                                                           \
+    }                                                                                             \
+    if (state.m_recording) {                                                                      \
+        PyErr_SetString(PyExc_Exception, "Cannot perform this action while recording is active"); \
+        return nullptr;                                                                           \
+    }                                                                                             \
+} while (0)
 
-// Common error checks
-#define ERROR_IF_RECORDING                                                                          \
-do {                                                                                                \
-    if (g_engine_state.m_recording) {                                                               \
-        PyErr_SetString(PyExc_Exception, "Cannot perform this action while recording is active");   \
-        return nullptr;                                                                             \
-    }                                                                                               \
+#define ERROR_IF_PLAYING                                                                         \
+do {                                                                                             \
+    if (!update_stream_stop(state, false)) {                                                     \
+        return nullptr;                                                                          \
+    }                                                                                            \
+    if (state.m_playing) {                                                                       \
+        PyErr_SetString(PyExc_Exception, "Cannot perform this action while playback is active"); \
+        return nullptr;                                                                          \
+    }                                                                                            \
+    if (state.m_rendering) {                                                                     \
+        PyErr_SetString(PyExc_Exception, "Cannot perform this action while rendering");          \
+        return nullptr;                                                                          \
+    }                                                                                            \
 } while (0)
 
-#define ERROR_IF_PLAYING                                                                            \
-do {                                                                                                \
-    if (g_engine_state.m_recording) {                                                               \
-        PyErr_SetString(PyExc_Exception, "Cannot perform this action while playback is active");    \
-        return nullptr;                                                                             \
-    }                                                                                               \
+#define ERROR_IF_TIME_STRETCHING                                                                        \
+do {                                                                                                    \
+    if (state.m_time_stretch_thread) {                                                                  \
+        PyErr_SetString(PyExc_Exception, "Cannot perform this action while a time stretch is running"); \
+        return nullptr;                                                                                 \
+    }                                                                                                   \
 } while (0)
 
-#define ERROR_IF_INVALID_CLIP_ID(clip_id)                                       \
-do {                                                                            \
-    if (g_engine_state.m_clips.find(clip_id) == g_engine_state.m_clips.end()) { \
-        PyErr_SetString(PyExc_ValueError, "Invalid clip ID");                   \
-        return nullptr;                                                         \
-    }                                                                           \
+#define ERROR_IF_INVALID_CLIP_ID(clip_id)                     \
+do {                                                          \
+    if (state.m_clips.find(clip_id) == state.m_clips.end()) { \
+        PyErr_SetString(PyExc_ValueError, "Invalid clip ID"); \
+        return nullptr;                                       \
+    }                                                         \
 } while (0)
 
-PyObject *initialize(PyObject *self) {
-    if (g_engine_state.m_portaudio_initialized) {
+PyObject *initialize(PyObject *self, PyObject *args) {
+    int virtual_devices = 0;
+    if (!PyArg_ParseTuple(args, "|p", &virtual_devices)) {
+        return nullptr;
+    }
+
+    if (g_device_state.m_portaudio_initialized) {
         PyErr_SetString(PyExc_Exception, "Engine already initialized");
         return nullptr;
     }
@@ -200,48 +607,152 @@ PyObject *initialize(PyObject *self) {
 
         if (device_info->maxInputChannels > 0) {
             if (device_index == default_input_device_index) {
-                g_engine_state.m_default_input_device_index =
-                    static_cast<int32_t>(g_engine_state.m_input_devices.size());
+                g_device_state.m_default_input_device_index =
+                    static_cast<int32_t>(g_device_state.m_input_devices.size());
             }
 
-            g_engine_state.m_input_devices.push_back(device);
-            g_engine_state.m_input_devices.back().m_suggested_latency = device_info->defaultLowInputLatency;
+            g_device_state.m_input_devices.push_back(device);
+            g_device_state.m_input_devices.back().m_suggested_latency = device_info->defaultLowInputLatency;
         }
 
         if (device_info->maxOutputChannels > 0) {
             if (device_index == default_output_device_index) {
-                g_engine_state.m_default_output_device_index =
-                    static_cast<int32_t>(g_engine_state.m_output_devices.size());
+                g_device_state.m_default_output_device_index =
+                    static_cast<int32_t>(g_device_state.m_output_devices.size());
             }
 
-            g_engine_state.m_output_devices.push_back(device);
-            g_engine_state.m_output_devices.back().m_suggested_latency = device_info->defaultLowOutputLatency;
+            g_device_state.m_output_devices.push_back(device);
+            g_device_state.m_output_devices.back().m_suggested_latency = device_info->defaultLowOutputLatency;
+        }
+    }
+
+    if (virtual_devices) {
+        // The virtual devices come last, and are only the defaults if there's no real hardware. Each engine runs its own
+        // virtual device so that engines can stream at the same time.
+        g_device_state.m_virtual_devices_enabled = true;
+        g_default_engine_state.m_virtual_device = std::make_unique<c_virtual_device>();
+        for (s_engine_state *engine_state : g_device_state.m_engine_instances) {
+            engine_state->m_virtual_device = std::make_unique<c_virtual_device>();
+        }
+
+        s_device device;
+        device.m_portaudio_device_index = -1;
+        device.m_virtual = true;
+
+        if (g_device_state.m_default_input_device_index < 0) {
+            g_device_state.m_default_input_device_index = static_cast<int32_t>(g_device_state.m_input_devices.size());
+        }
+
+        device.m_name = "Virtual input";
+        g_device_state.m_input_devices.push_back(device);
+
+        if (g_device_state.m_default_output_device_index < 0) {
+            g_device_state.m_default_output_device_index = static_cast<int32_t>(g_device_state.m_output_devices.size());
         }
+
+        device.m_name = "Virtual output";
+        g_device_state.m_output_devices.push_back(device);
     }
 
-    g_engine_state.m_portaudio_initialized = true;
+    g_device_state.m_portaudio_initialized = true;
     Py_RETURN_NONE;
 }
 
 PyObject *shutdown(PyObject *self) {
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
+    // Every engine must be stopped before portaudio goes away
+    std::vector<s_engine_state *> engine_states = g_device_state.m_engine_instances;
+    engine_states.push_back(&g_default_engine_state);
+    for (s_engine_state *engine_state : engine_states) {
+        s_engine_state &state = *engine_state;
+        if (!update_stream_stop(state, true)) {
+            return nullptr;
+        }
+
+        ERROR_IF_RECORDING;
+        ERROR_IF_PLAYING;
+    }
+
+    for (s_engine_state *engine_state : engine_states) {
+        engine_state->m_render_cache_segments.clear();
+        engine_state->m_render_cache.clear();
+        stop_time_stretch(*engine_state);
+    }
 
-    if (g_engine_state.m_portaudio_initialized) {
+    if (g_device_state.m_portaudio_initialized) {
         Pa_Terminate();
-        g_engine_state.m_portaudio_initialized = false;
+        for (s_engine_state *engine_state : engine_states) {
+            engine_state->m_virtual_device = nullptr;
+        }
+
+        g_device_state.m_virtual_devices_enabled = false;
+        g_device_state.m_input_devices.clear();
+        g_device_state.m_output_devices.clear();
+        g_device_state.m_default_input_device_index = -1;
+        g_device_state.m_default_output_device_index = -1;
+        g_device_state.m_portaudio_initialized = false;
     }
 
     Py_RETURN_NONE;
 }
 
+PyObject *engine_new(PyTypeObject *type, PyObject *args, PyObject *kwargs) {
+    if (!PyArg_ParseTuple(args, "")) {
+        return nullptr;
+    }
+
+    s_engine_object *object = reinterpret_cast<s_engine_object *>(type->tp_alloc(type, 0));
+    if (!object) {
+        return nullptr;
+    }
+
+    object->m_state = new s_engine_state();
+    if (g_device_state.m_virtual_devices_enabled) {
+        object->m_state->m_virtual_device = std::make_unique<c_virtual_device>();
+    }
+
+    g_device_state.m_engine_instances.push_back(object->m_state);
+    return reinterpret_cast<PyObject *>(object);
+}
+
+void engine_dealloc(PyObject *self) {
+    s_engine_object *object = reinterpret_cast<s_engine_object *>(self);
+    s_engine_state *state = object->m_state;
+    if (state) {
+        // There's nowhere to report errors to, so the stream is stopped as well as it can be
+        bool stream_running = state->m_playing || state->m_recording;
+        if (state->m_stream_stop_thread) {
+            state->m_stream_stop_thread->join();
+            delete state->m_stream_stop_thread;
+            state->m_stream_stop_thread = nullptr;
+            stream_running = state->m_stream_stop_error != nullptr;
+        }
+
+        if (stream_running) {
+            stop_stream(*state, true);
+        }
+
+        if (state->m_recording) {
+            state->m_recording_allocator.stop();
+            state->m_recording_allocator.clear();
+        }
+
+        stop_time_stretch(*state);
+
+        std::vector<s_engine_state *> &engine_instances = g_device_state.m_engine_instances;
+        engine_instances.erase(std::find(engine_instances.begin(), engine_instances.end(), state));
+        delete state;
+    }
+
+    Py_TYPE(self)->tp_free(self);
+}
+
 PyObject *get_input_device_count(PyObject *self) {
-    return PyLong_FromSize_t(g_engine_state.m_input_devices.size());
+    return PyLong_FromSize_t(g_device_state.m_input_devices.size());
 }
 
 PyObject *get_default_input_device_index(PyObject *self) {
-    if (g_engine_state.m_default_input_device_index >= 0) {
-        return PyLong_FromLong(g_engine_state.m_default_input_device_index);
+    if (g_device_state.m_default_input_device_index >= 0) {
+        return PyLong_FromLong(g_device_state.m_default_input_device_index);
     } else {
         Py_RETURN_NONE;
     }
@@ -253,21 +764,21 @@ PyObject *get_input_device_name(PyObject *self, PyObject *args) {
         return nullptr;
     }
 
-    if (index < 0 || index >= g_engine_state.m_input_devices.size()) {
+    if (index < 0 || index >= g_device_state.m_input_devices.size()) {
         PyErr_SetString(PyExc_ValueError, "Device index out of range");
         return nullptr;
     }
 
-    return PyUnicode_FromString(g_engine_state.m_input_devices[index].m_name.c_str());
+    return PyUnicode_FromString(g_device_state.m_input_devices[index].m_name.c_str());
 }
 
 PyObject *get_output_device_count(PyObject *self) {
-    return PyLong_FromSize_t(g_engine_state.m_output_devices.size());
+    return PyLong_FromSize_t(g_device_state.m_output_devices.size());
 }
 
 PyObject *get_default_output_device_index(PyObject *self) {
-    if (g_engine_state.m_default_output_device_index >= 0) {
-        return PyLong_FromLong(g_engine_state.m_default_output_device_index);
+    if (g_device_state.m_default_output_device_index >= 0) {
+        return PyLong_FromLong(g_device_state.m_default_output_device_index);
     } else {
         Py_RETURN_NONE;
     }
@@ -279,17 +790,19 @@ PyObject *get_output_device_name(PyObject *self, PyObject *args) {
         return nullptr;
     }
 
-    if (index < 0 || index >= g_engine_state.m_output_devices.size()) {
+    if (index < 0 || index >= g_device_state.m_output_devices.size()) {
         PyErr_SetString(PyExc_ValueError, "Device index out of range");
         return nullptr;
     }
 
-    return PyUnicode_FromString(g_engine_state.m_output_devices[index].m_name.c_str());
+    return PyUnicode_FromString(g_device_state.m_output_devices[index].m_name.c_str());
 }
 
 PyObject *set_sample_rate(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
     ERROR_IF_RECORDING;
     ERROR_IF_PLAYING;
+    ERROR_IF_TIME_STRETCHING;
 
     int32_t sample_rate;
     if (!PyArg_ParseTuple(args, "i", &sample_rate)) {
@@ -301,170 +814,1262 @@ PyObject *set_sample_rate(PyObject *self, PyObject *args) {
         return nullptr;
     }
 
-    if (!g_engine_state.m_clips.empty()) {
+    if (!state.m_clips.empty()) {
         PyErr_SetString(PyExc_Exception, "Cannot set sample rate when clips exist");
         return nullptr;
     }
 
-    g_engine_state.m_sample_rate = sample_rate;
+    state.m_sample_rate = sample_rate;
     Py_RETURN_NONE;
 }
 
-PyObject *load_clip(PyObject *self, PyObject *args) {
+PyObject *resample_clips(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
     ERROR_IF_RECORDING;
     ERROR_IF_PLAYING;
+    ERROR_IF_TIME_STRETCHING;
 
-    char *filename;
-    if (!PyArg_ParseTuple(args, "s", &filename)) {
+    int32_t sample_rate;
+    if (!PyArg_ParseTuple(args, "i", &sample_rate)) {
         return nullptr;
     }
 
-    std::vector<float> samples;
-    uint32_t sample_rate;
-    if (!read_wav(filename, samples, sample_rate)) {
-        PyErr_Format(PyExc_IOError, "Failed to read '%s'", filename);
+    if (sample_rate <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample rate");
         return nullptr;
     }
 
-    if (sample_rate != g_engine_state.m_sample_rate) {
-        PyErr_Format(PyExc_ValueError, "Incorrect sample rate, got %u but expected %d", sample_rate, g_engine_state.m_sample_rate);
+    if (sample_rate == state.m_sample_rate) {
+        Py_RETURN_NONE;
+    }
+
+    if (state.m_sample_rate <= 0) {
+        PyErr_SetString(PyExc_Exception, "Sample rate has not been set");
         return nullptr;
     }
 
-    t_clip_id clip_id = g_engine_state.m_next_clip_id++;
-    s_clip &clip = g_engine_state.m_clips.emplace(std::make_pair(clip_id, s_clip())).first->second;
-    std::swap(samples, clip.m_samples);
+    struct s_resample_task {
+        s_clip *m_clip;
+        const float *m_source_samples;
+        std::vector<float> m_decoded_samples;
+        std::vector<float> m_samples;
+    };
+
+    struct s_resample_block {
+        s_resample_task *m_task;
+        size_t m_first_output_index;
+        size_t m_output_count;
+    };
+
+    static const size_t k_block_size = 16384;
+
+    // Split every clip into blocks up front so that many small clips and a few long ones both keep every core busy
+    c_resampler resampler(static_cast<uint32_t>(state.m_sample_rate), static_cast<uint32_t>(sample_rate));
+    std::vector<s_resample_task> tasks;
+    tasks.reserve(state.m_clips.size());
+    for (auto &clip : state.m_clips) {
+        s_resample_task task = { &clip.second, nullptr, {}, {} };
+        task.m_samples.resize(resampler.get_output_count(clip.second.get_sample_count()));
+        tasks.push_back(std::move(task));
+    }
+
+    std::vector<s_resample_block> blocks;
+    for (s_resample_task &task : tasks) {
+        for (size_t i = 0; i < task.m_samples.size(); i += k_block_size) {
+            s_resample_block block = { &task, i, std::min(k_block_size, task.m_samples.size() - i) };
+            blocks.push_back(block);
+        }
+    }
 
-    return PyLong_FromLong(clip_id);
+    Py_BEGIN_ALLOW_THREADS
+    parallel_for(tasks.size(), 0,
+        [&](size_t task_index) {
+            s_resample_task &task = tasks[task_index];
+            task.m_source_samples = task.m_clip->get_float_samples(task.m_decoded_samples);
+        });
+
+    parallel_for(blocks.size(), 0,
+        [&](size_t block_index) {
+            const s_resample_block &block = blocks[block_index];
+            const s_clip &clip = *block.m_task->m_clip;
+            resampler.resample(
+                block.m_task->m_source_samples,
+                clip.get_sample_count(),
+                &block.m_task->m_samples[block.m_first_output_index],
+                block.m_first_output_index,
+                block.m_output_count);
+        });
+    Py_END_ALLOW_THREADS
+
+    // Cached segments were mixed at the old sample rate
+    state.m_render_cache_segments.clear();
+    state.m_render_cache.clear();
+
+    // Resampled clips are no longer backed by their files but keep their storage format
+    std::vector<e_sample_format> formats;
+    for (s_resample_task &task : tasks) {
+        formats.push_back(task.m_clip->m_format);
+        *task.m_clip = s_clip();
+        task.m_clip->m_samples.swap(task.m_samples);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    parallel_for(tasks.size(), 0,
+        [&](size_t task_index) {
+            s_clip &clip = *tasks[task_index].m_clip;
+            clip.update_block_levels();
+            set_clip_format(clip, formats[task_index]);
+        });
+    Py_END_ALLOW_THREADS
+
+    state.m_sample_rate = sample_rate;
+    Py_RETURN_NONE;
 }
 
-PyObject *save_clip(PyObject *self, PyObject *args) {
-    t_clip_id clip_id;
-    const char *filename;
-    if (!PyArg_ParseTuple(args, "is", &clip_id, &filename)) {
+PyObject *start_time_stretch(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    PyObject *clip_ids_object;
+    double ratio;
+    if (!PyArg_ParseTuple(args, "Od", &clip_ids_object, &ratio)) {
         return nullptr;
     }
 
-    ERROR_IF_INVALID_CLIP_ID(clip_id);
+    ERROR_IF_TIME_STRETCHING;
 
-    const s_clip &clip = g_engine_state.m_clips[clip_id];
-    const float *samples = clip.m_samples.size() > 0 ? &clip.m_samples.front() : nullptr;
-    if (!write_wav(filename, samples, clip.m_samples.size(), static_cast<uint32_t>(g_engine_state.m_sample_rate))) {
-        PyErr_Format(PyExc_IOError, "Failed to write '%s'", filename);
+    if (!(ratio > 0.0)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid ratio");
         return nullptr;
     }
 
-    Py_RETURN_NONE;
-}
-
-PyObject *delete_clip(PyObject *self, PyObject *args) {
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
+    if (state.m_sample_rate <= 0) {
+        PyErr_SetString(PyExc_Exception, "Sample rate has not been set");
+        return nullptr;
+    }
 
-    t_clip_id clip_id;
-    if (!PyArg_ParseTuple(args, "i", &clip_id)) {
+    PyObject *clip_ids_sequence = PySequence_Fast(clip_ids_object, "Clip IDs must be a sequence");
+    if (!clip_ids_sequence) {
         return nullptr;
     }
 
-    ERROR_IF_INVALID_CLIP_ID(clip_id);
+    std::vector<s_time_stretch_task> tasks(PySequence_Fast_GET_SIZE(clip_ids_sequence));
+    for (size_t i = 0; i < tasks.size(); ++i) {
+        t_clip_id clip_id = static_cast<t_clip_id>(PyLong_AsLong(PySequence_Fast_GET_ITEM(clip_ids_sequence, i)));
+        if (clip_id == -1 && PyErr_Occurred()) {
+            Py_DECREF(clip_ids_sequence);
+            return nullptr;
+        }
+
+        auto it = state.m_clips.find(clip_id);
+        if (it == state.m_clips.end()) {
+            Py_DECREF(clip_ids_sequence);
+            PyErr_SetString(PyExc_ValueError, "Invalid clip ID");
+            return nullptr;
+        }
+
+        // Clips don't move in the map when other clips are added, so workers can hold onto them
+        tasks[i].m_source_clip = &it->second;
+    }
+
+    Py_DECREF(clip_ids_sequence);
+
+    state.m_time_stretch_tasks.swap(tasks);
+    state.m_time_stretch_completed_count = 0;
+    state.m_time_stretch_terminate = false;
+    state.m_time_stretch_reported_count = SIZE_MAX;
+
+    // Each clip is stretched by one worker, and clips are handed out one at a time so long and short ones balance out
+    c_time_stretcher stretcher(static_cast<uint32_t>(state.m_sample_rate), ratio);
+    state.m_time_stretch_thread = new std::thread(
+        [&state, stretcher]() {
+            std::vector<s_time_stretch_task> &tasks = state.m_time_stretch_tasks;
+            parallel_for(tasks.size(), 0,
+                [&](size_t task_index) {
+                    if (state.m_time_stretch_terminate) {
+                        return;
+                    }
+
+                    s_time_stretch_task &task = tasks[task_index];
+                    std::vector<float> decoded_samples;
+                    const float *source_samples = task.m_source_clip->get_float_samples(decoded_samples);
+                    size_t source_sample_count = task.m_source_clip->get_sample_count();
+                    task.m_clip.m_samples.resize(stretcher.get_output_count(source_sample_count));
+                    stretcher.stretch(source_samples, source_sample_count, task.m_clip.m_samples.data());
+
+                    // Stretched clips keep the storage format of their source
+                    task.m_clip.update_block_levels();
+                    set_clip_format(task.m_clip, task.m_source_clip->m_format);
+                    state.m_time_stretch_completed_count++;
+                });
+        });
 
-    g_engine_state.m_clips.erase(clip_id);
     Py_RETURN_NONE;
 }
 
-void c_recording_allocator::start(size_t recording_buffer_length, size_t recording_buffer_padding) {
-    m_recording_buffer_length = recording_buffer_length;
-    m_recording_buffer_padding = recording_buffer_padding;
-    m_terminate = false;
-
-    m_first_buffer = new s_recording_buffer();
-    m_first_buffer->m_samples.resize(m_recording_buffer_length);
-    m_last_buffer = m_first_buffer;
+PyObject *finish_time_stretch(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    if (!state.m_time_stretch_thread) {
+        PyErr_SetString(PyExc_Exception, "No time stretch is running");
+        return nullptr;
+    }
 
-    m_thread = new std::thread([this]() { thread_main(); });
-}
+    Py_BEGIN_ALLOW_THREADS
+    state.m_time_stretch_thread->join();
+    Py_END_ALLOW_THREADS
 
-void c_recording_allocator::stop() {
-    m_terminate = true;
-    m_thread->join();
-    delete m_thread;
-    m_thread = nullptr;
-}
+    delete state.m_time_stretch_thread;
+    state.m_time_stretch_thread = nullptr;
 
-void c_recording_allocator::save_recorded_samples(std::vector<float> &buffer) {
-    size_t sample_count = 0;
-    s_recording_buffer *recording_buffer = m_first_buffer;
-    while (recording_buffer) {
-        sample_count += recording_buffer->m_usage;
-        recording_buffer = recording_buffer->m_next;
+    PyObject *list = PyList_New(state.m_time_stretch_tasks.size());
+    if (!list) {
+        state.m_time_stretch_tasks.clear();
+        return nullptr;
     }
 
-    buffer.clear();
-    buffer.reserve(sample_count);
-    recording_buffer = m_first_buffer;
-    while (recording_buffer) {
-        size_t usage = recording_buffer->m_usage;
-        for (size_t i = 0; i < usage; ++i) {
-            buffer.push_back(recording_buffer->m_samples[i]);
+    // Build the list before adding the clips so that a failure doesn't leave clips which nothing refers to
+    for (size_t i = 0; i < state.m_time_stretch_tasks.size(); ++i) {
+        PyObject *clip_id = PyLong_FromLong(state.m_next_clip_id + static_cast<t_clip_id>(i));
+        if (!clip_id) {
+            Py_DECREF(list);
+            state.m_time_stretch_tasks.clear();
+            return nullptr;
         }
-        sample_count += recording_buffer->m_usage;
-        recording_buffer = recording_buffer->m_next;
+
+        PyList_SET_ITEM(list, i, clip_id);
     }
-}
 
-void c_recording_allocator::clear() {
-    s_recording_buffer *recording_buffer = m_first_buffer;
-    while (recording_buffer) {
-        s_recording_buffer *next = recording_buffer->m_next;
-        delete recording_buffer;
-        recording_buffer = next;
+    for (s_time_stretch_task &task : state.m_time_stretch_tasks) {
+        t_clip_id clip_id = state.m_next_clip_id++;
+        state.m_clips.emplace(std::make_pair(clip_id, std::move(task.m_clip)));
     }
 
-    m_first_buffer = nullptr;
-    m_last_buffer = nullptr;
+    state.m_time_stretch_tasks.clear();
+    return list;
 }
 
-void c_recording_allocator::thread_main() {
-    while (!m_terminate) {
-        if (m_last_buffer->m_usage >= m_recording_buffer_length - m_recording_buffer_padding) {
-            // Buffer is nearly used up, so allocate another one
-            s_recording_buffer *new_buffer = new s_recording_buffer();
-            new_buffer->m_samples.resize(m_recording_buffer_length);
-            new_buffer->m_prev = m_last_buffer;
-
-            // Atomically set the next pointer
-            m_last_buffer->m_next = new_buffer;
-            m_last_buffer = new_buffer;
-        }
-
-        std::this_thread::sleep_for(std::chrono::milliseconds(50));
-    }
+PyObject *cancel_time_stretch(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    Py_BEGIN_ALLOW_THREADS
+    stop_time_stretch(state);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
 }
 
-PyObject *start_recording_clip(PyObject *self, PyObject *args) {
-    int32_t input_device_index;
-    int32_t output_device_index;
-    int32_t frames_per_buffer;
-    if (!PyArg_ParseTuple(args, "iii", &input_device_index, &output_device_index, &frames_per_buffer)) {
-        return nullptr;
-    }
-
+PyObject *load_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
     ERROR_IF_RECORDING;
     ERROR_IF_PLAYING;
 
-    if (g_engine_state.m_sample_rate <= 0) {
-        PyErr_SetString(PyExc_ValueError, "Invalid sample rate");
+    char *filename;
+    int memory_map = 0;
+    if (!PyArg_ParseTuple(args, "s|p", &filename, &memory_map)) {
         return nullptr;
     }
 
-    if (input_device_index < 0 || static_cast<uint32_t>(input_device_index) >= g_engine_state.m_input_devices.size()) {
-        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
-        return nullptr;
+    s_clip loaded_clip;
+    uint32_t sample_rate;
+    bool mapped = false;
+    bool lossless = is_lossless_file(filename);
+    if (memory_map && !lossless) {
+        // Fall back to reading the file if its samples can't be used in place
+        std::shared_ptr<c_mapped_file> mapped_file = std::make_shared<c_mapped_file>();
+        if (mapped_file->open(filename)
+            && find_wav_samples(
+                mapped_file->get_data(),
+                mapped_file->get_size(),
+                loaded_clip.m_mapped_samples,
+                loaded_clip.m_mapped_sample_count,
+                sample_rate)) {
+            loaded_clip.m_mapped_file = mapped_file;
+            mapped = true;
+        }
     }
 
-    if (output_device_index < 0 || static_cast<uint32_t>(output_device_index) >= g_engine_state.m_output_devices.size()) {
-        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
-        return nullptr;
+    if (!mapped) {
+        bool result;
+        Py_BEGIN_ALLOW_THREADS
+        result = lossless
+            ? read_lossless(filename, loaded_clip.m_samples, sample_rate, 0)
+            : read_wav(filename, loaded_clip.m_samples, sample_rate);
+        Py_END_ALLOW_THREADS
+
+        if (!result) {
+            PyErr_Format(PyExc_IOError, "Failed to read '%s'", filename);
+            return nullptr;
+        }
+    }
+
+    if (sample_rate != static_cast<uint32_t>(state.m_sample_rate)) {
+        if (state.m_sample_rate <= 0) {
+            PyErr_SetString(PyExc_Exception, "Sample rate has not been set");
+            return nullptr;
+        }
+
+        // Convert to the engine's sample rate. Mapped samples are resampled into memory and the mapping is dropped.
+        std::vector<float> resampled_samples;
+        Py_BEGIN_ALLOW_THREADS
+        std::vector<float> decoded_samples;
+        c_resampler resampler(sample_rate, static_cast<uint32_t>(state.m_sample_rate));
+        resample(resampler, loaded_clip.get_float_samples(decoded_samples), loaded_clip.get_sample_count(), resampled_samples, 0);
+        Py_END_ALLOW_THREADS
+
+        loaded_clip = s_clip();
+        loaded_clip.m_samples.swap(resampled_samples);
+    }
+
+    // Mapped clips are left for update_playback_clip_levels so that loading them doesn't read every sample
+    if (!loaded_clip.m_mapped_file) {
+        Py_BEGIN_ALLOW_THREADS
+        loaded_clip.update_block_levels();
+        Py_END_ALLOW_THREADS
+    }
+
+    t_clip_id clip_id = state.m_next_clip_id++;
+    state.m_clips.emplace(std::make_pair(clip_id, std::move(loaded_clip)));
+
+    return PyLong_FromLong(clip_id);
+}
+
+PyObject *save_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    const char *filename;
+    int compress = 0;
+    uint32_t thread_count = 0;
+    if (!PyArg_ParseTuple(args, "is|pI", &clip_id, &filename, &compress, &thread_count)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    const s_clip &clip = state.m_clips[clip_id];
+    if (clip.m_mapped_file && clip.m_mapped_file->is_same_file(filename)) {
+        // Mapped clips are never modified, so the file already holds these samples. Rewriting it would also pull the
+        // pages out from under the mapping.
+        Py_RETURN_NONE;
+    }
+
+    bool result;
+    Py_BEGIN_ALLOW_THREADS
+    std::vector<float> decoded_samples;
+    const float *samples = clip.get_sample_count() > 0 ? clip.get_float_samples(decoded_samples) : nullptr;
+    uint32_t sample_rate = static_cast<uint32_t>(state.m_sample_rate);
+    result = compress
+        ? write_lossless(filename, samples, clip.get_sample_count(), sample_rate, thread_count)
+        : write_wav(filename, samples, clip.get_sample_count(), sample_rate);
+    Py_END_ALLOW_THREADS
+
+    if (!result) {
+        PyErr_Format(PyExc_IOError, "Failed to write '%s'", filename);
+        return nullptr;
+    }
+
+    Py_RETURN_NONE;
+}
+
+PyObject *get_archive_metadata(PyObject *self, PyObject *args) {
+    const char *filename;
+    if (!PyArg_ParseTuple(args, "s", &filename)) {
+        return nullptr;
+    }
+
+    s_archive_index index;
+    if (!read_archive_index(filename, index)) {
+        PyErr_Format(PyExc_IOError, "Failed to read '%s'", filename);
+        return nullptr;
+    }
+
+    return PyUnicode_FromStringAndSize(index.m_metadata.data(), index.m_metadata.size());
+}
+
+PyObject *load_archive(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    const char *filename;
+    if (!PyArg_ParseTuple(args, "s", &filename)) {
+        return nullptr;
+    }
+
+    // Every clip is a view into this one mapping
+    std::shared_ptr<c_mapped_file> mapped_file = std::make_shared<c_mapped_file>();
+    s_archive_index index;
+    if (!mapped_file->open(filename)
+        || !parse_archive_index(mapped_file->get_data(), mapped_file->get_size(), index)) {
+        PyErr_Format(PyExc_IOError, "Failed to read '%s'", filename);
+        return nullptr;
+    }
+
+    // An archive without clips may have been saved before any sample rate was set
+    if (!index.m_clips.empty() && index.m_sample_rate != static_cast<uint32_t>(state.m_sample_rate)) {
+        PyErr_Format(PyExc_ValueError, "Incorrect sample rate, got %u but expected %d", index.m_sample_rate, state.m_sample_rate);
+        return nullptr;
+    }
+
+    // Build the result before adding any clips so that a failure doesn't leave clips behind
+    PyObject *clip_ids = PyDict_New();
+    if (!clip_ids) {
+        return nullptr;
+    }
+
+    for (size_t i = 0; i < index.m_clips.size(); ++i) {
+        PyObject *key = PyLong_FromLongLong(index.m_clips[i].m_key);
+        PyObject *clip_id = PyLong_FromLong(static_cast<long>(state.m_next_clip_id + i));
+        bool result = key && clip_id && PyDict_SetItem(clip_ids, key, clip_id) == 0;
+        Py_XDECREF(key);
+        Py_XDECREF(clip_id);
+        if (!result) {
+            Py_DECREF(clip_ids);
+            return nullptr;
+        }
+    }
+
+    std::vector<s_clip> loaded_clips(index.m_clips.size());
+    for (size_t i = 0; i < index.m_clips.size(); ++i) {
+        const s_archive_clip &archive_clip = index.m_clips[i];
+        s_clip &loaded_clip = loaded_clips[i];
+        loaded_clip.m_mapped_file = mapped_file;
+        loaded_clip.m_mapped_samples = reinterpret_cast<const float *>(mapped_file->get_data() + archive_clip.m_offset);
+        loaded_clip.m_mapped_sample_count = static_cast<size_t>(archive_clip.m_sample_count);
+    }
+
+    // Block levels are left for update_playback_clip_levels so that loading the archive doesn't read every sample
+    for (s_clip &loaded_clip : loaded_clips) {
+        t_clip_id clip_id = state.m_next_clip_id++;
+        state.m_clips.emplace(std::make_pair(clip_id, std::move(loaded_clip)));
+    }
+
+    return clip_ids;
+}
+
+PyObject *save_archive(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+    ERROR_IF_TIME_STRETCHING;
+
+    const char *filename;
+    const char *metadata;
+    PyObject *clips_object;
+    if (!PyArg_ParseTuple(args, "ssO", &filename, &metadata, &clips_object)) {
+        return nullptr;
+    }
+
+    // Saved clips are replaced by views into the archive, so the render cache can't keep reading from them
+    state.m_render_cache.stop();
+
+    PyObject *clips_sequence = PySequence_Fast(clips_object, "Expected a sequence of (key, clip_id) pairs");
+    if (!clips_sequence) {
+        return nullptr;
+    }
+
+    std::vector<t_clip_id> clip_ids;
+    std::vector<s_archive_clip_write> clips;
+    std::deque<std::vector<float>> decoded_clip_samples;   // Archives always store full precision samples
+    Py_ssize_t clip_count = PySequence_Fast_GET_SIZE(clips_sequence);
+    for (Py_ssize_t i = 0; i < clip_count; ++i) {
+        long long key;
+        t_clip_id clip_id;
+        if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(clips_sequence, i), "Li", &key, &clip_id)) {
+            Py_DECREF(clips_sequence);
+            return nullptr;
+        }
+
+        if (state.m_clips.find(clip_id) == state.m_clips.end()) {
+            Py_DECREF(clips_sequence);
+            PyErr_SetString(PyExc_ValueError, "Invalid clip ID");
+            return nullptr;
+        }
+
+        const s_clip &clip = state.m_clips[clip_id];
+        decoded_clip_samples.emplace_back();
+        const float *samples = clip.get_float_samples(decoded_clip_samples.back());
+        s_archive_clip_write archive_clip = { key, samples, 0, clip.get_sample_count() };
+        clip_ids.push_back(clip_id);
+        clips.push_back(archive_clip);
+    }
+
+    Py_DECREF(clips_sequence);
+
+    // Clips which are views into this same archive are already stored in it, so appending only has to write the rest.
+    // If write_archive compacts the archive instead, it copies them into the new file and updates their offsets.
+    s_archive_index existing_index;
+    bool append = read_archive_index(filename, existing_index);
+    for (size_t i = 0; i < clips.size(); ++i) {
+        const s_clip &clip = state.m_clips[clip_ids[i]];
+        if (clip.m_mapped_file && clip.m_mapped_file->is_same_file(filename)) {
+            if (!append) {
+                PyErr_Format(PyExc_IOError, "Cannot overwrite '%s' because clips are mapped from it", filename);
+                return nullptr;
+            }
+
+            clips[i].m_samples = nullptr;
+            clips[i].m_offset = reinterpret_cast<const uint8_t *>(clip.m_mapped_samples) - clip.m_mapped_file->get_data();
+        }
+    }
+
+    bool result;
+    Py_BEGIN_ALLOW_THREADS
+    uint32_t sample_rate = static_cast<uint32_t>(state.m_sample_rate);
+    result = write_archive(filename, append, sample_rate, metadata, clips);
+    Py_END_ALLOW_THREADS
+
+    if (!result) {
+        PyErr_Format(PyExc_IOError, "Failed to write '%s'", filename);
+        return nullptr;
+    }
+
+    // Switch the saved clips over to views of the archive. This frees the memory held by newly written clips and lets
+    // the next save skip them. Reduced precision clips drop their packed samples too, since the archive holds exactly
+    // the samples they decode to. If the archive can't be mapped the clips simply keep their current samples.
+    std::shared_ptr<c_mapped_file> mapped_file = std::make_shared<c_mapped_file>();
+    if (mapped_file->open(filename)) {
+        for (size_t i = 0; i < clips.size(); ++i) {
+            const s_archive_clip_write &archive_clip = clips[i];
+            if (archive_clip.m_offset + archive_clip.m_sample_count * sizeof(float) > mapped_file->get_size()) {
+                continue;
+            }
+
+            s_clip &clip = state.m_clips[clip_ids[i]];
+            std::vector<float>().swap(clip.m_samples);
+            std::vector<uint16_t>().swap(clip.m_packed_samples);
+            clip.m_packed_scale = 1.0f;
+            clip.m_format = e_sample_format::k_float32;
+            clip.m_mapped_file = mapped_file;
+            clip.m_mapped_samples = reinterpret_cast<const float *>(mapped_file->get_data() + archive_clip.m_offset);
+            clip.m_mapped_sample_count = static_cast<size_t>(archive_clip.m_sample_count);
+        }
+    }
+
+    Py_RETURN_NONE;
+}
+
+PyObject *delete_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+    ERROR_IF_TIME_STRETCHING;
+
+    t_clip_id clip_id;
+    if (!PyArg_ParseTuple(args, "i", &clip_id)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    state.m_render_cache.stop();
+    state.m_clips.erase(clip_id);
+    Py_RETURN_NONE;
+}
+
+PyObject *set_clip_storage_format(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+    ERROR_IF_TIME_STRETCHING;
+
+    t_clip_id clip_id;
+    const char *format_name;
+    if (!PyArg_ParseTuple(args, "is", &clip_id, &format_name)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    size_t format_index = 0;
+    while (format_index < static_cast<size_t>(e_sample_format::k_count)
+        && strcmp(format_name, k_sample_format_names[format_index]) != 0) {
+        format_index++;
+    }
+
+    if (format_index == static_cast<size_t>(e_sample_format::k_count)) {
+        PyErr_Format(PyExc_ValueError, "Invalid sample format '%s'", format_name);
+        return nullptr;
+    }
+
+    s_clip &clip = state.m_clips[clip_id];
+    e_sample_format format = static_cast<e_sample_format>(format_index);
+    if (format == clip.m_format) {
+        Py_RETURN_NONE;
+    }
+
+    // Cached segments mixed from this clip's old samples would no longer match live playback
+    state.m_render_cache_segments.clear();
+    state.m_render_cache.clear();
+
+    Py_BEGIN_ALLOW_THREADS
+    set_clip_format(clip, format);
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+PyObject *get_clip_storage_format(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    if (!PyArg_ParseTuple(args, "i", &clip_id)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    const s_clip &clip = state.m_clips[clip_id];
+    return PyUnicode_FromString(k_sample_format_names[static_cast<size_t>(clip.m_format)]);
+}
+
+void c_recording_allocator::start(size_t recording_buffer_length, size_t recording_buffer_padding) {
+    m_recording_buffer_length = recording_buffer_length;
+    m_recording_buffer_padding = recording_buffer_padding;
+    m_terminate = false;
+
+    m_first_buffer = new s_recording_buffer();
+    m_first_buffer->m_samples.resize(m_recording_buffer_length);
+    m_last_buffer = m_first_buffer;
+
+    m_thread = new std::thread([this]() { thread_main(); });
+}
+
+void c_recording_allocator::stop() {
+    m_terminate = true;
+    m_thread->join();
+    delete m_thread;
+    m_thread = nullptr;
+}
+
+void c_recording_allocator::save_recorded_samples(std::vector<float> &buffer) {
+    size_t sample_count = 0;
+    s_recording_buffer *recording_buffer = m_first_buffer;
+    while (recording_buffer) {
+        sample_count += recording_buffer->m_usage;
+        recording_buffer = recording_buffer->m_next;
+    }
+
+    buffer.clear();
+    buffer.reserve(sample_count);
+    recording_buffer = m_first_buffer;
+    while (recording_buffer) {
+        size_t usage = recording_buffer->m_usage;
+        for (size_t i = 0; i < usage; ++i) {
+            buffer.push_back(recording_buffer->m_samples[i]);
+        }
+        sample_count += recording_buffer->m_usage;
+        recording_buffer = recording_buffer->m_next;
+    }
+}
+
+void c_recording_allocator::clear() {
+    s_recording_buffer *recording_buffer = m_first_buffer;
+    while (recording_buffer) {
+        s_recording_buffer *next = recording_buffer->m_next;
+        delete recording_buffer;
+        recording_buffer = next;
+    }
+
+    m_first_buffer = nullptr;
+    m_last_buffer = nullptr;
+}
+
+void c_recording_allocator::thread_main() {
+    while (!m_terminate) {
+        if (m_last_buffer->m_usage >= m_recording_buffer_length - m_recording_buffer_padding) {
+            // Buffer is nearly used up, so allocate another one
+            s_recording_buffer *new_buffer = new s_recording_buffer();
+            new_buffer->m_samples.resize(m_recording_buffer_length);
+            new_buffer->m_prev = m_last_buffer;
+
+            // Atomically set the next pointer
+            m_last_buffer->m_next = new_buffer;
+            m_last_buffer = new_buffer;
+        }
+
+        std::this_thread::sleep_for(std::chrono::milliseconds(50));
+    }
+}
+
+PyObject *start_recording_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t input_device_index;
+    int32_t output_device_index;
+    int32_t frames_per_buffer;
+    if (!PyArg_ParseTuple(args, "iii", &input_device_index, &output_device_index, &frames_per_buffer)) {
+        return nullptr;
+    }
+
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    if (state.m_sample_rate <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample rate");
+        return nullptr;
+    }
+
+    if (input_device_index < 0 || static_cast<uint32_t>(input_device_index) >= g_device_state.m_input_devices.size()) {
+        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
+        return nullptr;
+    }
+
+    if (output_device_index < 0 || static_cast<uint32_t>(output_device_index) >= g_device_state.m_output_devices.size()) {
+        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
+        return nullptr;
+    }
+
+    if (frames_per_buffer <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid frames per buffer");
+        return nullptr;
+    }
+
+    const s_device &input_device = g_device_state.m_input_devices[input_device_index];
+    const s_device &output_device = g_device_state.m_output_devices[output_device_index];
+
+    // Start up the allocator first to make sure we never underrun
+    size_t recording_buffer_length = static_cast<size_t>(state.m_sample_rate * k_recording_buffer_length_seconds);
+    size_t recording_buffer_padding = static_cast<size_t>(state.m_sample_rate * k_recording_buffer_padding_seconds);
+    state.m_recording_allocator.start(recording_buffer_length, recording_buffer_padding);
+    state.m_current_recording_buffer = state.m_recording_allocator.get_first_buffer();
+
+    // This is used by the metronome
+    state.m_playback_sample_index = 0;
+    reset_playback_timestamp(state, 0);
+    reset_metronome(state);
+
+    PaTime total_latency = input_device.m_suggested_latency + output_device.m_suggested_latency;
+    state.m_recording_playback_latency = static_cast<int32_t>(total_latency * state.m_sample_rate);
+    state.m_samples_until_recording_begins = state.m_recording_playback_latency;
+
+    // When the virtual device runs flat out, it must not get ahead of the allocator
+    auto recording_buffer_ready = [&state, frames_per_buffer]() {
+        const s_recording_buffer *recording_buffer = state.m_current_recording_buffer;
+        return recording_buffer->m_next != nullptr
+            || recording_buffer->m_samples.size() - recording_buffer->m_usage >= static_cast<size_t>(frames_per_buffer);
+    };
+
+    if (!start_stream(
+        state,
+        &input_device,
+        output_device,
+        frames_per_buffer,
+        recording_stream_main,
+        recording_buffer_ready)) {
+        state.m_recording_allocator.stop();
+        state.m_recording_allocator.clear();
+        return nullptr;
+    }
+
+    state.m_recording = true;
+
+    t_clip_id clip_id = state.m_next_clip_id++;
+    state.m_clips.emplace(std::make_pair(clip_id, s_clip()));
+    state.m_recording_clip_id = clip_id;
+
+    return PyLong_FromLong(clip_id);
+}
+
+PyObject *stop_recording_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int immediate = 0;
+    int wait = 1;
+    if (!PyArg_ParseTuple(args, "|pp", &immediate, &wait)) {
+        return nullptr;
+    }
+
+    if (!update_stream_stop(state, false)) {
+        return nullptr;
+    }
+
+    if (!state.m_recording || state.m_stream_stop_thread) {
+        PyErr_SetString(PyExc_Exception, "Not recording");
+        return nullptr;
+    }
+
+    if (!wait) {
+        begin_stream_stop(state, immediate != 0);
+        Py_RETURN_NONE;
+    }
+
+    const char *error = stop_stream(state, immediate != 0);
+    if (error) {
+        PyErr_SetString(PyExc_Exception, error);
+        return nullptr;
+    }
+
+    finish_recording(state);
+    Py_RETURN_NONE;
+}
+
+static void finish_recording(s_engine_state &state) {
+    state.m_recording_allocator.stop();
+
+    s_clip &clip = state.m_clips[state.m_recording_clip_id];
+    state.m_recording_allocator.save_recorded_samples(clip.m_samples);
+    state.m_recording_allocator.clear();
+    clip.update_block_levels();
+    state.m_current_recording_buffer = nullptr;
+
+    state.m_recording = false;
+    state.m_recording_clip_id = -1;
+}
+
+PyObject *get_recorded_sample_count(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    if (!state.m_recording) {
+        PyErr_SetString(PyExc_Exception, "Not recording");
+        return nullptr;
+    }
+
+    // Take the playback sample index and subtract our recording latency
+    int32_t recorded_sample_count = std::max(
+        state.m_playback_sample_index - state.m_recording_playback_latency,
+        0);
+    return PyLong_FromLong(recorded_sample_count);
+}
+
+PyObject *get_latest_recorded_samples(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t sample_count;
+    if (!PyArg_ParseTuple(args, "i", &sample_count)) {
+        return nullptr;
+    }
+
+    if (!state.m_recording) {
+        PyErr_SetString(PyExc_Exception, "Not recording");
+        return nullptr;
+    }
+
+    if (sample_count < 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample count");
+        return nullptr;
+    }
+
+    std::vector<double> latest_samples(sample_count, 0.0);
+    int32_t samples_remaining = sample_count;
+    const s_recording_buffer *recording_buffer = state.m_current_recording_buffer;
+    while (samples_remaining > 0 && recording_buffer) {
+        size_t recording_buffer_samples_remaining = recording_buffer->m_usage;
+        size_t amount_to_copy = std::min(static_cast<size_t>(samples_remaining), recording_buffer_samples_remaining);
+        for (size_t i = 0; i < amount_to_copy; ++i) {
+            // Note pre-increment because we are iterating down to 0
+            latest_samples[--samples_remaining] = recording_buffer->m_samples[--recording_buffer_samples_remaining];
+        }
+
+        recording_buffer = recording_buffer->m_prev;
+    }
+
+    PyObject *list = PyList_New(sample_count);
+    if (!list) {
+        return nullptr;
+    }
+
+    for (int32_t i = 0; i < sample_count; ++i) {
+        PyObject *value = PyFloat_FromDouble(latest_samples[i]);
+        if (!value) {
+            Py_DECREF(list);
+            return nullptr;
+        }
+        PyList_SET_ITEM(list, i, value);
+    }
+
+    return list;
+}
+
+PyObject *get_recorded_peak_blocks(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t first_block_index;
+    int32_t samples_per_block;
+    if (!PyArg_ParseTuple(args, "ii", &first_block_index, &samples_per_block)) {
+        return nullptr;
+    }
+
+    if (!state.m_recording) {
+        PyErr_SetString(PyExc_Exception, "Not recording");
+        return nullptr;
+    }
+
+    if (first_block_index < 0 || samples_per_block <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid block");
+        return nullptr;
+    }
+
+    // Only the samples the audio thread has finished copying are visible through each buffer's usage. A block can span
+    // buffers, so its range is built up across them and only complete blocks are returned.
+    std::vector<std::pair<float, float>> blocks;
+    size_t block_size = static_cast<size_t>(samples_per_block);
+    size_t next_sample_index = static_cast<size_t>(first_block_index) * block_size;
+    size_t block_sample_count = 0;
+    float block_min = 0.0f;
+    float block_max = 0.0f;
+    size_t buffer_start_sample_index = 0;
+    const s_recording_buffer *recording_buffer = state.m_recording_allocator.get_first_buffer();
+    while (recording_buffer) {
+        size_t usage = recording_buffer->m_usage.load(std::memory_order_acquire);
+        size_t buffer_end_sample_index = buffer_start_sample_index + usage;
+        while (next_sample_index < buffer_end_sample_index) {
+            size_t count = std::min(block_size - block_sample_count, buffer_end_sample_index - next_sample_index);
+            float min_sample;
+            float max_sample;
+            find_sample_range(
+                recording_buffer->m_samples.data() + (next_sample_index - buffer_start_sample_index),
+                count,
+                min_sample,
+                max_sample);
+            block_min = block_sample_count == 0 ? min_sample : std::min(block_min, min_sample);
+            block_max = block_sample_count == 0 ? max_sample : std::max(block_max, max_sample);
+            block_sample_count += count;
+            next_sample_index += count;
+            if (block_sample_count == block_size) {
+                blocks.emplace_back(block_min, block_max);
+                block_sample_count = 0;
+            }
+        }
+
+        if (usage < recording_buffer->m_samples.size()) {
+            break;
+        }
+
+        buffer_start_sample_index = buffer_end_sample_index;
+        recording_buffer = recording_buffer->m_next;
+    }
+
+    PyObject *list = PyList_New(blocks.size());
+    if (!list) {
+        return nullptr;
+    }
+
+    for (size_t i = 0; i < blocks.size(); ++i) {
+        PyObject *value = Py_BuildValue("(dd)", blocks[i].first, blocks[i].second);
+        if (!value) {
+            Py_DECREF(list);
+            return nullptr;
+        }
+        PyList_SET_ITEM(list, i, value);
+    }
+
+    return list;
+}
+
+PyObject *get_clip_sample_count(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    if (!PyArg_ParseTuple(args, "i", &clip_id)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    const s_clip &clip = state.m_clips[clip_id];
+    return PyLong_FromSize_t(clip.get_sample_count());
+}
+
+PyObject *get_clip_samples(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    int32_t max_sample_count;
+    if (!PyArg_ParseTuple(args, "ii", &clip_id, &max_sample_count)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    const s_clip &clip = state.m_clips[clip_id];
+
+    s_mix_source clip_source = clip.get_mix_source();
+    size_t clip_sample_count = clip.get_sample_count();
+
+    if (max_sample_count <= 0) {
+        max_sample_count = static_cast<int32_t>(clip_sample_count);
+    }
+
+    int32_t sample_count = std::min(static_cast<int32_t>(clip_sample_count), max_sample_count);
+    PyObject *list = PyList_New(sample_count);
+    if (!list) {
+        return nullptr;
+    }
+
+    for (int32_t i = 0; i < sample_count; ++i) {
+        // Spread out samples evenly if the count exceeds max_sample_count
+        int64_t source_index = static_cast<int64_t>(i) * static_cast<int64_t>(clip_sample_count) / max_sample_count;
+        float sample;
+        decode_samples(clip_source, static_cast<size_t>(source_index), 1, &sample);
+        PyObject *value = PyFloat_FromDouble(sample);
+        if (!value) {
+            Py_DECREF(list);
+            return nullptr;
+        }
+        PyList_SET_ITEM(list, i, value);
+    }
+
+    return list;
+}
+
+PyObject *analyze_clip_boundaries(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    double samples_per_measure;
+    if (!PyArg_ParseTuple(args, "id", &clip_id, &samples_per_measure)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    if (state.m_sample_rate <= 0) {
+        PyErr_SetString(PyExc_Exception, "Sample rate has not been set");
+        return nullptr;
+    }
+
+    const s_clip &clip = state.m_clips[clip_id];
+    s_clip_boundaries boundaries;
+    Py_BEGIN_ALLOW_THREADS
+    std::vector<float> decoded_samples;
+    boundaries = find_clip_boundaries(
+        clip.get_float_samples(decoded_samples),
+        clip.get_sample_count(),
+        samples_per_measure,
+        static_cast<uint32_t>(state.m_sample_rate));
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue(
+        "(nnOO)",
+        static_cast<Py_ssize_t>(boundaries.m_start_sample_index),
+        static_cast<Py_ssize_t>(boundaries.m_end_sample_index),
+        boundaries.m_has_intro ? Py_True : Py_False,
+        boundaries.m_has_outro ? Py_True : Py_False);
+}
+
+PyObject *playback_builder_begin(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    state.m_render_cache.stop();
+    state.m_first_active_playback_clip = nullptr;
+    state.m_active_playback_clip_count = 0;
+    state.m_playback_clips.clear();
+    state.m_buses.clear();
+    state.m_render_cache_samples_per_segment = 0.0;
+    state.m_playback_end_sample_index = -1;
+    Py_RETURN_NONE;
+}
+
+PyObject *playback_builder_enable_render_cache(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    double samples_per_segment;
+    if (!PyArg_ParseTuple(args, "d", &samples_per_segment)) {
+        return nullptr;
+    }
+
+    if (samples_per_segment < 1.0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid segment length");
+        return nullptr;
+    }
+
+    state.m_render_cache_samples_per_segment = samples_per_segment;
+    Py_RETURN_NONE;
+}
+
+PyObject *playback_builder_set_end_sample_index(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    int32_t end_sample_index;
+    if (!PyArg_ParseTuple(args, "i", &end_sample_index)) {
+        return nullptr;
+    }
+
+    if (end_sample_index < 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid end sample index");
+        return nullptr;
+    }
+
+    state.m_playback_end_sample_index = end_sample_index;
+    Py_RETURN_NONE;
+}
+
+PyObject *playback_builder_add_bus(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    double gain = 1.0;
+    int muted = 0;
+    int soloed = 0;
+    if (!PyArg_ParseTuple(args, "|dpp", &gain, &muted, &soloed)) {
+        return nullptr;
+    }
+
+    s_bus &bus = state.m_buses.emplace_back();
+    bus.m_gain = static_cast<float>(gain);
+    bus.m_muted = muted != 0;
+    bus.m_soloed = soloed != 0;
+
+    return PyLong_FromSize_t(state.m_buses.size() - 1);
+}
+
+PyObject *playback_builder_add_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    t_clip_id clip_id;
+    int32_t start_sample_index;
+    int32_t end_sample_index;
+    int32_t playback_start_sample_index;
+    double gain;
+    PyObject *bus_indices = nullptr;
+    if (!PyArg_ParseTuple(
+        args,
+        "iiiid|O",
+        &clip_id,
+        &start_sample_index,
+        &end_sample_index,
+        &playback_start_sample_index,
+        &gain,
+        &bus_indices)) {
+        return nullptr;
+    }
+
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
+
+    const s_clip &clip = state.m_clips[clip_id];
+    if (start_sample_index < 0
+        || static_cast<uint32_t>(start_sample_index) > clip.get_sample_count()
+        || end_sample_index < 0
+        || static_cast<uint32_t>(end_sample_index) > clip.get_sample_count()
+        || start_sample_index > end_sample_index) {
+        PyErr_SetString(PyExc_ValueError, "Invalid start/end sample indices");
+        return nullptr;
+    }
+
+    s_playback_clip playback_clip;
+    playback_clip.m_clip_id = clip_id;
+    playback_clip.m_start_sample_index = start_sample_index;
+    playback_clip.m_end_sample_index = end_sample_index;
+    playback_clip.m_playback_start_sample_index = playback_start_sample_index;
+    playback_clip.m_gain = static_cast<float>(gain);
+
+    if (bus_indices) {
+        PyObject *bus_indices_sequence = PySequence_Fast(bus_indices, "Bus indices must be a sequence");
+        if (!bus_indices_sequence) {
+            return nullptr;
+        }
+
+        Py_ssize_t bus_index_count = PySequence_Fast_GET_SIZE(bus_indices_sequence);
+        for (Py_ssize_t i = 0; i < bus_index_count; ++i) {
+            long bus_index = PyLong_AsLong(PySequence_Fast_GET_ITEM(bus_indices_sequence, i));
+            if (bus_index < 0 || static_cast<size_t>(bus_index) >= state.m_buses.size()) {
+                Py_DECREF(bus_indices_sequence);
+                if (!PyErr_Occurred()) {
+                    PyErr_SetString(PyExc_ValueError, "Invalid bus index");
+                }
+
+                return nullptr;
+            }
+
+            playback_clip.m_bus_indices.push_back(static_cast<int32_t>(bus_index));
+        }
+
+        Py_DECREF(bus_indices_sequence);
+    }
+
+    state.m_playback_clips.push_back(playback_clip);
+
+    Py_RETURN_NONE;
+}
+
+PyObject *playback_builder_finalize(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    state.m_playback_events.clear();
+
+    state.m_playback_events.reserve(state.m_playback_clips.size() * 2);
+    int32_t last_clip_end_sample_index = 0;
+    for (size_t i = 0; i < state.m_playback_clips.size(); ++i) {
+        const s_playback_clip &playback_clip = state.m_playback_clips[i];
+        int32_t clip_length = playback_clip.m_end_sample_index - playback_clip.m_start_sample_index;
+        s_playback_event start_event = { e_playback_event::k_start_clip, i, playback_clip.m_playback_start_sample_index };
+        s_playback_event stop_event = { e_playback_event::k_stop_clip, i, playback_clip.m_playback_start_sample_index + clip_length };
+
+        state.m_playback_events.push_back(start_event);
+        state.m_playback_events.push_back(stop_event);
+        last_clip_end_sample_index = std::max(last_clip_end_sample_index, stop_event.m_sample_index);
+    }
+
+    if (state.m_playback_end_sample_index < 0) {
+        state.m_playback_end_sample_index = last_clip_end_sample_index;
+    }
+
+    // Sort events using a stable sort - end events should always come after start events, even if the sample count is 0
+    std::stable_sort(
+        state.m_playback_events.begin(),
+        state.m_playback_events.end(),
+        [](const s_playback_event &a, const s_playback_event &b) { return a.m_sample_index < b.m_sample_index; });
+
+    // Ask the OS to start paging in the mapped ranges we're about to play so the audio thread doesn't take the faults.
+    for (const s_playback_clip &playback_clip : state.m_playback_clips) {
+        const s_clip &clip = state.m_clips[playback_clip.m_clip_id];
+        if (clip.m_mapped_file) {
+            size_t offset = reinterpret_cast<const uint8_t *>(clip.m_mapped_samples + playback_clip.m_start_sample_index)
+                - clip.m_mapped_file->get_data();
+            size_t size = (playback_clip.m_end_sample_index - playback_clip.m_start_sample_index) * sizeof(float);
+            clip.m_mapped_file->advise(offset, size, e_mapped_file_access_hint::k_sequential);
+            clip.m_mapped_file->advise(offset, size, e_mapped_file_access_hint::k_will_need);
+        }
+    }
+
+    // The loop's seek point refers to the old events
+    if (state.m_loop_start_sample_index >= 0) {
+        find_playback_seek_point(state, state.m_loop_start_sample_index, state.m_loop_seek_point);
+    }
+
+    update_render_cache(state);
+    Py_RETURN_NONE;
+}
+
+PyObject *get_render_cache_status(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    size_t ready_segment_count = 0;
+    for (const s_render_cache_segment &segment : state.m_render_cache_segments) {
+        if (segment.m_entry->m_ready) {
+            ready_segment_count++;
+        }
+    }
+
+    return Py_BuildValue("(nn)", ready_segment_count, state.m_render_cache_segments.size());
+}
+
+PyObject *clear_render_cache(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_PLAYING;
+
+    state.m_render_cache_segments.clear();
+    state.m_render_cache.clear();
+    Py_RETURN_NONE;
+}
+
+PyObject *start_playback(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t output_device_index;
+    int32_t frames_per_buffer;
+    int32_t sample_index;
+    if (!PyArg_ParseTuple(args, "iii", &output_device_index, &frames_per_buffer, &sample_index)) {
+        return nullptr;
+    }
+
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    if (state.m_sample_rate <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample rate");
+        return nullptr;
+    }
+
+    if (output_device_index < 0 || static_cast<uint32_t>(output_device_index) >= g_device_state.m_output_devices.size()) {
+        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
+        return nullptr;
     }
 
     if (frames_per_buffer <= 0) {
@@ -472,319 +2077,787 @@ PyObject *start_recording_clip(PyObject *self, PyObject *args) {
         return nullptr;
     }
 
-    const s_device &input_device = g_engine_state.m_input_devices[input_device_index];
-    const s_device &output_device = g_engine_state.m_output_devices[output_device_index];
+    const s_device &output_device = g_device_state.m_output_devices[output_device_index];
+
+    // m_rendering keeps the clips from being changed while the GIL is released
+    state.m_rendering = true;
+    Py_BEGIN_ALLOW_THREADS
+    update_playback_clip_levels(state);
+    Py_END_ALLOW_THREADS
+    state.m_rendering = false;
+
+    seek_playback(state, sample_index);
+    state.m_playback_end_reported = false;
+    reset_playback_timestamp(state, sample_index);
+    reset_metronome(state);
+
+    if (!start_stream(state, nullptr, output_device, frames_per_buffer, playback_stream_main)) {
+        return nullptr;
+    }
+
+    state.m_playing = true;
+    Py_RETURN_NONE;
+}
+
+PyObject *stop_playback(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int immediate = 0;
+    int wait = 1;
+    if (!PyArg_ParseTuple(args, "|pp", &immediate, &wait)) {
+        return nullptr;
+    }
+
+    if (!update_stream_stop(state, false)) {
+        return nullptr;
+    }
+
+    if (!state.m_playing || state.m_stream_stop_thread) {
+        PyErr_SetString(PyExc_Exception, "Not playing");
+        return nullptr;
+    }
+
+    if (!wait) {
+        begin_stream_stop(state, immediate != 0);
+        Py_RETURN_NONE;
+    }
+
+    const char *error = stop_stream(state, immediate != 0);
+    if (error) {
+        PyErr_SetString(PyExc_Exception, error);
+        return nullptr;
+    }
+
+    state.m_playing = false;
+    Py_RETURN_NONE;
+}
+
+PyObject *is_stopping(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    if (!update_stream_stop(state, false)) {
+        return nullptr;
+    }
+
+    return PyBool_FromLong(state.m_stream_stop_thread != nullptr);
+}
+
+PyObject *wait_for_stop(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    if (!update_stream_stop(state, true)) {
+        return nullptr;
+    }
+
+    Py_RETURN_NONE;
+}
+
+PyObject *render_playback(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t start_sample_index;
+    int32_t end_sample_index;
+    if (!PyArg_ParseTuple(args, "ii", &start_sample_index, &end_sample_index)) {
+        return nullptr;
+    }
+
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
+
+    if (start_sample_index < 0 || end_sample_index < start_sample_index) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample range");
+        return nullptr;
+    }
+
+    std::vector<float> samples(static_cast<size_t>(end_sample_index - start_sample_index), 0.0f);
+    seek_playback(state, start_sample_index);
+
+    // The GIL is released so that other engines can render at the same time. m_rendering keeps this engine's own state
+    // from being changed in the meantime.
+    state.m_rendering = true;
+    Py_BEGIN_ALLOW_THREADS
+    update_playback_clip_levels(state);
+    for (size_t offset = 0; offset < samples.size(); offset += k_render_frames_per_buffer) {
+        size_t frame_count = std::min(k_render_frames_per_buffer, samples.size() - offset);
+        mix_playback(state, samples.data() + offset, frame_count);
+    }
+    Py_END_ALLOW_THREADS
+    state.m_rendering = false;
+
+    PyObject *list = PyList_New(samples.size());
+    if (!list) {
+        return nullptr;
+    }
+
+    for (size_t i = 0; i < samples.size(); ++i) {
+        PyObject *value = PyFloat_FromDouble(samples[i]);
+        if (!value) {
+            Py_DECREF(list);
+            return nullptr;
+        }
+        PyList_SET_ITEM(list, i, value);
+    }
+
+    return list;
+}
+
+PyObject *preview_clip(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    t_clip_id clip_id;
+    int32_t start_sample_index;
+    int32_t end_sample_index;
+    double gain;
+    if (!PyArg_ParseTuple(args, "iiid", &clip_id, &start_sample_index, &end_sample_index, &gain)) {
+        return nullptr;
+    }
+
+    if (!update_stream_stop(state, false)) {
+        return nullptr;
+    }
+
+    if (!state.m_playing || state.m_stream_stop_thread) {
+        PyErr_SetString(PyExc_Exception, "Not playing");
+        return nullptr;
+    }
 
-    // Setup the stream parameters
-    PaStreamParameters input_params;
-    input_params.device = input_device.m_portaudio_device_index;
-    input_params.channelCount = 1;
-    input_params.sampleFormat = paFloat32;
-    input_params.suggestedLatency = input_device.m_suggested_latency;
-    input_params.hostApiSpecificStreamInfo = nullptr;
+    ERROR_IF_INVALID_CLIP_ID(clip_id);
 
-    PaStreamParameters output_params;
-    output_params.device = output_device.m_portaudio_device_index;
-    output_params.channelCount = 1;
-    output_params.sampleFormat = paFloat32;
-    output_params.suggestedLatency = output_device.m_suggested_latency;
-    output_params.hostApiSpecificStreamInfo = nullptr;
+    const s_clip &clip = state.m_clips[clip_id];
+    if (start_sample_index < 0
+        || end_sample_index < start_sample_index
+        || static_cast<size_t>(end_sample_index) > clip.get_sample_count()) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample range");
+        return nullptr;
+    }
 
-    PaError result = Pa_IsFormatSupported(
-        &input_params,
-        &output_params,
-        static_cast<double>(g_engine_state.m_sample_rate));
-    if (result != paFormatIsSupported) {
-        PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
+    s_preview_command command;
+    command.m_start = true;
+    command.m_source = clip.get_mix_source();
+    command.m_start_sample_index = start_sample_index;
+    command.m_end_sample_index = end_sample_index;
+    command.m_gain = static_cast<float>(gain);
+    if (!state.m_preview_commands.push(command)) {
+        PyErr_SetString(PyExc_Exception, "Too many preview requests");
         return nullptr;
     }
 
-    // Start up the allocator first to make sure we never underrun
-    size_t recording_buffer_length = static_cast<size_t>(g_engine_state.m_sample_rate * k_recording_buffer_length_seconds);
-    size_t recording_buffer_padding = static_cast<size_t>(g_engine_state.m_sample_rate * k_recording_buffer_padding_seconds);
-    g_engine_state.m_recording_allocator.start(recording_buffer_length, recording_buffer_padding);
-    g_engine_state.m_current_recording_buffer = g_engine_state.m_recording_allocator.get_first_buffer();
+    Py_RETURN_NONE;
+}
 
-    // This is used by the metronome
-    g_engine_state.m_playback_sample_index = 0;
-    g_engine_state.m_metronome_sample = INT32_MAX;
+PyObject *stop_preview(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
 
-    PaTime total_latency = input_device.m_suggested_latency + output_device.m_suggested_latency;
-    g_engine_state.m_recording_playback_latency = static_cast<int32_t>(total_latency * g_engine_state.m_sample_rate);
-    g_engine_state.m_samples_until_recording_begins = g_engine_state.m_recording_playback_latency;
+    // Nothing can be previewing without a stream
+    if (state.m_playing) {
+        s_preview_command command;
+        if (!state.m_preview_commands.push(command)) {
+            PyErr_SetString(PyExc_Exception, "Too many preview requests");
+            return nullptr;
+        }
+    }
 
-    result = Pa_OpenStream(
-        &g_engine_state.m_stream,
-        &input_params,
-        &output_params,
-        static_cast<double>(g_engine_state.m_sample_rate),
-        static_cast<uint32_t>(frames_per_buffer),
-        paNoFlag,
-        recording_stream_main,
-        nullptr);
-    if (result != paNoError) {
-        PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
-        g_engine_state.m_recording_allocator.stop();
-        g_engine_state.m_recording_allocator.clear();
+    Py_RETURN_NONE;
+}
+
+#define ERROR_IF_INVALID_BUS_INDEX(bus_index)                                               \
+do {                                                                                        \
+    if (bus_index < 0 || static_cast<size_t>(bus_index) >= state.m_buses.size()) { \
+        PyErr_SetString(PyExc_ValueError, "Invalid bus index");                             \
+        return nullptr;                                                                     \
+    }                                                                                       \
+} while (0)
+
+PyObject *set_loop(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t start_sample_index;
+    int32_t end_sample_index;
+    if (!PyArg_ParseTuple(args, "ii", &start_sample_index, &end_sample_index)) {
         return nullptr;
     }
 
-    result = Pa_StartStream(g_engine_state.m_stream);
-    if (result != paNoError) {
-        Pa_CloseStream(g_engine_state.m_stream);
-        g_engine_state.m_stream = nullptr;
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
 
-        PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
-        g_engine_state.m_recording_allocator.stop();
-        g_engine_state.m_recording_allocator.clear();
+    if (start_sample_index < 0 || end_sample_index <= start_sample_index) {
+        PyErr_SetString(PyExc_ValueError, "Invalid sample range");
         return nullptr;
     }
 
-    g_engine_state.m_recording = true;
+    state.m_loop_start_sample_index = start_sample_index;
+    state.m_loop_end_sample_index = end_sample_index;
+    find_playback_seek_point(state, start_sample_index, state.m_loop_seek_point);
+    Py_RETURN_NONE;
+}
 
-    t_clip_id clip_id = g_engine_state.m_next_clip_id++;
-    g_engine_state.m_clips.emplace(std::make_pair(clip_id, s_clip()));
-    g_engine_state.m_recording_clip_id = clip_id;
+PyObject *clear_loop(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_RECORDING;
+    ERROR_IF_PLAYING;
 
-    return PyLong_FromLong(clip_id);
+    state.m_loop_start_sample_index = -1;
+    state.m_loop_end_sample_index = -1;
+    state.m_loop_seek_point = {};
+    Py_RETURN_NONE;
 }
 
-PyObject *stop_recording_clip(PyObject *self) {
-    if (!g_engine_state.m_recording) {
-        PyErr_SetString(PyExc_Exception, "Not recording");
+PyObject *set_bus_gain(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t bus_index;
+    double gain;
+    if (!PyArg_ParseTuple(args, "id", &bus_index, &gain)) {
         return nullptr;
     }
 
-    // It would be bad if this failed...
-    if (Pa_StopStream(g_engine_state.m_stream) != paNoError) {
-        PyErr_SetString(PyExc_Exception, "Failed to stop the stream");
-        return nullptr;
+    ERROR_IF_INVALID_BUS_INDEX(bus_index);
+
+    float new_gain = static_cast<float>(gain);
+    if (state.m_buses[bus_index].m_gain.exchange(new_gain) != new_gain) {
+        state.m_bus_version++;
     }
 
-    // This too...
-    if (Pa_CloseStream(g_engine_state.m_stream) != paNoError) {
-        PyErr_SetString(PyExc_Exception, "Failed to close the stream");
+    Py_RETURN_NONE;
+}
+
+PyObject *set_bus_muted(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t bus_index;
+    int muted;
+    if (!PyArg_ParseTuple(args, "ip", &bus_index, &muted)) {
         return nullptr;
     }
 
-    g_engine_state.m_recording_allocator.stop();
+    ERROR_IF_INVALID_BUS_INDEX(bus_index);
 
-    s_clip &clip = g_engine_state.m_clips[g_engine_state.m_recording_clip_id];
-    g_engine_state.m_recording_allocator.save_recorded_samples(clip.m_samples);
-    g_engine_state.m_recording_allocator.clear();
-    g_engine_state.m_current_recording_buffer = nullptr;
+    bool new_muted = muted != 0;
+    if (state.m_buses[bus_index].m_muted.exchange(new_muted) != new_muted) {
+        state.m_bus_version++;
+    }
 
-    g_engine_state.m_recording = false;
-    g_engine_state.m_recording_clip_id = -1;
     Py_RETURN_NONE;
 }
 
-PyObject *get_recorded_sample_count(PyObject *self) {
-    if (!g_engine_state.m_recording) {
-        PyErr_SetString(PyExc_Exception, "Not recording");
+PyObject *set_bus_soloed(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int32_t bus_index;
+    int soloed;
+    if (!PyArg_ParseTuple(args, "ip", &bus_index, &soloed)) {
         return nullptr;
     }
 
-    // Take the playback sample index and subtract our recording latency
-    int32_t recorded_sample_count = std::max(
-        g_engine_state.m_playback_sample_index - g_engine_state.m_recording_playback_latency,
-        0);
-    return PyLong_FromLong(recorded_sample_count);
+    ERROR_IF_INVALID_BUS_INDEX(bus_index);
+
+    bool new_soloed = soloed != 0;
+    if (state.m_buses[bus_index].m_soloed.exchange(new_soloed) != new_soloed) {
+        state.m_bus_version++;
+    }
+
+    Py_RETURN_NONE;
 }
 
-PyObject *get_latest_recorded_samples(PyObject *self, PyObject *args) {
-    int32_t sample_count;
-    if (!PyArg_ParseTuple(args, "i", &sample_count)) {
+PyObject *get_playback_sample_index(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    return PyLong_FromLong(state.m_playback_sample_index);
+}
+
+PyObject *get_playback_position(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    PyObject *time_object = Py_None;
+    if (!PyArg_ParseTuple(args, "|O", &time_object)) {
         return nullptr;
     }
 
-    if (!g_engine_state.m_recording) {
-        PyErr_SetString(PyExc_Exception, "Not recording");
+    int64_t time = get_trace_time();
+    if (time_object != Py_None) {
+        double time_seconds = PyFloat_AsDouble(time_object);
+        if (time_seconds == -1.0 && PyErr_Occurred()) {
+            return nullptr;
+        }
+
+        time = static_cast<int64_t>(time_seconds * 1e9);
+    }
+
+    int64_t timestamp_frame_index;
+    int32_t timestamp_frame_count;
+    int64_t timestamp_time;
+    bool timestamp_valid = read_playback_timestamp(state, timestamp_frame_index, timestamp_frame_count, timestamp_time);
+    if (!(state.m_playing || state.m_recording) || !timestamp_valid) {
+        return PyFloat_FromDouble(static_cast<double>(state.m_playback_sample_index));
+    }
+
+    // The position can't be before playback started or beyond the samples which have been handed to the device
+    double elapsed_seconds = static_cast<double>(time - timestamp_time) * 1e-9;
+    double frame_position = static_cast<double>(timestamp_frame_index) + elapsed_seconds * state.m_sample_rate;
+    frame_position = std::min(
+        std::max(frame_position, 0.0),
+        static_cast<double>(timestamp_frame_index + timestamp_frame_count));
+    double position = static_cast<double>(state.m_playback_first_sample_index) + frame_position;
+
+    // The loop can't change while playing, so frames past the loop end map back into the loop the same way the audio
+    // thread wrapped them
+    if (state.m_playing
+        && state.m_loop_start_sample_index >= 0
+        && state.m_playback_first_sample_index < state.m_loop_end_sample_index
+        && position >= static_cast<double>(state.m_loop_end_sample_index)) {
+        double loop_length = static_cast<double>(state.m_loop_end_sample_index - state.m_loop_start_sample_index);
+        position = static_cast<double>(state.m_loop_start_sample_index)
+            + fmod(position - static_cast<double>(state.m_loop_end_sample_index), loop_length);
+    }
+
+    return PyFloat_FromDouble(position);
+}
+
+static bool append_engine_event(PyObject *list, const char *name, int32_t sample_index, int32_t argument) {
+    PyObject *item = Py_BuildValue("(sii)", name, sample_index, argument);
+    if (!item || PyList_Append(list, item) != 0) {
+        Py_XDECREF(item);
+        return false;
+    }
+
+    Py_DECREF(item);
+    return true;
+}
+
+PyObject *poll_events(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    // Completing a background stop here means it's reported in the same poll that notices it has finished
+    if (!update_stream_stop(state, false)) {
         return nullptr;
     }
 
-    if (sample_count < 0) {
-        PyErr_SetString(PyExc_ValueError, "Invalid sample count");
+    PyObject *list = PyList_New(0);
+    if (!list) {
         return nullptr;
     }
 
-    std::vector<double> latest_samples(sample_count, 0.0);
-    int32_t samples_remaining = sample_count;
-    const s_recording_buffer *recording_buffer = g_engine_state.m_current_recording_buffer;
-    while (samples_remaining > 0 && recording_buffer) {
-        size_t recording_buffer_samples_remaining = recording_buffer->m_usage;
-        size_t amount_to_copy = std::min(static_cast<size_t>(samples_remaining), recording_buffer_samples_remaining);
-        for (size_t i = 0; i < amount_to_copy; ++i) {
-            // Note pre-increment because we are iterating down to 0
-            latest_samples[--samples_remaining] = recording_buffer->m_samples[--recording_buffer_samples_remaining];
+    s_engine_event event;
+    while (state.m_event_ring.pop(event)) {
+        const char *name = k_engine_event_names[static_cast<size_t>(event.m_event)];
+        if (!append_engine_event(list, name, event.m_sample_index, event.m_argument)) {
+            Py_DECREF(list);
+            return nullptr;
         }
+    }
 
-        recording_buffer = recording_buffer->m_prev;
+    uint64_t dropped_event_count = state.m_event_ring.take_dropped_count();
+    if (dropped_event_count > 0) {
+        int32_t argument = static_cast<int32_t>(std::min<uint64_t>(dropped_event_count, INT32_MAX));
+        if (!append_engine_event(list, "events_dropped", state.m_playback_sample_index, argument)) {
+            Py_DECREF(list);
+            return nullptr;
+        }
     }
 
-    PyObject *list = PyList_New(sample_count);
-    if (!list) {
-        return nullptr;
+    // Time stretches run on their own threads rather than the audio thread, so their progress is checked here
+    if (state.m_time_stretch_thread) {
+        size_t completed_count = state.m_time_stretch_completed_count;
+        if (completed_count != state.m_time_stretch_reported_count) {
+            state.m_time_stretch_reported_count = completed_count;
+            const char *name = completed_count == state.m_time_stretch_tasks.size()
+                ? "time_stretch_finished"
+                : "time_stretch_progress";
+            if (!append_engine_event(list, name, state.m_playback_sample_index, static_cast<int32_t>(completed_count))) {
+                Py_DECREF(list);
+                return nullptr;
+            }
+        }
     }
 
-    for (int32_t i = 0; i < sample_count; ++i) {
-        PyObject *value = PyFloat_FromDouble(latest_samples[i]);
-        if (!value) {
+    // Nothing is queued once the stream has stopped, so this always comes last
+    if (state.m_stream_stopped_event_pending) {
+        state.m_stream_stopped_event_pending = false;
+        if (!append_engine_event(list, "stream_stopped", state.m_playback_sample_index, 0)) {
             Py_DECREF(list);
             return nullptr;
         }
-        PyList_SET_ITEM(list, i, value);
     }
 
     return list;
 }
 
-PyObject *get_clip_sample_count(PyObject *self, PyObject *args) {
-    t_clip_id clip_id;
-    if (!PyArg_ParseTuple(args, "i", &clip_id)) {
+PyObject *set_metronome_samples_per_beat(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    double samples_per_beat;
+    int32_t beats_per_measure = 0;
+    if (!PyArg_ParseTuple(args, "d|i", &samples_per_beat, &beats_per_measure)) {
         return nullptr;
     }
 
-    ERROR_IF_INVALID_CLIP_ID(clip_id);
+    if (samples_per_beat < 0.0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid samples per beat");
+        return nullptr;
+    }
+
+    if (beats_per_measure < 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid beats per measure");
+        return nullptr;
+    }
 
-    const s_clip &clip = g_engine_state.m_clips[clip_id];
-    return PyLong_FromSize_t(clip.m_samples.size());
+    // An odd sequence number tells the audio thread that a write is in progress. The GIL keeps writers from overlapping.
+    uint32_t sequence = state.m_metronome_settings_sequence.load(std::memory_order_relaxed);
+    state.m_metronome_settings_sequence.store(sequence + 1, std::memory_order_relaxed);
+    std::atomic_thread_fence(std::memory_order_release);
+    state.m_metronome_samples_per_beat.store(samples_per_beat, std::memory_order_relaxed);
+    state.m_metronome_beats_per_measure.store(beats_per_measure, std::memory_order_relaxed);
+    state.m_metronome_settings_sequence.store(sequence + 2, std::memory_order_release);
+    Py_RETURN_NONE;
 }
 
-PyObject *get_clip_samples(PyObject *self, PyObject *args) {
-    t_clip_id clip_id;
-    int32_t max_sample_count;
-    if (!PyArg_ParseTuple(args, "ii", &clip_id, &max_sample_count)) {
+PyObject *get_stats(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    const s_engine_stats &stats = state.m_stats;
+    uint64_t callback_count = stats.m_callback_count;
+
+    double min_duration = 0.0;
+    double average_duration = 0.0;
+    double max_duration = 0.0;
+    double p99_duration = 0.0;
+    if (callback_count > 0) {
+        min_duration = stats.m_min_callback_duration / k_stats_duration_scale;
+        average_duration = stats.m_total_callback_duration / k_stats_duration_scale / callback_count;
+        max_duration = stats.m_max_callback_duration / k_stats_duration_scale;
+
+        // Read the histogram first since the audio thread may be adding to it, and report the top of the bucket
+        uint32_t histogram[k_stats_histogram_bucket_count];
+        uint64_t histogram_count = 0;
+        for (size_t i = 0; i < k_stats_histogram_bucket_count; ++i) {
+            histogram[i] = stats.m_callback_duration_histogram[i];
+            histogram_count += histogram[i];
+        }
+
+        uint64_t p99_count = (histogram_count * 99 + 99) / 100;
+        uint64_t cumulative_count = 0;
+        for (size_t i = 0; i < k_stats_histogram_bucket_count; ++i) {
+            cumulative_count += histogram[i];
+            if (cumulative_count >= p99_count) {
+                p99_duration = std::min((i + 1) * k_stats_histogram_bucket_width, max_duration);
+                break;
+            }
+        }
+    }
+
+    return Py_BuildValue(
+        "{s:K,s:d,s:d,s:d,s:d,s:K,s:K,s:K,s:K,s:K,s:i}",
+        "callback_count", static_cast<unsigned long long>(callback_count),
+        "callback_duration_min", min_duration,
+        "callback_duration_avg", average_duration,
+        "callback_duration_max", max_duration,
+        "callback_duration_p99", p99_duration,
+        "input_underflows", static_cast<unsigned long long>(stats.m_input_underflows),
+        "input_overflows", static_cast<unsigned long long>(stats.m_input_overflows),
+        "output_underflows", static_cast<unsigned long long>(stats.m_output_underflows),
+        "output_overflows", static_cast<unsigned long long>(stats.m_output_overflows),
+        "recording_underflows", static_cast<unsigned long long>(stats.m_recording_underflows),
+        "active_clip_high_water", static_cast<int>(stats.m_active_clip_high_water));
+}
+
+PyObject *get_meters(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    auto take_meter = [](s_meter &meter) {
+        return std::make_pair(meter.m_peak.exchange(0.0f), meter.m_rms.load());
+    };
+
+    PyObject *buses = PyList_New(state.m_buses.size());
+    if (!buses) {
         return nullptr;
     }
 
-    ERROR_IF_INVALID_CLIP_ID(clip_id);
+    for (size_t i = 0; i < state.m_buses.size(); ++i) {
+        auto levels = take_meter(state.m_buses[i].m_meter);
+        PyObject *value = Py_BuildValue("(dd)", levels.first, levels.second);
+        if (!value) {
+            Py_DECREF(buses);
+            return nullptr;
+        }
+        PyList_SET_ITEM(buses, i, value);
+    }
 
-    const s_clip &clip = g_engine_state.m_clips[clip_id];
+    auto input_levels = take_meter(state.m_input_meter);
+    auto output_levels = take_meter(state.m_output_meter);
+    return Py_BuildValue(
+        "{s:(dd),s:(dd),s:N}",
+        "input", input_levels.first, input_levels.second,
+        "output", output_levels.first, output_levels.second,
+        "buses", buses);
+}
 
-    if (max_sample_count <= 0) {
-        max_sample_count = static_cast<int32_t>(clip.m_samples.size());
+PyObject *reset_stats(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    s_engine_stats &stats = state.m_stats;
+    stats.m_callback_count = 0;
+    stats.m_total_callback_duration = 0;
+    stats.m_min_callback_duration = UINT64_MAX;
+    stats.m_max_callback_duration = 0;
+    for (std::atomic<uint32_t> &bucket : stats.m_callback_duration_histogram) {
+        bucket = 0;
+    }
+
+    stats.m_input_underflows = 0;
+    stats.m_input_overflows = 0;
+    stats.m_output_underflows = 0;
+    stats.m_output_overflows = 0;
+    stats.m_recording_underflows = 0;
+    stats.m_active_clip_high_water = state.m_playing ? state.m_active_playback_clip_count : 0;
+    Py_RETURN_NONE;
+}
+
+PyObject *set_trace_enabled(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int enabled;
+    if (!PyArg_ParseTuple(args, "p", &enabled)) {
+        return nullptr;
     }
 
-    int32_t sample_count = std::min(static_cast<int32_t>(clip.m_samples.size()), max_sample_count);
-    PyObject *list = PyList_New(sample_count);
+    state.m_trace_enabled = enabled != 0;
+    Py_RETURN_NONE;
+}
+
+static PyObject *build_trace_event(int64_t time, char phase, const char *name, int32_t argument) {
+    char phase_string[] = { phase, '\0' };
+    return Py_BuildValue("(dssi)", static_cast<double>(time) * 1e-9, phase_string, name, argument);
+}
+
+PyObject *drain_trace(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    PyObject *list = PyList_New(0);
     if (!list) {
         return nullptr;
     }
 
-    for (int32_t i = 0; i < sample_count; ++i) {
-        // Spread out samples evenly if the count exceeds max_sample_count
-        int64_t source_index = static_cast<int64_t>(i) * static_cast<int64_t>(clip.m_samples.size()) / max_sample_count;
-        PyObject *value = PyFloat_FromDouble(clip.m_samples[source_index]);
-        if (!value) {
+    s_trace_event event;
+    while (state.m_trace_ring.pop(event)) {
+        static const char k_phases[] = { 'B', 'E', 'i' };
+        PyObject *item = build_trace_event(
+            event.m_time,
+            k_phases[static_cast<size_t>(event.m_phase)],
+            k_trace_event_names[event.m_name],
+            event.m_argument);
+        if (!item || PyList_Append(list, item) != 0) {
+            Py_XDECREF(item);
             Py_DECREF(list);
             return nullptr;
         }
-        PyList_SET_ITEM(list, i, value);
+
+        Py_DECREF(item);
+    }
+
+    // Report overflow as an event of its own so gaps in the trace are explained
+    uint64_t dropped_event_count = state.m_trace_ring.take_dropped_count();
+    if (dropped_event_count > 0) {
+        int32_t argument = static_cast<int32_t>(std::min<uint64_t>(dropped_event_count, INT32_MAX));
+        PyObject *item = build_trace_event(get_trace_time(), 'i', "trace_events_dropped", argument);
+        if (!item || PyList_Append(list, item) != 0) {
+            Py_XDECREF(item);
+            Py_DECREF(list);
+            return nullptr;
+        }
+
+        Py_DECREF(item);
     }
 
     return list;
 }
 
-PyObject *playback_builder_begin(PyObject *self) {
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
-
-    g_engine_state.m_playback_clips.clear();
-    Py_RETURN_NONE;
+PyObject *get_time(PyObject *self) {
+    return PyFloat_FromDouble(static_cast<double>(get_trace_time()) * 1e-9);
 }
 
-PyObject *playback_builder_add_clip(PyObject *self, PyObject *args) {
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
+#define ERROR_IF_NO_VIRTUAL_DEVICE                                              \
+do {                                                                            \
+    if (!state.m_virtual_device) {                                     \
+        PyErr_SetString(PyExc_Exception, "Virtual devices are not enabled");    \
+        return nullptr;                                                         \
+    }                                                                           \
+} while (0)
 
-    t_clip_id clip_id;
-    int32_t start_sample_index;
-    int32_t end_sample_index;
-    int32_t playback_start_sample_index;
-    double gain;
-    if (!PyArg_ParseTuple(args, "iiiid", &clip_id, &start_sample_index, &end_sample_index, &playback_start_sample_index, &gain)) {
+PyObject *set_virtual_device(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    int realtime = 0;
+    long long frame_limit = 0;
+    int capture_output = 1;
+    if (!PyArg_ParseTuple(args, "|pLp", &realtime, &frame_limit, &capture_output)) {
         return nullptr;
     }
 
-    ERROR_IF_INVALID_CLIP_ID(clip_id);
+    ERROR_IF_NO_VIRTUAL_DEVICE;
 
-    const s_clip &clip = g_engine_state.m_clips[clip_id];
-    if (start_sample_index < 0
-        || static_cast<uint32_t>(start_sample_index) > clip.m_samples.size()
-        || end_sample_index < 0
-        || static_cast<uint32_t>(end_sample_index) > clip.m_samples.size()
-        || start_sample_index > end_sample_index) {
-        PyErr_SetString(PyExc_ValueError, "Invalid start/end sample indices");
+    if (frame_limit < 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid frame limit");
         return nullptr;
     }
 
-    s_playback_clip playback_clip;
-    playback_clip.m_clip_id = clip_id;
-    playback_clip.m_start_sample_index = start_sample_index;
-    playback_clip.m_end_sample_index = end_sample_index;
-    playback_clip.m_playback_start_sample_index = playback_start_sample_index;
-    playback_clip.m_gain = static_cast<float>(gain);
-    g_engine_state.m_playback_clips.push_back(playback_clip);
-
+    s_virtual_device_settings &settings = state.m_virtual_device->get_settings();
+    settings.m_realtime = realtime != 0;
+    settings.m_frame_limit = static_cast<uint64_t>(frame_limit);
+    settings.m_capture_output = capture_output != 0;
     Py_RETURN_NONE;
 }
 
-PyObject *playback_builder_finalize(PyObject *self) {
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
+PyObject *set_virtual_input(PyObject *self, PyObject *args) {
+    s_engine_state &state = get_engine_state(self);
+    PyObject *source = Py_None;
+    if (!PyArg_ParseTuple(args, "|O", &source)) {
+        return nullptr;
+    }
 
-    g_engine_state.m_playback_events.clear();
+    ERROR_IF_NO_VIRTUAL_DEVICE;
 
-    g_engine_state.m_playback_events.reserve(g_engine_state.m_playback_clips.size() * 2);
-    for (size_t i = 0; i < g_engine_state.m_playback_clips.size(); ++i) {
-        const s_playback_clip &playback_clip = g_engine_state.m_playback_clips[i];
-        int32_t clip_length = playback_clip.m_end_sample_index - playback_clip.m_start_sample_index;
-        s_playback_event start_event = { e_playback_event::k_start_clip, i, playback_clip.m_playback_start_sample_index };
-        s_playback_event stop_event = { e_playback_event::k_stop_clip, i, playback_clip.m_playback_start_sample_index + clip_length };
+    s_virtual_device_settings &settings = state.m_virtual_device->get_settings();
+    if (source == Py_None) {
+        settings.m_input_source = e_virtual_input_source::k_silence;
+        settings.m_input_samples.clear();
+    } else if (PyUnicode_Check(source)) {
+        const char *filename = PyUnicode_AsUTF8(source);
+        if (!filename) {
+            return nullptr;
+        }
 
-        g_engine_state.m_playback_events.push_back(start_event);
-        g_engine_state.m_playback_events.push_back(stop_event);
-    }
+        if (state.m_sample_rate <= 0) {
+            PyErr_SetString(PyExc_Exception, "Sample rate has not been set");
+            return nullptr;
+        }
 
-    // Sort events using a stable sort - end events should always come after start events, even if the sample count is 0
-    std::stable_sort(
-        g_engine_state.m_playback_events.begin(),
-        g_engine_state.m_playback_events.end(),
-        [](const s_playback_event &a, const s_playback_event &b) { return a.m_sample_index < b.m_sample_index; });
+        std::vector<float> samples;
+        uint32_t sample_rate;
+        bool result;
+        Py_BEGIN_ALLOW_THREADS
+        result = read_wav(filename, samples, sample_rate);
+        if (result && sample_rate != static_cast<uint32_t>(state.m_sample_rate)) {
+            std::vector<float> resampled_samples;
+            c_resampler resampler(sample_rate, static_cast<uint32_t>(state.m_sample_rate));
+            resample(resampler, samples.data(), samples.size(), resampled_samples, 0);
+            samples.swap(resampled_samples);
+        }
+        Py_END_ALLOW_THREADS
+
+        if (!result) {
+            PyErr_Format(PyExc_IOError, "Failed to read '%s'", filename);
+            return nullptr;
+        }
+
+        settings.m_input_source = e_virtual_input_source::k_samples;
+        settings.m_input_samples.swap(samples);
+    } else {
+        double frequency = PyFloat_AsDouble(source);
+        if (frequency == -1.0 && PyErr_Occurred()) {
+            PyErr_SetString(PyExc_TypeError, "Virtual input must be None, a sine frequency or a wav filename");
+            return nullptr;
+        }
+
+        if (frequency <= 0.0) {
+            PyErr_SetString(PyExc_ValueError, "Invalid sine frequency");
+            return nullptr;
+        }
+
+        settings.m_input_source = e_virtual_input_source::k_sine;
+        settings.m_input_sine_frequency = frequency;
+        settings.m_input_samples.clear();
+    }
 
     Py_RETURN_NONE;
 }
 
-PyObject *start_playback(PyObject *self, PyObject *args) {
-    int32_t output_device_index;
-    int32_t frames_per_buffer;
-    int32_t sample_index;
-    if (!PyArg_ParseTuple(args, "iii", &output_device_index, &frames_per_buffer, &sample_index)) {
+PyObject *wait_virtual_device(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_NO_VIRTUAL_DEVICE;
+
+    c_virtual_device *virtual_device = state.m_virtual_device.get();
+    if (!state.m_stream_virtual || !virtual_device->is_running()) {
+        Py_RETURN_NONE;
+    }
+
+    if (virtual_device->get_stream_frame_limit() == 0) {
+        PyErr_SetString(PyExc_Exception, "The virtual device has no frame limit");
         return nullptr;
     }
 
-    ERROR_IF_RECORDING;
-    ERROR_IF_PLAYING;
+    Py_BEGIN_ALLOW_THREADS
+    virtual_device->wait();
+    Py_END_ALLOW_THREADS
 
-    if (g_engine_state.m_sample_rate <= 0) {
-        PyErr_SetString(PyExc_ValueError, "Invalid sample rate");
+    Py_RETURN_NONE;
+}
+
+PyObject *get_virtual_output(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_NO_VIRTUAL_DEVICE;
+
+    std::vector<float> output;
+    state.m_virtual_device->get_output(output);
+
+    PyObject *samples = PyList_New(output.size());
+    if (!samples) {
         return nullptr;
     }
 
-    if (output_device_index < 0 || static_cast<uint32_t>(output_device_index) >= g_engine_state.m_output_devices.size()) {
-        PyErr_SetString(PyExc_ValueError, "Invalid input device index");
-        return nullptr;
-    }
+    for (size_t i = 0; i < output.size(); ++i) {
+        PyObject *value = PyFloat_FromDouble(output[i]);
+        if (!value) {
+            Py_DECREF(samples);
+            return nullptr;
+        }
+        PyList_SET_ITEM(samples, i, value);
+    }
+
+    return samples;
+}
 
-    if (frames_per_buffer <= 0) {
-        PyErr_SetString(PyExc_ValueError, "Invalid frames per buffer");
+PyObject *clear_virtual_output(PyObject *self) {
+    s_engine_state &state = get_engine_state(self);
+    ERROR_IF_NO_VIRTUAL_DEVICE;
+
+    if (state.m_virtual_device->is_running()) {
+        PyErr_SetString(PyExc_Exception, "Cannot clear the virtual output while a stream is running");
         return nullptr;
     }
 
-    const s_device &output_device = g_engine_state.m_output_devices[output_device_index];
+    state.m_virtual_device->clear_output();
+    Py_RETURN_NONE;
+}
+
+static bool start_stream(
+    s_engine_state &state,
+    const s_device *input_device,
+    const s_device &output_device,
+    int32_t frames_per_buffer,
+    PaStreamCallback *callback,
+    const std::function<bool()> &virtual_device_ready) {
+    // Events left over from the last stream no longer apply. Nothing is pushing now, so it's safe to read them from here.
+    s_engine_event event;
+    while (state.m_event_ring.pop(event)) {}
+    state.m_event_ring.take_dropped_count();
+    state.m_stream_stopped_event_pending = false;
+
+    // Likewise, a preview only lasts as long as the stream it was started in
+    s_preview_command preview_command;
+    while (state.m_preview_commands.pop(preview_command)) {}
+    state.m_preview_voice.m_active = false;
+
+    // And meters shouldn't show the levels it ended with
+    reset_meters(state);
+
+    if (output_device.m_virtual || (input_device && input_device->m_virtual)) {
+        if (!output_device.m_virtual || (input_device && !input_device->m_virtual)) {
+            PyErr_SetString(PyExc_ValueError, "Virtual and hardware devices cannot be used in the same stream");
+            return false;
+        }
+
+        state.m_virtual_device->start(
+            static_cast<uint32_t>(state.m_sample_rate),
+            static_cast<uint32_t>(frames_per_buffer),
+            input_device != nullptr,
+            callback,
+            &state,
+            virtual_device_ready);
+        state.m_stream_virtual = true;
+        return true;
+    }
 
     // Setup the stream parameters
+    PaStreamParameters input_params;
+    if (input_device) {
+        input_params.device = input_device->m_portaudio_device_index;
+        input_params.channelCount = 1;
+        input_params.sampleFormat = paFloat32;
+        input_params.suggestedLatency = input_device->m_suggested_latency;
+        input_params.hostApiSpecificStreamInfo = nullptr;
+    }
+
     PaStreamParameters output_params;
     output_params.device = output_device.m_portaudio_device_index;
     output_params.channelCount = 1;
@@ -793,131 +2866,264 @@ PyObject *start_playback(PyObject *self, PyObject *args) {
     output_params.hostApiSpecificStreamInfo = nullptr;
 
     PaError result = Pa_IsFormatSupported(
-        nullptr,
+        input_device ? &input_params : nullptr,
         &output_params,
-        static_cast<double>(g_engine_state.m_sample_rate));
+        static_cast<double>(state.m_sample_rate));
     if (result != paFormatIsSupported) {
         PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
-        return nullptr;
-    }
-
-    // Go through all the clip events and clear them from the active list
-    g_engine_state.m_first_active_playback_clip = nullptr;
-    for (size_t i = 0; i < g_engine_state.m_playback_clips.size(); ++i) {
-        s_playback_clip &playback_clip = g_engine_state.m_playback_clips[i];
-        playback_clip.m_prev_active_playback_clip = nullptr;
-        playback_clip.m_next_active_playback_clip = nullptr;
-    }
-
-    // Activate and deactivate the appropriate playback clips for our starting point
-    g_engine_state.m_next_playback_event_index = 0;
-    for (size_t i = 0; i < g_engine_state.m_playback_events.size(); ++i) {
-        const s_playback_event &playback_event = g_engine_state.m_playback_events[i];
-        if (playback_event.m_sample_index > sample_index) {
-            // This event occurs after our start sample, so don't process it or anything that comes after it
-            break;
-        }
-
-        if (playback_event.m_event == e_playback_event::k_start_clip) {
-            activate_playback_clip(playback_event.m_playback_clip_index);
-        } else {
-            assert(playback_event.m_event == e_playback_event::k_stop_clip);
-            deactivate_playback_clip(playback_event.m_playback_clip_index);
-        }
-
-        // Advance to the next event
-        g_engine_state.m_next_playback_event_index++;
+        return false;
     }
 
-    g_engine_state.m_playback_sample_index = sample_index;
-    g_engine_state.m_metronome_sample = INT32_MAX;
-
     result = Pa_OpenStream(
-        &g_engine_state.m_stream,
-        nullptr,
+        &state.m_stream,
+        input_device ? &input_params : nullptr,
         &output_params,
-        static_cast<double>(g_engine_state.m_sample_rate),
+        static_cast<double>(state.m_sample_rate),
         static_cast<uint32_t>(frames_per_buffer),
         paNoFlag,
-        playback_stream_main,
-        nullptr);
+        callback,
+        &state);
     if (result != paNoError) {
         PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
-        return nullptr;
+        return false;
     }
 
-    result = Pa_StartStream(g_engine_state.m_stream);
+    result = Pa_StartStream(state.m_stream);
     if (result != paNoError) {
-        Pa_CloseStream(g_engine_state.m_stream);
-        g_engine_state.m_stream = nullptr;
+        Pa_CloseStream(state.m_stream);
+        state.m_stream = nullptr;
 
         PyErr_SetString(PyExc_Exception, Pa_GetErrorText(result));
-        return nullptr;
+        return false;
     }
 
-    g_engine_state.m_playing = true;
-    Py_RETURN_NONE;
+    state.m_stream_virtual = false;
+    return true;
 }
 
-PyObject *stop_playback(PyObject *self) {
-    if (!g_engine_state.m_playing) {
-        PyErr_SetString(PyExc_Exception, "Not playing");
+// Returns an error message on failure. This doesn't touch Python so that it can run on the stream stop thread.
+static const char *stop_stream(s_engine_state &state, bool immediate) {
+    if (state.m_stream_virtual) {
+        state.m_virtual_device->stop();
+        state.m_stream_virtual = false;
         return nullptr;
     }
 
-    // It would be bad if this failed...
-    if (Pa_StopStream(g_engine_state.m_stream) != paNoError) {
-        PyErr_SetString(PyExc_Exception, "Failed to stop the stream");
-        return nullptr;
+    // Aborting discards queued buffers rather than waiting for them to play. It would be bad if this failed...
+    PaError result = immediate ? Pa_AbortStream(state.m_stream) : Pa_StopStream(state.m_stream);
+    if (result != paNoError) {
+        return "Failed to stop the stream";
     }
 
     // This too...
-    if (Pa_CloseStream(g_engine_state.m_stream) != paNoError) {
-        PyErr_SetString(PyExc_Exception, "Failed to close the stream");
-        return nullptr;
+    if (Pa_CloseStream(state.m_stream) != paNoError) {
+        return "Failed to close the stream";
     }
 
-    g_engine_state.m_playing = false;
-    Py_RETURN_NONE;
+    state.m_stream = nullptr;
+    return nullptr;
 }
 
-PyObject *get_playback_sample_index(PyObject *self) {
-    return PyLong_FromLong(g_engine_state.m_playback_sample_index);
+static void begin_stream_stop(s_engine_state &state, bool immediate) {
+    state.m_stream_stop_complete = false;
+    state.m_stream_stop_error = nullptr;
+    state.m_stream_stop_thread = new std::thread(
+        [&state, immediate]() {
+            state.m_stream_stop_error = stop_stream(state, immediate);
+            state.m_stream_stop_complete.store(true, std::memory_order_release);
+        });
 }
 
-PyObject *set_metronome_samples_per_beat(PyObject *self, PyObject *args) {
-    double samples_per_beat;
-    if (!PyArg_ParseTuple(args, "d", &samples_per_beat)) {
-        return nullptr;
+// Completes a stop started by begin_stream_stop once its thread has finished, waiting for it if requested. Returns false
+// with the Python error set if the stop failed.
+static bool update_stream_stop(s_engine_state &state, bool wait) {
+    if (!state.m_stream_stop_thread
+        || (!wait && !state.m_stream_stop_complete.load(std::memory_order_acquire))) {
+        return true;
     }
 
-    if (samples_per_beat < 0.0) {
-        PyErr_SetString(PyExc_ValueError, "Invalid samples per beat");
-        return nullptr;
+    Py_BEGIN_ALLOW_THREADS
+    state.m_stream_stop_thread->join();
+    Py_END_ALLOW_THREADS
+
+    delete state.m_stream_stop_thread;
+    state.m_stream_stop_thread = nullptr;
+
+    // As with a blocking stop, a failure leaves the engine playing or recording so that stopping can be retried
+    if (state.m_stream_stop_error) {
+        PyErr_SetString(PyExc_Exception, state.m_stream_stop_error);
+        return false;
     }
 
-    g_engine_state.m_metronome_samples_per_beat = samples_per_beat;
-    Py_RETURN_NONE;
+    if (state.m_recording) {
+        finish_recording(state);
+    }
+
+    state.m_playing = false;
+    state.m_stream_stopped_event_pending = true;
+    return true;
+}
+
+// Cancels a time stretch, if any, and discards its clips
+static void stop_time_stretch(s_engine_state &state) {
+    if (state.m_time_stretch_thread) {
+        state.m_time_stretch_terminate = true;
+        state.m_time_stretch_thread->join();
+        delete state.m_time_stretch_thread;
+        state.m_time_stretch_thread = nullptr;
+    }
+
+    state.m_time_stretch_tasks.clear();
+}
+
+static void set_clip_format(s_clip &clip, e_sample_format format) {
+    // A mapped clip's pages are backed by its file, so the OS can drop them again under memory pressure. A packed copy
+    // would be memory on top of the mapping that can't be reclaimed, so mapped clips are left as they are.
+    if (format == clip.m_format || clip.m_mapped_file) {
+        return;
+    }
+
+    size_t sample_count = clip.get_sample_count();
+    if (format == e_sample_format::k_float32) {
+        std::vector<float> samples(sample_count);
+        decode_samples(clip.get_mix_source(), 0, sample_count, samples.data());
+        clip.m_samples.swap(samples);
+        std::vector<uint16_t>().swap(clip.m_packed_samples);
+        clip.m_packed_scale = 1.0f;
+        clip.m_format = format;
+        return;
+    }
+
+    std::vector<float> decoded_samples;
+    const float *samples = clip.get_float_samples(decoded_samples);
+    std::vector<uint16_t> packed_samples(sample_count);
+    float scale = encode_samples(samples, sample_count, format, packed_samples.data());
+    clip.m_packed_samples.swap(packed_samples);
+    clip.m_packed_scale = scale;
+    clip.m_format = format;
+    std::vector<float>().swap(clip.m_samples);
+}
+
+// Computes the block levels of the playback's clips which don't have them yet, which are mapped clips being played for
+// the first time. Mixing is correct without levels, but the mixer can't skip silence and the buses aren't metered. The
+// render cache may still be mixing these clips, but it took their mix sources while they had no levels, so it never
+// reads the vectors written here.
+static void update_playback_clip_levels(s_engine_state &state) {
+    std::vector<s_clip *> clips;
+    for (const s_playback_clip &playback_clip : state.m_playback_clips) {
+        s_clip &clip = state.m_clips[playback_clip.m_clip_id];
+        if (clip.m_block_peaks.empty() && clip.get_sample_count() > 0) {
+            clips.push_back(&clip);
+        }
+    }
+
+    // Clips are often placed more than once
+    std::sort(clips.begin(), clips.end());
+    clips.erase(std::unique(clips.begin(), clips.end()), clips.end());
+    parallel_for(clips.size(), 0, [&](size_t i) { clips[i]->update_block_levels(); });
+}
+
+// Finds the event cursor and active clips by playing through the events up to sample_index
+static void find_playback_seek_point(s_engine_state &state, int32_t sample_index, s_playback_seek_point &seek_point) {
+    std::vector<bool> active(state.m_playback_clips.size(), false);
+    seek_point.m_next_playback_event_index = 0;
+    for (size_t i = 0; i < state.m_playback_events.size(); ++i) {
+        const s_playback_event &playback_event = state.m_playback_events[i];
+        if (playback_event.m_sample_index > sample_index) {
+            // This event occurs after our start sample, so don't process it or anything that comes after it
+            break;
+        }
+
+        active[playback_event.m_playback_clip_index] = playback_event.m_event == e_playback_event::k_start_clip;
+
+        // Advance to the next event
+        seek_point.m_next_playback_event_index++;
+    }
+
+    seek_point.m_active_playback_clip_indices.clear();
+    for (size_t i = 0; i < active.size(); ++i) {
+        if (active[i]) {
+            seek_point.m_active_playback_clip_indices.push_back(i);
+        }
+    }
+}
+
+static void seek_playback(s_engine_state &state, int32_t sample_index) {
+    // Go through all the clip events and clear them from the active list
+    state.m_first_active_playback_clip = nullptr;
+    state.m_active_playback_clip_count = 0;
+    for (size_t i = 0; i < state.m_playback_clips.size(); ++i) {
+        s_playback_clip &playback_clip = state.m_playback_clips[i];
+        playback_clip.m_prev_active_playback_clip = nullptr;
+        playback_clip.m_next_active_playback_clip = nullptr;
+    }
+
+    // Activate the appropriate playback clips for our starting point
+    update_bus_gains(state);
+    s_playback_seek_point seek_point;
+    find_playback_seek_point(state, sample_index, seek_point);
+    apply_playback_seek_point(state, seek_point);
+    state.m_playback_sample_index = sample_index;
+}
+
+// The active list must be empty
+static void apply_playback_seek_point(s_engine_state &state, const s_playback_seek_point &seek_point) {
+    for (size_t playback_clip_index : seek_point.m_active_playback_clip_indices) {
+        activate_playback_clip(state, playback_clip_index);
+    }
+
+    state.m_next_playback_event_index = seek_point.m_next_playback_event_index;
+}
+
+// Jumps from the loop end back to the loop start. Only the clips which are active need to be visited, so this is cheap
+// enough to do in the audio callback.
+static void wrap_playback_loop(s_engine_state &state) {
+    s_playback_clip *active_playback_clip = state.m_first_active_playback_clip;
+    while (active_playback_clip) {
+        s_playback_clip *next_active_playback_clip = active_playback_clip->m_next_active_playback_clip;
+        active_playback_clip->m_prev_active_playback_clip = nullptr;
+        active_playback_clip->m_next_active_playback_clip = nullptr;
+        active_playback_clip = next_active_playback_clip;
+    }
+
+    state.m_first_active_playback_clip = nullptr;
+    state.m_active_playback_clip_count = 0;
+    apply_playback_seek_point(state, state.m_loop_seek_point);
+    state.m_playback_sample_index = state.m_loop_start_sample_index;
+
+    // Find the next beat on the grid from the loop start. A click which is already sounding isn't cut off.
+    state.m_metronome_active_samples_per_beat = -1.0;
+
+    post_event(state, e_engine_event::k_loop_wrapped, state.m_loop_end_sample_index, state.m_loop_start_sample_index);
 }
 
-static void activate_playback_clip(size_t playback_clip_index) {
-    s_playback_clip &playback_clip = g_engine_state.m_playback_clips[playback_clip_index];
+static void activate_playback_clip(s_engine_state &state, size_t playback_clip_index) {
+    s_playback_clip &playback_clip = state.m_playback_clips[playback_clip_index];
     assert(playback_clip.m_prev_active_playback_clip == nullptr);
     assert(playback_clip.m_next_active_playback_clip == nullptr);
 
-    if (g_engine_state.m_first_active_playback_clip != nullptr) {
-        g_engine_state.m_first_active_playback_clip->m_prev_active_playback_clip = &playback_clip;
-        playback_clip.m_next_active_playback_clip = g_engine_state.m_first_active_playback_clip;
+    if (state.m_first_active_playback_clip != nullptr) {
+        state.m_first_active_playback_clip->m_prev_active_playback_clip = &playback_clip;
+        playback_clip.m_next_active_playback_clip = state.m_first_active_playback_clip;
     }
 
-    g_engine_state.m_first_active_playback_clip = &playback_clip;
+    state.m_first_active_playback_clip = &playback_clip;
+
+    // Clips start at their target gain, there's nothing playing to ramp from
+    playback_clip.m_target_gain = get_playback_clip_target_gain(state, playback_clip);
+    playback_clip.m_current_gain = playback_clip.m_target_gain;
+
+    state.m_active_playback_clip_count++;
+    if (state.m_active_playback_clip_count > state.m_stats.m_active_clip_high_water) {
+        state.m_stats.m_active_clip_high_water = state.m_active_playback_clip_count;
+    }
 }
 
-static void deactivate_playback_clip(size_t playback_clip_index) {
-    s_playback_clip &playback_clip = g_engine_state.m_playback_clips[playback_clip_index];
+static void deactivate_playback_clip(s_engine_state &state, size_t playback_clip_index) {
+    s_playback_clip &playback_clip = state.m_playback_clips[playback_clip_index];
 
     if (playback_clip.m_prev_active_playback_clip == nullptr) {
-        g_engine_state.m_first_active_playback_clip = playback_clip.m_next_active_playback_clip;
+        state.m_first_active_playback_clip = playback_clip.m_next_active_playback_clip;
     } else {
         playback_clip.m_prev_active_playback_clip->m_next_active_playback_clip = playback_clip.m_next_active_playback_clip;
     }
@@ -928,6 +3134,170 @@ static void deactivate_playback_clip(size_t playback_clip_index) {
 
     playback_clip.m_prev_active_playback_clip = nullptr;
     playback_clip.m_next_active_playback_clip = nullptr;
+
+    state.m_active_playback_clip_count--;
+}
+
+// Snapshots the buses and computes the gain each active clip should reach by the end of the callback
+static void update_bus_gains(s_engine_state &state) {
+    bool solo_active = false;
+    for (s_bus &bus : state.m_buses) {
+        bool muted = bus.m_muted.load(std::memory_order_relaxed);
+        bus.m_block_gain = muted ? 0.0f : bus.m_gain.load(std::memory_order_relaxed);
+        bus.m_block_soloed = !muted && bus.m_soloed.load(std::memory_order_relaxed);
+        solo_active |= bus.m_block_soloed;
+    }
+
+    state.m_solo_active = solo_active;
+
+    s_playback_clip *playback_clip = state.m_first_active_playback_clip;
+    while (playback_clip) {
+        playback_clip->m_target_gain = get_playback_clip_target_gain(state, *playback_clip);
+        playback_clip = playback_clip->m_next_active_playback_clip;
+    }
+}
+
+static float get_playback_clip_target_gain(s_engine_state &state, const s_playback_clip &playback_clip) {
+    // While anything is soloed, only clips routed through a soloed bus are audible
+    float gain = playback_clip.m_gain;
+    bool soloed = false;
+    for (int32_t bus_index : playback_clip.m_bus_indices) {
+        const s_bus &bus = state.m_buses[bus_index];
+        gain *= bus.m_block_gain;
+        soloed |= bus.m_block_soloed;
+    }
+
+    return state.m_solo_active && !soloed ? 0.0f : gain;
+}
+
+// Splits the playback into segments and requests each one from the render cache, which renders new segments in the
+// background. Segments are keyed on the clips and gains within them, so edits only invalidate the segments they touch.
+static void update_render_cache(s_engine_state &state) {
+    state.m_render_cache_segments.clear();
+    state.m_render_cache.begin_update();
+
+    double samples_per_segment = state.m_render_cache_samples_per_segment;
+    if (samples_per_segment <= 0.0 || state.m_playback_clips.empty()) {
+        state.m_render_cache.end_update();
+        return;
+    }
+
+    // Segments are mixed with the buses as they are now, and are only valid until the buses change
+    state.m_render_cache_bus_version = state.m_bus_version;
+    update_bus_gains(state);
+
+    int32_t first_sample_index = INT32_MAX;
+    int32_t end_sample_index = INT32_MIN;
+    for (const s_playback_clip &playback_clip : state.m_playback_clips) {
+        int32_t clip_length = playback_clip.m_end_sample_index - playback_clip.m_start_sample_index;
+        first_sample_index = std::min(first_sample_index, playback_clip.m_playback_start_sample_index);
+        end_sample_index = std::max(end_sample_index, playback_clip.m_playback_start_sample_index + clip_length);
+    }
+
+    int64_t first_segment_index = static_cast<int64_t>(floor(first_sample_index / samples_per_segment));
+    int64_t end_segment_index = static_cast<int64_t>(ceil(end_sample_index / samples_per_segment));
+    size_t segment_count = static_cast<size_t>(std::max(end_segment_index - first_segment_index, int64_t(0)));
+    auto get_segment_start = [&](size_t segment_index) {
+        return static_cast<int32_t>(llround((first_segment_index + static_cast<int64_t>(segment_index)) * samples_per_segment));
+    };
+
+    std::vector<s_render_cache_key> keys(segment_count);
+    for (const s_playback_clip &playback_clip : state.m_playback_clips) {
+        float gain = get_playback_clip_target_gain(state, playback_clip);
+        int32_t clip_start_sample_index = playback_clip.m_playback_start_sample_index;
+        int32_t clip_end_sample_index =
+            clip_start_sample_index + playback_clip.m_end_sample_index - playback_clip.m_start_sample_index;
+        if (gain == 0.0f || clip_start_sample_index == clip_end_sample_index) {
+            continue;
+        }
+
+        // Estimate the first segment, then correct for rounding of the segment boundaries
+        size_t segment_index = static_cast<size_t>(std::max(
+            static_cast<int64_t>(floor(clip_start_sample_index / samples_per_segment)) - first_segment_index,
+            int64_t(0)));
+        while (segment_index > 0 && get_segment_start(segment_index) > clip_start_sample_index) {
+            segment_index--;
+        }
+
+        for (; segment_index < segment_count; ++segment_index) {
+            int32_t segment_start_sample_index = get_segment_start(segment_index);
+            int32_t segment_end_sample_index = get_segment_start(segment_index + 1);
+            if (segment_start_sample_index >= clip_end_sample_index) {
+                break;
+            }
+
+            int32_t overlap_start_sample_index = std::max(clip_start_sample_index, segment_start_sample_index);
+            int32_t overlap_end_sample_index = std::min(clip_end_sample_index, segment_end_sample_index);
+            if (overlap_start_sample_index >= overlap_end_sample_index) {
+                continue;
+            }
+
+            s_render_cache_clip render_cache_clip;
+            render_cache_clip.m_clip_id = playback_clip.m_clip_id;
+            render_cache_clip.m_clip_sample_index =
+                playback_clip.m_start_sample_index + overlap_start_sample_index - clip_start_sample_index;
+            render_cache_clip.m_segment_offset = overlap_start_sample_index - segment_start_sample_index;
+            render_cache_clip.m_sample_count = overlap_end_sample_index - overlap_start_sample_index;
+            render_cache_clip.m_gain = gain;
+            keys[segment_index].m_clips.push_back(render_cache_clip);
+        }
+    }
+
+    // Silent segments are left out, there's nothing to mix there anyway
+    std::vector<s_mix_source> clip_sources;
+    for (size_t segment_index = 0; segment_index < segment_count; ++segment_index) {
+        s_render_cache_key &key = keys[segment_index];
+        if (key.m_clips.empty()) {
+            continue;
+        }
+
+        s_render_cache_segment segment;
+        segment.m_start_sample_index = get_segment_start(segment_index);
+        segment.m_end_sample_index = get_segment_start(segment_index + 1);
+        key.m_sample_count = segment.m_end_sample_index - segment.m_start_sample_index;
+        std::sort(key.m_clips.begin(), key.m_clips.end());
+
+        clip_sources.clear();
+        for (const s_render_cache_clip &render_cache_clip : key.m_clips) {
+            clip_sources.push_back(state.m_clips[render_cache_clip.m_clip_id].get_mix_source());
+        }
+
+        segment.m_entry = state.m_render_cache.request(key, clip_sources);
+        state.m_render_cache_segments.push_back(segment);
+    }
+
+    state.m_render_cache.end_update();
+}
+
+// Returns the render cache segment containing sample_index, or null if there isn't one. end_sample_index is clamped so
+// that the range starting at sample_index doesn't cross a segment boundary.
+static const s_render_cache_segment *find_render_cache_segment(
+    s_engine_state &state,
+    int32_t sample_index,
+    int32_t &end_sample_index) {
+    const std::vector<s_render_cache_segment> &segments = state.m_render_cache_segments;
+    auto it = std::upper_bound(
+        segments.begin(),
+        segments.end(),
+        sample_index,
+        [](int32_t sample_index, const s_render_cache_segment &segment) {
+            return sample_index < segment.m_start_sample_index;
+        });
+    if (it != segments.end()) {
+        end_sample_index = std::min(end_sample_index, it->m_start_sample_index);
+    }
+
+    if (it == segments.begin()) {
+        return nullptr;
+    }
+
+    --it;
+    if (sample_index >= it->m_end_sample_index) {
+        return nullptr;
+    }
+
+    end_sample_index = std::min(end_sample_index, it->m_end_sample_index);
+    return &*it;
 }
 
 int recording_stream_main(
@@ -937,23 +3307,42 @@ int recording_stream_main(
     const PaStreamCallbackTimeInfo *time_info,
     PaStreamCallbackFlags status_flags,
     void *user_data) {
+    s_engine_state &state = *static_cast<s_engine_state *>(user_data);
+    std::chrono::steady_clock::time_point start_time = std::chrono::steady_clock::now();
+    trace(state, e_trace_phase::k_begin, e_trace_event_name::k_recording_callback, static_cast<int32_t>(frame_count));
+    record_callback_flags(state, status_flags);
+    publish_playback_timestamp(state, time_info, frame_count);
+
     float *output_buffer = reinterpret_cast<float *>(output);
     memset(output_buffer, 0, frame_count * sizeof(float));
 
-    add_metronome_track(output_buffer, frame_count);
+    add_metronome_track(state, output_buffer, frame_count);
 
-    s_recording_buffer *recording_buffer = g_engine_state.m_current_recording_buffer;
+    float peak;
+    float sum_of_squares;
+    measure_levels(static_cast<const float *>(input), frame_count, peak, sum_of_squares);
+    update_meter(state.m_input_meter, peak, sum_of_squares, frame_count);
+    measure_levels(output_buffer, frame_count, peak, sum_of_squares);
+    update_meter(state.m_output_meter, peak, sum_of_squares, frame_count);
+
+    trace(state, e_trace_phase::k_begin, e_trace_event_name::k_recording_copy);
+    s_recording_buffer *recording_buffer = state.m_current_recording_buffer;
 
     // Start out by skipping frames if necessary
-    size_t frame_index = std::min(static_cast<unsigned long>(g_engine_state.m_samples_until_recording_begins), frame_count);
-    g_engine_state.m_samples_until_recording_begins -= static_cast<int32_t>(frame_index);
+    size_t frame_index = std::min(static_cast<unsigned long>(state.m_samples_until_recording_begins), frame_count);
+    state.m_samples_until_recording_begins -= static_cast<int32_t>(frame_index);
     while (frame_index < frame_count) {
         size_t capacity = recording_buffer->m_samples.size();
         size_t usage = recording_buffer->m_usage;
         if (usage == capacity) {
             recording_buffer = recording_buffer->m_next;
             if (!recording_buffer) {
-                ++g_engine_state.m_recording_underflows;
+                state.m_stats.m_recording_underflows++;
+                post_event(
+                    state,
+                    e_engine_event::k_recording_underflow,
+                    state.m_playback_sample_index,
+                    static_cast<int32_t>(frame_count - frame_index));
                 break;
             }
 
@@ -969,12 +3358,29 @@ int recording_stream_main(
 
         // Don't increment usage until after we've copied data to make sure it's only exposed after it's valid
         recording_buffer->m_usage += copy_amount;
+
+        // The allocator should have the next buffer ready well before the padding runs out
+        size_t remaining = capacity - usage;
+        if (!recording_buffer->m_low_reported
+            && !recording_buffer->m_next
+            && remaining < state.m_recording_allocator.get_recording_buffer_padding() / 2) {
+            recording_buffer->m_low_reported = true;
+            post_event(
+                state,
+                e_engine_event::k_recording_buffer_low,
+                state.m_playback_sample_index,
+                static_cast<int32_t>(remaining));
+        }
     }
 
     // Update the current recording buffer for the next callback
-    g_engine_state.m_current_recording_buffer = recording_buffer;
+    state.m_current_recording_buffer = recording_buffer;
+    trace(state, e_trace_phase::k_end, e_trace_event_name::k_recording_copy);
+
+    state.m_playback_sample_index += static_cast<int32_t>(frame_count);
 
-    g_engine_state.m_playback_sample_index += static_cast<int32_t>(frame_count);
+    record_callback_duration(state, start_time, frame_count);
+    trace(state, e_trace_phase::k_end, e_trace_event_name::k_recording_callback);
     return paContinue;
 }
 
@@ -985,119 +3391,482 @@ int playback_stream_main(
     const PaStreamCallbackTimeInfo *time_info,
     PaStreamCallbackFlags status_flags,
     void *user_data) {
+    s_engine_state &state = *static_cast<s_engine_state *>(user_data);
+    std::chrono::steady_clock::time_point start_time = std::chrono::steady_clock::now();
+    trace(state, e_trace_phase::k_begin, e_trace_event_name::k_playback_callback, static_cast<int32_t>(frame_count));
+    record_callback_flags(state, status_flags);
+    publish_playback_timestamp(state, time_info, frame_count);
+
     // Zero the output buffer because we're going to accumulate clip samples
     float *output_buffer = reinterpret_cast<float *>(output);
     memset(output_buffer, 0, frame_count * sizeof(float));
 
-    add_metronome_track(output_buffer, frame_count);
+    for (s_bus &bus : state.m_buses) {
+        bus.m_block_peak = 0.0f;
+        bus.m_block_energy = 0.0f;
+    }
+
+    // If the loop end falls within this buffer, mix up to it, wrap back to the loop start, and carry on from there
+    size_t frame_index = 0;
+    while (frame_index < frame_count) {
+        size_t mix_frame_count = frame_count - frame_index;
+        int32_t sample_index = state.m_playback_sample_index;
+        int32_t loop_end_sample_index = state.m_loop_end_sample_index;
+        bool wrap = false;
+        if (loop_end_sample_index >= 0
+            && sample_index < loop_end_sample_index
+            && static_cast<size_t>(loop_end_sample_index - sample_index) <= mix_frame_count) {
+            mix_frame_count = static_cast<size_t>(loop_end_sample_index - sample_index);
+            wrap = true;
+        }
+
+        add_metronome_track(state, output_buffer + frame_index, mix_frame_count);
+        mix_playback(state, output_buffer + frame_index, mix_frame_count);
+        frame_index += mix_frame_count;
+
+        int32_t end_sample_index = state.m_playback_sample_index;
+        if (!state.m_playback_end_reported && end_sample_index >= state.m_playback_end_sample_index) {
+            state.m_playback_end_reported = true;
+            post_event(state, e_engine_event::k_playback_end, end_sample_index);
+        }
+
+        if (wrap) {
+            wrap_playback_loop(state);
+        }
+    }
+
+    mix_preview(state, output_buffer, frame_count);
+
+    for (s_bus &bus : state.m_buses) {
+        update_meter(bus.m_meter, bus.m_block_peak, bus.m_block_energy, frame_count);
+    }
+
+    float peak;
+    float sum_of_squares;
+    measure_levels(output_buffer, frame_count, peak, sum_of_squares);
+    update_meter(state.m_output_meter, peak, sum_of_squares, frame_count);
+
+    record_callback_duration(state, start_time, frame_count);
+    trace(state, e_trace_phase::k_end, e_trace_event_name::k_playback_callback);
+    return paContinue;
+}
+
+// Adds frame_count samples of the playback at the current playback sample index to output and advances the index
+static void mix_playback(s_engine_state &state, float *output, size_t frame_count) {
+    update_bus_gains(state);
 
-    int32_t current_sample_index = g_engine_state.m_playback_sample_index;
+    bool render_cache_valid =
+        state.m_render_cache_bus_version == state.m_bus_version.load(std::memory_order_relaxed);
+
+    int32_t current_sample_index = state.m_playback_sample_index;
     int32_t end_sample_index = current_sample_index + static_cast<int32_t>(frame_count);
-    int32_t output_buffer_offset = 0;
+    int32_t output_offset = 0;
     while (current_sample_index < end_sample_index) {
-        // Phase 1: determine how many samples we can process before an event occurs
+        // Phase 1: determine how many samples we can process before an event occurs or a render cache segment begins
+        // or ends
         int32_t iteration_end_sample_index = end_sample_index;
+        const s_render_cache_segment *render_cache_segment = render_cache_valid
+            ? find_render_cache_segment(state, current_sample_index, iteration_end_sample_index)
+            : nullptr;
+
         const s_playback_event *next_playback_event = nullptr;
-        if (g_engine_state.m_next_playback_event_index < g_engine_state.m_playback_events.size()) {
-            next_playback_event = &g_engine_state.m_playback_events[g_engine_state.m_next_playback_event_index];
-            if (next_playback_event->m_sample_index < end_sample_index) {
+        if (state.m_next_playback_event_index < state.m_playback_events.size()) {
+            next_playback_event = &state.m_playback_events[state.m_next_playback_event_index];
+            if (next_playback_event->m_sample_index < iteration_end_sample_index) {
                 iteration_end_sample_index = next_playback_event->m_sample_index;
             } else {
                 next_playback_event = nullptr; // Ignore it for now, we won't process any samples for this event
             }
         }
 
-        // Phase 2: accumulate data from clips into the output buffer
-        if (current_sample_index != iteration_end_sample_index) {
+        // Phase 2: accumulate data from clips into the output buffer, or copy it from the render cache if it's ready
+        accumulate_bus_levels(state, current_sample_index, iteration_end_sample_index - current_sample_index);
+        if (current_sample_index != iteration_end_sample_index
+            && render_cache_segment
+            && render_cache_segment->m_entry->m_ready.load(std::memory_order_acquire)) {
+            int32_t iteration_sample_count = iteration_end_sample_index - current_sample_index;
+            trace(state, e_trace_phase::k_begin, e_trace_event_name::k_cached_mix, iteration_sample_count);
+
+            const float *cached_samples = render_cache_segment->m_entry->m_samples.data()
+                + (current_sample_index - render_cache_segment->m_start_sample_index);
+            for (int32_t i = 0; i < iteration_sample_count; ++i) {
+                output[output_offset + i] += cached_samples[i];
+            }
+
+            current_sample_index = iteration_end_sample_index;
+            output_offset += iteration_sample_count;
+            trace(state, e_trace_phase::k_end, e_trace_event_name::k_cached_mix);
+        } else if (current_sample_index != iteration_end_sample_index) {
             int32_t iteration_sample_count = iteration_end_sample_index - current_sample_index;
+            trace(state, e_trace_phase::k_begin, e_trace_event_name::k_mix, iteration_sample_count);
 
-            const s_playback_clip *playback_clip = g_engine_state.m_first_active_playback_clip;
+            const s_playback_clip *playback_clip = state.m_first_active_playback_clip;
             while (playback_clip) {
-                const s_clip &clip = g_engine_state.m_clips[playback_clip->m_clip_id];
+                const s_clip &clip = state.m_clips[playback_clip->m_clip_id];
                 int32_t clip_start_sample =
                     current_sample_index - playback_clip->m_playback_start_sample_index + playback_clip->m_start_sample_index;
-                for (int32_t i = 0; i < iteration_sample_count; ++i) {
-                    output_buffer[output_buffer_offset + i] += clip.m_samples[clip_start_sample + i] * playback_clip->m_gain;
-                }
+
+                // Ramp linearly if the gain is changing so the target is reached on the last sample of the callback
+                float gain_step = (playback_clip->m_target_gain - playback_clip->m_current_gain) / static_cast<float>(frame_count);
+                mix_samples(
+                    output + output_offset,
+                    clip.get_mix_source(),
+                    static_cast<size_t>(clip_start_sample),
+                    static_cast<size_t>(iteration_sample_count),
+                    playback_clip->m_current_gain + gain_step * static_cast<float>(output_offset),
+                    gain_step);
 
                 playback_clip = playback_clip->m_next_active_playback_clip;
             }
 
             current_sample_index = iteration_end_sample_index;
-            output_buffer_offset += iteration_sample_count;
+            output_offset += iteration_sample_count;
+            trace(state, e_trace_phase::k_end, e_trace_event_name::k_mix);
         }
 
         // Phase 3: process the next event to activate or deactivate clips
         if (next_playback_event != nullptr) {
             // Activate or deactivate the clip associated with this event
+            int32_t playback_clip_index = static_cast<int32_t>(next_playback_event->m_playback_clip_index);
             if (next_playback_event->m_event == e_playback_event::k_start_clip) {
-                activate_playback_clip(next_playback_event->m_playback_clip_index);
+                trace(state, e_trace_phase::k_instant, e_trace_event_name::k_clip_start, playback_clip_index);
+                activate_playback_clip(state, next_playback_event->m_playback_clip_index);
             } else {
                 assert(next_playback_event->m_event == e_playback_event::k_stop_clip);
-                deactivate_playback_clip(next_playback_event->m_playback_clip_index);
+                trace(state, e_trace_phase::k_instant, e_trace_event_name::k_clip_stop, playback_clip_index);
+                deactivate_playback_clip(state, next_playback_event->m_playback_clip_index);
             }
 
             // Advance to the next event
-            ++g_engine_state.m_next_playback_event_index;
+            ++state.m_next_playback_event_index;
         }
     }
 
-    g_engine_state.m_playback_sample_index = end_sample_index;
-    return paContinue;
+    state.m_playback_sample_index = end_sample_index;
+
+    s_playback_clip *active_playback_clip = state.m_first_active_playback_clip;
+    while (active_playback_clip) {
+        active_playback_clip->m_current_gain = active_playback_clip->m_target_gain;
+        active_playback_clip = active_playback_clip->m_next_active_playback_clip;
+    }
 }
 
-static void add_metronome_track(float *output, size_t frame_count) {
-    double metronome_samples_per_beat = g_engine_state.m_metronome_samples_per_beat;
-    if (metronome_samples_per_beat == 0.0) {
-        g_engine_state.m_metronome_sample = INT32_MAX;
+// Bus levels are estimated from the block levels of their clips rather than measured from mixed samples, since clips are
+// mixed straight into the output (or come from the render cache already mixed). A bus's peak is an upper bound: each
+// clip contributes the highest peak of the blocks overlapping the callback, and the peaks of clips playing together are
+// summed as if they all peaked at once. Energies are summed too, which assumes the clips are uncorrelated.
+static void accumulate_bus_levels(s_engine_state &state, int32_t sample_index, int32_t sample_count) {
+    if (sample_count <= 0 || state.m_buses.empty()) {
+        return;
+    }
+
+    const s_playback_clip *playback_clip = state.m_first_active_playback_clip;
+    while (playback_clip) {
+        const s_clip &clip = state.m_clips[playback_clip->m_clip_id];
+        if (!playback_clip->m_bus_indices.empty() && !clip.m_block_peaks.empty()) {
+            size_t clip_start_sample = static_cast<size_t>(
+                sample_index - playback_clip->m_playback_start_sample_index + playback_clip->m_start_sample_index);
+            size_t clip_end_sample = clip_start_sample + static_cast<size_t>(sample_count);
+            float peak = 0.0f;
+            float energy = 0.0f;
+            for (size_t block_index = clip_start_sample / k_peak_block_size;
+                block_index * k_peak_block_size < clip_end_sample;
+                ++block_index) {
+                size_t block_start = std::max(block_index * k_peak_block_size, clip_start_sample);
+                size_t block_end = std::min((block_index + 1) * k_peak_block_size, clip_end_sample);
+                peak = std::max(peak, clip.m_block_peaks[block_index]);
+                energy += clip.m_block_mean_squares[block_index] * static_cast<float>(block_end - block_start);
+            }
+
+            float gain = std::abs(playback_clip->m_target_gain);
+            for (int32_t bus_index : playback_clip->m_bus_indices) {
+                s_bus &bus = state.m_buses[bus_index];
+                bus.m_block_peak += peak * gain;
+                bus.m_block_energy += energy * gain * gain;
+            }
+        }
+
+        playback_clip = playback_clip->m_next_active_playback_clip;
     }
+}
 
-    double sample_sine_multiplier =
-        k_metronome_pitch_hz * 2.0 * k_pi / static_cast<double>(g_engine_state.m_sample_rate);
+static void update_meter(s_meter &meter, float peak, float sum_of_squares, size_t sample_count) {
+    meter.m_rms.store(sqrtf(sum_of_squares / static_cast<float>(sample_count)), std::memory_order_relaxed);
 
-    int32_t metronome_sample_count = static_cast<int32_t>(k_metronome_time_seconds * g_engine_state.m_sample_rate);
+    // Hold the highest peak since get_meters last took it
+    float held_peak = meter.m_peak.load(std::memory_order_relaxed);
+    while (peak > held_peak && !meter.m_peak.compare_exchange_weak(held_peak, peak, std::memory_order_relaxed)) {}
+}
 
-    int32_t current_sample_index = g_engine_state.m_playback_sample_index;
-    size_t frame_index = 0;
-    while (frame_index < frame_count) {
-        // Determine the next metronome sample and process up to that point
-        int32_t next_metronome_sample_index;
-        if (metronome_samples_per_beat == 0.0) {
-            // The next metronome sample never occurs
-            next_metronome_sample_index = current_sample_index + static_cast<int32_t>(frame_count) + 1;
-        } else {
-            double last_beat_index = floor(static_cast<double>(current_sample_index) / metronome_samples_per_beat);
-            int32_t last_metronome_sample_index = static_cast<int32_t>(floor(last_beat_index * metronome_samples_per_beat));
-            if (current_sample_index == last_metronome_sample_index) {
-                // This next sample the one we just fell on, process it immediately
-                next_metronome_sample_index = last_metronome_sample_index;
-            } else {
-                double next_beat_index = last_beat_index + 1.0;
-                next_metronome_sample_index = static_cast<int32_t>(floor(next_beat_index * metronome_samples_per_beat));
-            }
+static void reset_meters(s_engine_state &state) {
+    for (s_meter *meter : { &state.m_input_meter, &state.m_output_meter }) {
+        meter->m_peak = 0.0f;
+        meter->m_rms = 0.0f;
+    }
+
+    for (s_bus &bus : state.m_buses) {
+        bus.m_meter.m_peak = 0.0f;
+        bus.m_meter.m_rms = 0.0f;
+    }
+}
+
+static void mix_preview(s_engine_state &state, float *output, size_t frame_count) {
+    // Only the latest command matters
+    s_preview_command command;
+    bool command_received = false;
+    while (state.m_preview_commands.pop(command)) {
+        command_received = true;
+    }
+
+    s_preview_voice &voice = state.m_preview_voice;
+    if (command_received) {
+        voice.m_active = command.m_start;
+        voice.m_source = command.m_source;
+        voice.m_sample_index = command.m_start_sample_index;
+        voice.m_end_sample_index = command.m_end_sample_index;
+        voice.m_gain = command.m_gain;
+    }
+
+    if (!voice.m_active) {
+        return;
+    }
+
+    size_t sample_count = std::min(frame_count, static_cast<size_t>(voice.m_end_sample_index - voice.m_sample_index));
+    trace(state, e_trace_phase::k_begin, e_trace_event_name::k_preview, static_cast<int32_t>(sample_count));
+    mix_samples(output, voice.m_source, static_cast<size_t>(voice.m_sample_index), sample_count, voice.m_gain);
+    voice.m_sample_index += static_cast<int32_t>(sample_count);
+    if (voice.m_sample_index >= voice.m_end_sample_index) {
+        voice.m_active = false;
+    }
+
+    trace(state, e_trace_phase::k_end, e_trace_event_name::k_preview);
+}
+
+static void trace(s_engine_state &state, e_trace_phase phase, e_trace_event_name name, int32_t argument) {
+    if (state.m_trace_enabled.load(std::memory_order_relaxed)) {
+        s_trace_event event = { get_trace_time(), phase, static_cast<uint8_t>(name), argument };
+        state.m_trace_ring.push(event);
+    }
+}
+
+static void post_event(s_engine_state &state, e_engine_event event, int32_t sample_index, int32_t argument) {
+    s_engine_event engine_event = { event, sample_index, argument };
+    state.m_event_ring.push(engine_event);
+}
+
+static void record_callback_flags(s_engine_state &state, PaStreamCallbackFlags status_flags) {
+    // Other flags, like paPrimingOutput, don't mean anything was lost
+    PaStreamCallbackFlags xrun_flags =
+        status_flags & (paInputUnderflow | paInputOverflow | paOutputUnderflow | paOutputOverflow);
+    if (xrun_flags != 0) {
+        post_event(state, e_engine_event::k_xrun, state.m_playback_sample_index, static_cast<int32_t>(xrun_flags));
+    }
+
+    s_engine_stats &stats = state.m_stats;
+    if (status_flags & paInputUnderflow) {
+        stats.m_input_underflows++;
+    }
+
+    if (status_flags & paInputOverflow) {
+        stats.m_input_overflows++;
+    }
+
+    if (status_flags & paOutputUnderflow) {
+        stats.m_output_underflows++;
+    }
+
+    if (status_flags & paOutputOverflow) {
+        stats.m_output_overflows++;
+    }
+}
+
+// Must be called before the stream starts
+static void reset_playback_timestamp(s_engine_state &state, int32_t sample_index) {
+    state.m_playback_first_sample_index = sample_index;
+    state.m_playback_frame_index = 0;
+    state.m_playback_timestamp_frame_index = 0;
+    state.m_playback_timestamp_frame_count = 0;
+    state.m_playback_timestamp_time = INT64_MIN;
+}
+
+static void publish_playback_timestamp(
+    s_engine_state &state,
+    const PaStreamCallbackTimeInfo *time_info,
+    unsigned long frame_count) {
+    // Portaudio's times are on the stream's own clock, so only the distance from now to the DAC time is used. Some
+    // host APIs report 0 when they don't know it.
+    double output_latency = 0.0;
+    if (time_info && time_info->outputBufferDacTime > time_info->currentTime) {
+        output_latency = time_info->outputBufferDacTime - time_info->currentTime;
+    }
+
+    int64_t time = get_trace_time() + static_cast<int64_t>(output_latency * 1e9);
+    int64_t frame_index = state.m_playback_frame_index;
+    state.m_playback_frame_index += static_cast<int64_t>(frame_count);
+
+    // An odd sequence number tells readers that a write is in progress
+    uint32_t sequence = state.m_playback_timestamp_sequence.load(std::memory_order_relaxed);
+    state.m_playback_timestamp_sequence.store(sequence + 1, std::memory_order_relaxed);
+    std::atomic_thread_fence(std::memory_order_release);
+    state.m_playback_timestamp_frame_index.store(frame_index, std::memory_order_relaxed);
+    state.m_playback_timestamp_frame_count.store(static_cast<int32_t>(frame_count), std::memory_order_relaxed);
+    state.m_playback_timestamp_time.store(time, std::memory_order_relaxed);
+    state.m_playback_timestamp_sequence.store(sequence + 2, std::memory_order_release);
+}
+
+// Returns false if no callback has published a timestamp yet
+static bool read_playback_timestamp(s_engine_state &state, int64_t &frame_index, int32_t &frame_count, int64_t &time) {
+    while (true) {
+        uint32_t sequence = state.m_playback_timestamp_sequence.load(std::memory_order_acquire);
+        if (sequence & 1) {
+            continue;
+        }
+
+        frame_index = state.m_playback_timestamp_frame_index.load(std::memory_order_relaxed);
+        frame_count = state.m_playback_timestamp_frame_count.load(std::memory_order_relaxed);
+        time = state.m_playback_timestamp_time.load(std::memory_order_relaxed);
+        std::atomic_thread_fence(std::memory_order_acquire);
+        if (state.m_playback_timestamp_sequence.load(std::memory_order_relaxed) == sequence) {
+            return time != INT64_MIN;
+        }
+    }
+}
+
+static void record_callback_duration(
+    s_engine_state &state,
+    std::chrono::steady_clock::time_point start_time,
+    unsigned long frame_count) {
+    std::chrono::duration<double> duration = std::chrono::steady_clock::now() - start_time;
+    double buffer_period = static_cast<double>(frame_count) / static_cast<double>(state.m_sample_rate);
+    double fraction = duration.count() / buffer_period;
+
+    // The audio thread is the only writer, so plain loads and stores are enough for the min and max
+    s_engine_stats &stats = state.m_stats;
+    uint64_t scaled_fraction = static_cast<uint64_t>(fraction * k_stats_duration_scale);
+    stats.m_callback_count++;
+    stats.m_total_callback_duration += scaled_fraction;
+    if (scaled_fraction < stats.m_min_callback_duration.load(std::memory_order_relaxed)) {
+        stats.m_min_callback_duration.store(scaled_fraction, std::memory_order_relaxed);
+    }
+
+    if (scaled_fraction > stats.m_max_callback_duration.load(std::memory_order_relaxed)) {
+        stats.m_max_callback_duration.store(scaled_fraction, std::memory_order_relaxed);
+    }
+
+    size_t bucket = std::min(
+        static_cast<size_t>(fraction / k_stats_histogram_bucket_width),
+        k_stats_histogram_bucket_count - 1);
+    stats.m_callback_duration_histogram[bucket]++;
+}
+
+static void render_metronome_click(int32_t sample_rate, double pitch_hz, size_t sample_count, std::vector<float> &click) {
+    double sample_sine_multiplier = pitch_hz * 2.0 * k_pi / static_cast<double>(sample_rate);
+    click.resize(sample_count);
+    for (size_t i = 0; i < sample_count; ++i) {
+        click[i] = static_cast<float>(sin(static_cast<double>(i) * sample_sine_multiplier) * k_metronome_amplitude);
+    }
+}
+
+// Called before a stream starts: renders the clicks if the sample rate has changed and resets the audio thread state
+static void reset_metronome(s_engine_state &state) {
+    if (state.m_metronome_click_sample_rate != state.m_sample_rate) {
+        size_t sample_count = static_cast<size_t>(k_metronome_time_seconds * state.m_sample_rate);
+        render_metronome_click(state.m_sample_rate, k_metronome_pitch_hz, sample_count, state.m_metronome_click);
+        render_metronome_click(
+            state.m_sample_rate,
+            k_metronome_accented_pitch_hz,
+            sample_count,
+            state.m_metronome_accented_click);
+        state.m_metronome_click_sample_rate = state.m_sample_rate;
+    }
+
+    // The audio thread isn't running yet, so the settings can be read directly
+    state.m_metronome_block_samples_per_beat = state.m_metronome_samples_per_beat;
+    state.m_metronome_block_beats_per_measure = state.m_metronome_beats_per_measure;
+    state.m_metronome_active_samples_per_beat = -1.0;
+    state.m_metronome_click_samples = nullptr;
+    state.m_metronome_click_length = 0;
+    state.m_metronome_sample = 0;
+}
+
+static void add_metronome_track(s_engine_state &state, float *output, size_t frame_count) {
+    trace(state, e_trace_phase::k_begin, e_trace_event_name::k_metronome);
+
+    // If the settings are being written right now, keep using the last ones read rather than waiting for the writer
+    uint32_t sequence = state.m_metronome_settings_sequence.load(std::memory_order_acquire);
+    if (!(sequence & 1)) {
+        double new_samples_per_beat = state.m_metronome_samples_per_beat.load(std::memory_order_relaxed);
+        int32_t new_beats_per_measure = state.m_metronome_beats_per_measure.load(std::memory_order_relaxed);
+        std::atomic_thread_fence(std::memory_order_acquire);
+        if (state.m_metronome_settings_sequence.load(std::memory_order_relaxed) == sequence) {
+            state.m_metronome_block_samples_per_beat = new_samples_per_beat;
+            state.m_metronome_block_beats_per_measure = new_beats_per_measure;
         }
+    }
+
+    double samples_per_beat = state.m_metronome_block_samples_per_beat;
+    int32_t beats_per_measure = state.m_metronome_block_beats_per_measure;
+    int64_t first_sample_index = state.m_playback_sample_index;
+    int64_t end_sample_index = first_sample_index + static_cast<int64_t>(frame_count);
 
-        int32_t samples_to_process;
-        if (current_sample_index == next_metronome_sample_index) {
-            g_engine_state.m_metronome_sample = 0;
-            samples_to_process = 1; // Advance by 1 sample and loop in order to find the next metronome sample index
+    if (samples_per_beat != state.m_metronome_active_samples_per_beat) {
+        // The tempo changed (or the stream just started) so find the next beat on the new grid. From then on, beats are
+        // found by accumulating samples_per_beat.
+        state.m_metronome_active_samples_per_beat = samples_per_beat;
+        if (samples_per_beat > 0.0) {
+            double next_beat_index = ceil(static_cast<double>(first_sample_index) / samples_per_beat);
+            state.m_metronome_next_beat_index = static_cast<int64_t>(next_beat_index);
+            state.m_metronome_next_beat_sample = next_beat_index * samples_per_beat;
         } else {
-            samples_to_process = std::min(
-                next_metronome_sample_index - current_sample_index,
-                static_cast<int32_t>(frame_count - frame_index));
+            // Turning the metronome off silences a click which is still sounding
+            state.m_metronome_click_length = 0;
+            state.m_metronome_sample = 0;
+        }
+    }
+
+    size_t frame_index = 0;
+    while (frame_index < frame_count) {
+        // Mix the sounding click up to the next beat or the end of the buffer
+        size_t segment_end_frame_index = frame_count;
+        bool beat_starts = false;
+        if (samples_per_beat > 0.0) {
+            int64_t beat_sample_index = static_cast<int64_t>(state.m_metronome_next_beat_sample);
+            if (beat_sample_index < end_sample_index) {
+                segment_end_frame_index = static_cast<size_t>(std::max(beat_sample_index - first_sample_index, int64_t(0)));
+                segment_end_frame_index = std::max(segment_end_frame_index, frame_index);
+                beat_starts = true;
+            }
         }
 
-        int32_t metronome_sample = g_engine_state.m_metronome_sample;
-        for (int32_t i = 0; i < samples_to_process; ++i) {
-            if (metronome_sample < metronome_sample_count) {
-                output[frame_index] += static_cast<float>(
-                    sin(static_cast<double>(i) * sample_sine_multiplier) * k_metronome_amplitude);
-                ++metronome_sample;
+        int32_t click_sample = state.m_metronome_sample;
+        int32_t mix_count = std::min(
+            static_cast<int32_t>(segment_end_frame_index - frame_index),
+            state.m_metronome_click_length - click_sample);
+        if (mix_count > 0) {
+            const float *click_samples = state.m_metronome_click_samples + click_sample;
+            for (int32_t i = 0; i < mix_count; ++i) {
+                output[frame_index + i] += click_samples[i];
             }
-            ++frame_index;
-            ++current_sample_index;
+
+            state.m_metronome_sample = click_sample + mix_count;
         }
 
-        g_engine_state.m_metronome_sample = metronome_sample;
+        frame_index = segment_end_frame_index;
+
+        if (beat_starts) {
+            // Downbeats get the accented click. A click is cut off by the following beat.
+            bool accented = beats_per_measure > 0 && state.m_metronome_next_beat_index % beats_per_measure == 0;
+            const std::vector<float> &click = accented
+                ? state.m_metronome_accented_click
+                : state.m_metronome_click;
+            state.m_metronome_click_samples = click.data();
+            state.m_metronome_click_length = static_cast<int32_t>(
+                std::min(click.size(), static_cast<size_t>(std::max(samples_per_beat, 1.0))));
+            state.m_metronome_sample = 0;
+
+            state.m_metronome_next_beat_index++;
+            state.m_metronome_next_beat_sample += samples_per_beat;
+        }
     }
+    trace(state, e_trace_phase::k_end, e_trace_event_name::k_metronome);
 }
\ No newline at end of file
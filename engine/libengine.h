@@ -2,8 +2,28 @@
 
 #include <Python.h>
 
-// Initialize the engine
-PyObject *initialize(PyObject *self);
+struct s_engine_state;
+
+// engine.Engine: an engine with its own clips, playback and stream. Its methods are the functions below which don't
+// deal with initialization or devices, and the module-level versions of those functions operate on a default engine.
+// Engines are independent of each other, so they can be used from different threads, e.g. to render in parallel.
+struct s_engine_object {
+    PyObject_HEAD
+    s_engine_state *m_state;
+};
+
+extern PyTypeObject engine_type;
+
+// Creates an engine, which shares the devices set up by initialize
+PyObject *engine_new(PyTypeObject *type, PyObject *args, PyObject *kwargs);
+
+// Stops the engine's stream if one is running and frees the engine
+void engine_dealloc(PyObject *self);
+
+// Initialize the engine. If virtual_devices is True, a virtual input and output device are added after the hardware
+// devices (and become the defaults if there are no hardware defaults). They run streams without a sound card.
+// Arguments: virtual_devices=False
+PyObject *initialize(PyObject *self, PyObject *args);
 
 // Shutdown the engine
 PyObject *shutdown(PyObject *self);
@@ -34,26 +54,83 @@ PyObject *get_output_device_name(PyObject *self, PyObject *args);
 // Arguments: sample_rate
 PyObject *set_sample_rate(PyObject *self, PyObject *args);
 
-// Load a clip from a file
-// Arguments: filename
+// Converts every clip to a new sample rate using a multithreaded windowed-sinc resampler, then sets the sample rate.
+// Clip IDs are unchanged, so callers must rescale any sample positions they hold and treat every clip as modified.
+// Arguments: sample_rate
+PyObject *resample_clips(PyObject *self, PyObject *args);
+
+// Starts changing the length of clips without changing their pitch, e.g. to follow a tempo change. The clips are
+// stretched in the background using WSOLA, spread across a thread per core, and poll_events reports the progress. The
+// source clips are left untouched, but can't be deleted or changed until the stretch is finished or canceled.
+// Arguments: clip_ids, ratio (new length / old length)
+PyObject *start_time_stretch(PyObject *self, PyObject *args);
+
+// Waits for the running time stretch to finish and adds the stretched clips as new clips, in the order of the clip IDs
+// passed to start_time_stretch
+// Returns: [clip_id, ...]
+PyObject *finish_time_stretch(PyObject *self);
+
+// Stops the running time stretch, if any, and discards its clips
+PyObject *cancel_time_stretch(PyObject *self);
+
+// Load a clip from a wav or lossless clip file, detected from its contents. Wavs may be PCM or float with any number of
+// channels, which are downmixed to one. If memory_map is True, a single channel float wav is mapped and used directly
+// rather than being read into memory. Files at a different sample rate are resampled to the engine's sample rate.
+// Arguments: filename, memory_map=False
 // Returns: clip_id
 PyObject *load_clip(PyObject *self, PyObject *args);
 
-// Save a clip to a file
-// Arguments: clip_id, filename
+// Save a clip to a file, either as a float wav or, if compress is True, using the multithreaded lossless codec. The GIL
+// is released while writing so multiple clips can be saved in parallel. thread_count limits the threads the codec uses,
+// 0 for one per core; callers saving several clips in parallel should pass 1 so the threads don't multiply.
+// Arguments: clip_id, filename, compress=False, thread_count=0
 PyObject *save_clip(PyObject *self, PyObject *args);
 
+// Returns the JSON metadata stored in a project archive without loading any clips
+// Arguments: filename
+// Returns: metadata
+PyObject *get_archive_metadata(PyObject *self, PyObject *args);
+
+// Loads every clip in a project archive. The archive is mapped once and each clip is a view into the mapping.
+// Arguments: filename
+// Returns: {key: clip_id}
+PyObject *load_archive(PyObject *self, PyObject *args);
+
+// Saves clips and JSON metadata to a project archive. If filename is already an archive, only clips which aren't views
+// into it are written, appended to the end of the file. Afterwards every saved clip is a view into the archive.
+// Arguments: filename, metadata, [(key, clip_id), ...]
+PyObject *save_archive(PyObject *self, PyObject *args);
+
 // Deletes a clip
 // Arguments: clip_id
 PyObject *delete_clip(PyObject *self, PyObject *args);
 
+// Sets how a clip's samples are stored in memory: "float32" (the default), "int16" or "float16". The 16-bit formats
+// halve the memory used and read while mixing, at the cost of precision. int16 is scaled to the clip's peak and keeps
+// about 96dB of dynamic range below it, so it suits normally recorded takes and is as cheap to mix as float32. float16
+// keeps 11 bits of precision at every level (about 66dB signal to noise), so it suits clips with a wide range of
+// levels, but takes more work to decode while mixing. Converting a clip to a 16-bit format discards the extra precision
+// for good. Memory-mapped clips always stay "float32": the OS can page their samples back out to the file, whereas a
+// packed copy would add memory rather than save it. Saving a packed clip to an archive maps it, so it becomes "float32"
+// again with the same samples.
+// Arguments: clip_id, format
+PyObject *set_clip_storage_format(PyObject *self, PyObject *args);
+
+// Returns how a clip's samples are stored in memory
+// Arguments: clip_id
+// Returns: format
+PyObject *get_clip_storage_format(PyObject *self, PyObject *args);
+
 // Starts recording a clip
 // Arguments: input_device_index, output_device_index, frames_per_buffer
 // Returns: clip_id
 PyObject *start_recording_clip(PyObject *self, PyObject *args);
 
-// Stops the current recording
-PyObject *stop_recording_clip(PyObject *self);
+// Stops the current recording. If immediate is True, buffers which are queued to play are discarded rather than waiting
+// for them to drain. If wait is False, the stream is stopped on a background thread and this returns right away; the
+// engine counts as recording until is_stopping returns False.
+// Arguments: immediate=False, wait=True
+PyObject *stop_recording_clip(PyObject *self, PyObject *args);
 
 // Returns the number of samples that have been recorded
 // Returns: smaple_count
@@ -64,6 +141,12 @@ PyObject *get_recorded_sample_count(PyObject *self);
 // Returns: samples
 PyObject *get_latest_recorded_samples(PyObject *self, PyObject *args);
 
+// Returns the lowest and highest sample of each complete block of samples_per_block recorded samples, starting with
+// block first_block_index. Passing the number of blocks already received returns only the new ones.
+// Arguments: first_block_index, samples_per_block
+// Returns: [(min_sample, max_sample), ...]
+PyObject *get_recorded_peak_blocks(PyObject *self, PyObject *args);
+
 // Returns the number of samples in the clip
 // Arguments: clip_id
 // Returns: sample_count
@@ -74,27 +157,188 @@ PyObject *get_clip_sample_count(PyObject *self, PyObject *args);
 // Returns: samples
 PyObject *get_clip_samples(PyObject *self, PyObject *args);
 
+// Suggests how to trim a recorded take by finding where its sound begins and ends. Sample 0 is taken to be a downbeat.
+// has_intro is True if the first onset comes after the first downbeat and has_outro is True if nothing starts in the
+// last measure. At least one measure is left which is neither.
+// Arguments: clip_id, samples_per_measure
+// Returns: (start_sample_index, end_sample_index, has_intro, has_outro)
+PyObject *analyze_clip_boundaries(PyObject *self, PyObject *args);
+
 // Starts building playback
 PyObject *playback_builder_begin(PyObject *self);
 
-// Adds a clip to the current playback track
-// Arguments: clip_id, start_sample_index, end_sample_index, playback_start_sample_index, gain
+// Adds a bus to the current playback. Buses group clips (e.g. by track or category) so that their gain, mute and solo
+// can be changed during playback.
+// Arguments: gain=1.0, muted=False, soloed=False
+// Returns: bus_index
+PyObject *playback_builder_add_bus(PyObject *self, PyObject *args);
+
+// Adds a clip to the current playback track. The clip's gain is multiplied by the gain of each bus it's routed through,
+// it's silent if any of them are muted, and while any bus is soloed it's only audible if one of its buses is soloed.
+// Arguments: clip_id, start_sample_index, end_sample_index, playback_start_sample_index, gain, bus_indices=()
 PyObject *playback_builder_add_clip(PyObject *self, PyObject *args);
 
+// Enables the render cache for the current playback, which is split into segments of the given length (e.g. a measure).
+// When the playback is finalized, segments which aren't cached are mixed on a background thread, and playback copies
+// cached segments rather than mixing their clips. Segments are keyed on the clips and gains within them, so rebuilding
+// the playback after an edit only re-renders the segments the edit touched. Cached segments aren't used once a bus
+// changes during playback.
+// Arguments: samples_per_segment
+PyObject *playback_builder_enable_render_cache(PyObject *self, PyObject *args);
+
+// Sets the sample index at which playback reports a playback_end event. Defaults to the end of the last clip.
+// Arguments: end_sample_index
+PyObject *playback_builder_set_end_sample_index(PyObject *self, PyObject *args);
+
 // Finalizes the playback builder, allowing for playback to start
 PyObject *playback_builder_finalize(PyObject *self);
 
+// Returns how many of the current playback's render cache segments have been rendered
+// Returns: (ready_segment_count, segment_count)
+PyObject *get_render_cache_status(PyObject *self);
+
+// Frees all cached segments
+PyObject *clear_render_cache(PyObject *self);
+
 // Starts playback at the given sample index
 // Arguments: output_device_index, frames_per_buffer, sample_index
 PyObject *start_playback(PyObject *self, PyObject *args);
 
-// Stops playback
-PyObject *stop_playback(PyObject *self);
+// Stops playback. If immediate is True, buffers which are queued to play are discarded rather than waiting for them to
+// drain. If wait is False, the stream is stopped on a background thread and this returns right away; the engine counts
+// as playing until is_stopping returns False.
+// Arguments: immediate=False, wait=True
+PyObject *stop_playback(PyObject *self, PyObject *args);
 
-// Returns the current playback sample index
+// Returns whether a stop started with wait=False is still in progress. Once it has finished, the engine is no longer
+// playing or recording.
+// Returns: stopping
+PyObject *is_stopping(PyObject *self);
+
+// Blocks until a stop started with wait=False has finished. Does nothing if no stop is in progress.
+PyObject *wait_for_stop(PyObject *self);
+
+// Mixes the playback over [start_sample_index, end_sample_index) without a stream and returns the samples. Buses are
+// applied but the metronome isn't. The GIL is released while mixing, so engines can render in parallel from different
+// threads.
+// Arguments: start_sample_index, end_sample_index
+// Returns: samples
+PyObject *render_playback(PyObject *self, PyObject *args);
+
+// Auditions samples [start_sample_index, end_sample_index) of a clip over the running playback. The preview is a
+// separate one-shot voice which starts within one buffer and ignores buses. Starting a preview replaces the current one.
+// Arguments: clip_id, start_sample_index, end_sample_index, gain
+PyObject *preview_clip(PyObject *self, PyObject *args);
+
+// Stops the current preview, if any
+PyObject *stop_preview(PyObject *self);
+
+// Loops playback over [start_sample_index, end_sample_index). When playback reaches the end sample index it jumps back
+// to the start sample index within the same buffer, so there's no gap. Playback which starts at or past the end sample
+// index doesn't loop. The loop is kept across playback builds but can't be changed while playing, and render_playback
+// ignores it.
+// Arguments: start_sample_index, end_sample_index
+PyObject *set_loop(PyObject *self, PyObject *args);
+
+// Stops looping playback
+PyObject *clear_loop(PyObject *self);
+
+// Sets the gain of a bus. Can be changed during playback, taking effect within one buffer.
+// Arguments: bus_index, gain
+PyObject *set_bus_gain(PyObject *self, PyObject *args);
+
+// Mutes or unmutes a bus. Can be changed during playback, taking effect within one buffer.
+// Arguments: bus_index, muted
+PyObject *set_bus_muted(PyObject *self, PyObject *args);
+
+// Solos or unsolos a bus. Can be changed during playback, taking effect within one buffer.
+// Arguments: bus_index, soloed
+PyObject *set_bus_soloed(PyObject *self, PyObject *args);
+
+// Returns the current playback sample index. This counts the samples which have been handed to the device, so it moves
+// in buffer-sized steps and runs ahead of what can be heard by the output latency.
 // Returns: sample_index
 PyObject *get_playback_sample_index(PyObject *self);
 
-// Sets the metronome rate, or disables the metronome if 0.0 is provided
-// Arguments: samples_per_beat
+// Returns the fractional sample index which is audible at the given time, which uses the same clock as get_time and
+// defaults to now. Each callback records when its buffer will reach the output, and the position is extrapolated from
+// the latest of these, so it advances smoothly between callbacks and wraps with the loop. When not playing or recording,
+// this returns the playback sample index.
+// Arguments: time_seconds=None
+// Returns: sample_index
+PyObject *get_playback_position(PyObject *self, PyObject *args);
+
+// Removes and returns the events the audio thread has reported since the last call, in order, so the UI only needs to
+// make one call per frame. Events are:
+//   playback_end: playback passed the end sample index, reported once per start_playback
+//   xrun: the device reported an underflow or overflow, the argument holds portaudio's underflow and overflow flags
+//   recording_underflow: recording ran out of buffer space, the argument is the number of input samples lost
+//   recording_buffer_low: the recording buffer is nearly full with no next buffer ready, the argument is the space left
+//   loop_wrapped: playback reached the loop end and jumped back, the argument is the loop start sample index
+//   events_dropped: the event queue was full, the argument is the number of events lost
+//   stream_stopped: a stop started with wait=False has finished
+//   time_stretch_progress: more clips of the running time stretch are done, the argument is how many
+//   time_stretch_finished: every clip of the running time stretch is done, the argument is how many
+// Events from a previous stream are discarded when a new one starts.
+// Returns: [(name, sample_index, argument), ...]
+PyObject *poll_events(PyObject *self);
+
+// Sets the metronome rate, or disables the metronome if 0.0 is provided. If beats_per_measure is nonzero, the first beat
+// of each measure is accented. Can be changed during playback, and disabling it cuts off a click which is sounding.
+// Arguments: samples_per_beat, beats_per_measure=0
 PyObject *set_metronome_samples_per_beat(PyObject *self, PyObject *args);
+
+// Returns real-time performance counters, gathered since the engine started or since the last call to reset_stats.
+// Callback durations are fractions of the buffer period, so values approaching 1.0 are close to the deadline. Underflow
+// and overflow counts come from portaudio's callback status flags. recording_underflows counts callbacks which ran out
+// of recording buffer space and active_clip_high_water is the most clips which have been mixed at once.
+// Returns: {callback_count, callback_duration_min, callback_duration_avg, callback_duration_max,
+//   callback_duration_p99, input_underflows, input_overflows, output_underflows, output_overflows, recording_underflows,
+//   active_clip_high_water}
+PyObject *get_stats(PyObject *self);
+
+// Returns the levels measured by the audio thread as (peak, rms) pairs. input is only measured while recording. Each
+// peak is the highest since the last call, each rms covers the latest callback. Bus levels are estimated from the
+// levels of the clips routed through them, so a bus peak is an upper bound (the sum of its clips' peaks) rather than the
+// peak of the mixed bus.
+// Returns: {input, output, buses}
+PyObject *get_meters(PyObject *self);
+
+// Resets the performance counters returned by get_stats
+PyObject *reset_stats(PyObject *self);
+
+// Enables or disables recording timing events on the audio thread. Events go into a fixed-size lock-free ring, so
+// drain_trace must be called regularly while tracing; events which don't fit are dropped.
+// Arguments: enabled
+PyObject *set_trace_enabled(PyObject *self, PyObject *args);
+
+// Removes and returns all recorded trace events. Phases are 'B' (begin), 'E' (end) or 'i' (instant), and times use the
+// same clock as get_time.
+// Returns: [(time_seconds, phase, name, argument), ...]
+PyObject *drain_trace(PyObject *self);
+
+// Returns the current time in seconds on the clock used for trace events
+// Returns: time_seconds
+PyObject *get_time(PyObject *self);
+
+// Configures the virtual devices for the next stream. If realtime is True, callbacks are paced like a sound card,
+// otherwise they run back to back as fast as possible. If frame_limit is nonzero, callbacks stop after that many frames.
+// If capture_output is True, the output of streams with a frame limit is kept for get_virtual_output. Space for it is
+// allocated when the stream starts so the callbacks stay allocation free.
+// Arguments: realtime=False, frame_limit=0, capture_output=True
+PyObject *set_virtual_device(PyObject *self, PyObject *args);
+
+// Sets the signal fed to the virtual input device for the next stream: silence if source is None, a sine wave if it's a
+// frequency in Hz, or the contents of a wav followed by silence if it's a filename
+// Arguments: source=None
+PyObject *set_virtual_input(PyObject *self, PyObject *args);
+
+// Blocks until the current virtual device stream reaches its frame limit. The stream still needs to be stopped.
+PyObject *wait_virtual_device(PyObject *self);
+
+// Returns everything written to the virtual output device since the output was last cleared
+// Returns: samples
+PyObject *get_virtual_output(PyObject *self);
+
+// Clears the captured virtual output. Streams must be stopped first.
+PyObject *clear_virtual_output(PyObject *self);
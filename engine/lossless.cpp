@@ -0,0 +1,603 @@
+#include "lossless.h"
+#include "parallel.h"
+
+#include <cmath>
+#include <cstring>
+#include <fstream>
+
+#ifdef _MSC_VER
+#include <intrin.h>
+#endif
+
+// File layout, all values little endian:
+//   header
+//   (block_count + 1) uint64 block offsets, relative to the start of the block data
+//   block data
+//
+// Each block starts with a block type byte:
+//   k_verbatim - raw float bits
+//   k_predicted - samples are integers on a 2^-23 grid (true of anything recorded through a 16 or 24 bit converter), so
+//     they're coded as a fixed polynomial prediction (as in FLAC's FIXED subframes) followed by Rice-coded residuals.
+//     Layout: wasted bit count, predictor order, partition order, warmup samples as int32, then the bitstream.
+//
+// The encoder checks that every sample of a predicted block converts back to exactly the same bits, and falls back to
+// a verbatim block otherwise, so round trips are always bit-exact.
+
+static const uint8_t k_signature[] = { 'S', 'S', 'L', 'C' };
+static const uint32_t k_version = 1;
+static const uint32_t k_block_size = 4096;
+static const size_t k_header_size = 24;
+
+static const float k_integer_scale = 8388608.0f; // 2^23
+static const float k_inverse_integer_scale = 1.0f / k_integer_scale;
+static const float k_max_integer_magnitude = 1073741824.0f; // 2^30, leaves headroom for prediction residuals
+
+static const uint32_t k_max_predictor_order = 4;
+static const uint32_t k_max_partition_order = 4;
+static const uint32_t k_rice_parameter_bits = 5;
+static const uint32_t k_max_rice_parameter = 30;
+
+// A quotient this large is coded as an escape followed by the raw 64-bit value
+static const uint32_t k_rice_escape_quotient = 32;
+
+enum class e_block_type : uint8_t {
+    k_verbatim,
+    k_predicted
+};
+
+static uint32_t count_leading_zeros(uint64_t value) {
+#ifdef _MSC_VER
+    unsigned long index;
+    _BitScanReverse64(&index, value);
+    return 63 - index;
+#else
+    return static_cast<uint32_t>(__builtin_clzll(value));
+#endif
+}
+
+static uint32_t count_trailing_zeros(uint32_t value) {
+#ifdef _MSC_VER
+    unsigned long index;
+    _BitScanForward(&index, value);
+    return index;
+#else
+    return static_cast<uint32_t>(__builtin_ctz(value));
+#endif
+}
+
+static void write_u32(std::vector<uint8_t> &buffer, uint32_t value) {
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        buffer.push_back(static_cast<uint8_t>(value >> (i * 8)));
+    }
+}
+
+static void write_u64(std::vector<uint8_t> &buffer, uint64_t value) {
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        buffer.push_back(static_cast<uint8_t>(value >> (i * 8)));
+    }
+}
+
+static uint32_t read_u32(const uint8_t *data) {
+    uint32_t value = 0;
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        value |= static_cast<uint32_t>(data[i]) << (i * 8);
+    }
+    return value;
+}
+
+static uint64_t read_u64(const uint8_t *data) {
+    uint64_t value = 0;
+    for (size_t i = 0; i < sizeof(value); ++i) {
+        value |= static_cast<uint64_t>(data[i]) << (i * 8);
+    }
+    return value;
+}
+
+static uint64_t zigzag_encode(int64_t value) {
+    return (static_cast<uint64_t>(value) << 1) ^ static_cast<uint64_t>(value >> 63);
+}
+
+static int64_t zigzag_decode(uint64_t value) {
+    return static_cast<int64_t>(value >> 1) ^ -static_cast<int64_t>(value & 1);
+}
+
+// Writes bits most significant first
+class c_bit_writer {
+public:
+    c_bit_writer(std::vector<uint8_t> &buffer)
+        : m_buffer(buffer) {}
+
+    // bit_count must be at most 32
+    void write_bits(uint32_t value, uint32_t bit_count) {
+        if (bit_count == 0) {
+            return;
+        }
+
+        m_accumulator = (m_accumulator << bit_count) | (value & (0xFFFFFFFFu >> (32 - bit_count)));
+        m_bit_count += bit_count;
+        while (m_bit_count >= 8) {
+            m_bit_count -= 8;
+            m_buffer.push_back(static_cast<uint8_t>(m_accumulator >> m_bit_count));
+        }
+    }
+
+    // Writes zero_count zeros followed by a one
+    void write_unary(uint32_t zero_count) {
+        while (zero_count >= 32) {
+            write_bits(0, 32);
+            zero_count -= 32;
+        }
+
+        write_bits(1, zero_count + 1);
+    }
+
+    void flush() {
+        if (m_bit_count > 0) {
+            write_bits(0, 8 - m_bit_count);
+        }
+    }
+
+private:
+    std::vector<uint8_t> &m_buffer;
+    uint64_t m_accumulator = 0;
+    uint32_t m_bit_count = 0;
+};
+
+class c_bit_reader {
+public:
+    c_bit_reader(const uint8_t *data, size_t size)
+        : m_data(data)
+        , m_size(size) {}
+
+    // bit_count must be at most 32
+    uint32_t read_bits(uint32_t bit_count) {
+        if (bit_count == 0) {
+            return 0;
+        }
+
+        refill();
+        uint32_t value = static_cast<uint32_t>(m_cache >> (64 - bit_count));
+        m_cache <<= bit_count;
+        m_cache_bit_count -= bit_count;
+        return value;
+    }
+
+    // Counts zeros up to the next one, stopping early at max_zero_count
+    uint32_t read_unary(uint32_t max_zero_count) {
+        uint32_t zero_count = 0;
+        while (zero_count < max_zero_count) {
+            refill();
+            if (m_cache == 0) {
+                // Every buffered bit is a zero
+                zero_count += m_cache_bit_count;
+                m_cache_bit_count = 0;
+                continue;
+            }
+
+            // Only valid bits can be set, so the leading one is always within the buffered bits
+            uint32_t leading_zero_count = count_leading_zeros(m_cache);
+            zero_count += leading_zero_count;
+            m_cache <<= leading_zero_count;
+            m_cache <<= 1;
+            m_cache_bit_count -= leading_zero_count + 1;
+            return zero_count;
+        }
+
+        return max_zero_count;
+    }
+
+    // Returns true if more bits were consumed than the data contains
+    bool overran() const {
+        return m_byte_index * 8 - m_cache_bit_count > m_size * 8;
+    }
+
+private:
+    void refill() {
+        // The cache is left-aligned so the next bit is always the most significant
+        while (m_cache_bit_count <= 56) {
+            uint64_t byte = m_byte_index < m_size ? m_data[m_byte_index] : 0;
+            m_cache |= byte << (56 - m_cache_bit_count);
+            m_cache_bit_count += 8;
+            ++m_byte_index;
+        }
+    }
+
+    const uint8_t *m_data;
+    size_t m_size;
+    size_t m_byte_index = 0;
+    uint64_t m_cache = 0;
+    uint32_t m_cache_bit_count = 0;
+};
+
+static int64_t predict(const int32_t *values, size_t index, uint32_t order) {
+    switch (order) {
+    case 0:
+        return 0;
+
+    case 1:
+        return values[index - 1];
+
+    case 2:
+        return 2 * static_cast<int64_t>(values[index - 1]) - values[index - 2];
+
+    case 3:
+        return 3 * (static_cast<int64_t>(values[index - 1]) - values[index - 2]) + values[index - 3];
+
+    case 4:
+        return 4 * (static_cast<int64_t>(values[index - 1]) + values[index - 3])
+            - 6 * static_cast<int64_t>(values[index - 2])
+            - values[index - 4];
+
+    default:
+        return 0;
+    }
+}
+
+static uint64_t get_rice_bit_count(const uint64_t *values, size_t count, uint32_t rice_parameter) {
+    uint64_t bit_count = 0;
+    for (size_t i = 0; i < count; ++i) {
+        uint64_t quotient = values[i] >> rice_parameter;
+        bit_count += quotient < k_rice_escape_quotient
+            ? quotient + 1 + rice_parameter
+            : k_rice_escape_quotient + 1 + 64;
+    }
+
+    return bit_count;
+}
+
+// Picks the parameter near log2 of the mean, which is close to optimal for Laplacian residuals
+static uint32_t choose_rice_parameter(const uint64_t *values, size_t count, uint64_t &bit_count) {
+    uint64_t sum = 0;
+    for (size_t i = 0; i < count; ++i) {
+        sum += values[i];
+    }
+
+    uint64_t mean = count > 0 ? sum / count : 0;
+    uint32_t estimate = mean == 0 ? 0 : 63 - count_leading_zeros(mean);
+
+    uint32_t best_parameter = 0;
+    bit_count = UINT64_MAX;
+    uint32_t first_parameter = estimate > 0 ? estimate - 1 : 0;
+    uint32_t last_parameter = std::min(estimate + 1, k_max_rice_parameter);
+    for (uint32_t parameter = first_parameter; parameter <= last_parameter; ++parameter) {
+        uint64_t parameter_bit_count = get_rice_bit_count(values, count, parameter);
+        if (parameter_bit_count < bit_count) {
+            bit_count = parameter_bit_count;
+            best_parameter = parameter;
+        }
+    }
+
+    return best_parameter;
+}
+
+static void encode_verbatim_block(const float *samples, size_t count, std::vector<uint8_t> &buffer) {
+    buffer.push_back(static_cast<uint8_t>(e_block_type::k_verbatim));
+    for (size_t i = 0; i < count; ++i) {
+        uint32_t bits;
+        memcpy(&bits, &samples[i], sizeof(bits));
+        write_u32(buffer, bits);
+    }
+}
+
+static void encode_block(const float *samples, size_t count, std::vector<uint8_t> &buffer) {
+    // Convert to integers, making sure every sample survives the round trip bit-for-bit (this rejects -0, NaN, etc.)
+    std::vector<int32_t> values(count);
+    uint32_t combined_bits = 0;
+    for (size_t i = 0; i < count; ++i) {
+        float scaled = samples[i] * k_integer_scale;
+        if (!(std::fabs(scaled) < k_max_integer_magnitude) || scaled != std::floor(scaled)) {
+            encode_verbatim_block(samples, count, buffer);
+            return;
+        }
+
+        values[i] = static_cast<int32_t>(scaled);
+        float reconstructed = static_cast<float>(values[i]) * k_inverse_integer_scale;
+        if (memcmp(&reconstructed, &samples[i], sizeof(float)) != 0) {
+            encode_verbatim_block(samples, count, buffer);
+            return;
+        }
+
+        combined_bits |= static_cast<uint32_t>(values[i]);
+    }
+
+    // Low bits which are zero in every sample (e.g. 16-bit sources on the 2^-23 grid) don't need to be stored
+    uint32_t wasted_bit_count = combined_bits == 0 ? 0 : count_trailing_zeros(combined_bits);
+    for (size_t i = 0; i < count; ++i) {
+        values[i] >>= wasted_bit_count;
+    }
+
+    // Pick the predictor order with the smallest residuals
+    uint32_t max_order = static_cast<uint32_t>(std::min<size_t>(k_max_predictor_order, count));
+    uint32_t order = 0;
+    uint64_t best_residual_sum = UINT64_MAX;
+    for (uint32_t candidate_order = 0; candidate_order <= max_order; ++candidate_order) {
+        uint64_t residual_sum = 0;
+        for (size_t i = max_order; i < count; ++i) {
+            int64_t residual = values[i] - predict(values.data(), i, candidate_order);
+            residual_sum += static_cast<uint64_t>(residual < 0 ? -residual : residual);
+        }
+
+        if (residual_sum < best_residual_sum) {
+            best_residual_sum = residual_sum;
+            order = candidate_order;
+        }
+    }
+
+    size_t residual_count = count - order;
+    std::vector<uint64_t> residuals(residual_count);
+    for (size_t i = 0; i < residual_count; ++i) {
+        size_t index = order + i;
+        residuals[i] = zigzag_encode(values[index] - predict(values.data(), index, order));
+    }
+
+    // Split the residuals into 2^partition_order partitions, each with its own Rice parameter
+    uint32_t partition_order = 0;
+    uint64_t best_bit_count = UINT64_MAX;
+    std::vector<uint32_t> rice_parameters;
+    std::vector<uint32_t> candidate_rice_parameters;
+    for (uint32_t candidate_partition_order = 0;
+        candidate_partition_order <= k_max_partition_order;
+        ++candidate_partition_order) {
+        size_t partition_count = static_cast<size_t>(1) << candidate_partition_order;
+        if (candidate_partition_order > 0 && residual_count / partition_count == 0) {
+            break;
+        }
+
+        candidate_rice_parameters.clear();
+        uint64_t bit_count = 0;
+        for (size_t partition_index = 0; partition_index < partition_count; ++partition_index) {
+            size_t start = partition_index * residual_count / partition_count;
+            size_t end = (partition_index + 1) * residual_count / partition_count;
+            uint64_t partition_bit_count;
+            candidate_rice_parameters.push_back(
+                choose_rice_parameter(residuals.data() + start, end - start, partition_bit_count));
+            bit_count += partition_bit_count + k_rice_parameter_bits;
+        }
+
+        if (bit_count < best_bit_count) {
+            best_bit_count = bit_count;
+            partition_order = candidate_partition_order;
+            std::swap(rice_parameters, candidate_rice_parameters);
+        }
+    }
+
+    // Coding didn't help (e.g. noise), so store the block as-is
+    if (best_bit_count / 8 + order * sizeof(int32_t) >= count * sizeof(float)) {
+        encode_verbatim_block(samples, count, buffer);
+        return;
+    }
+
+    buffer.push_back(static_cast<uint8_t>(e_block_type::k_predicted));
+    buffer.push_back(static_cast<uint8_t>(wasted_bit_count));
+    buffer.push_back(static_cast<uint8_t>(order));
+    buffer.push_back(static_cast<uint8_t>(partition_order));
+    for (uint32_t i = 0; i < order; ++i) {
+        write_u32(buffer, static_cast<uint32_t>(values[i]));
+    }
+
+    c_bit_writer writer(buffer);
+    size_t partition_count = static_cast<size_t>(1) << partition_order;
+    for (size_t partition_index = 0; partition_index < partition_count; ++partition_index) {
+        size_t start = partition_index * residual_count / partition_count;
+        size_t end = (partition_index + 1) * residual_count / partition_count;
+        uint32_t rice_parameter = rice_parameters[partition_index];
+        writer.write_bits(rice_parameter, k_rice_parameter_bits);
+
+        for (size_t i = start; i < end; ++i) {
+            uint64_t quotient = residuals[i] >> rice_parameter;
+            if (quotient < k_rice_escape_quotient) {
+                writer.write_unary(static_cast<uint32_t>(quotient));
+                writer.write_bits(static_cast<uint32_t>(residuals[i]), rice_parameter);
+            } else {
+                writer.write_unary(k_rice_escape_quotient);
+                writer.write_bits(static_cast<uint32_t>(residuals[i] >> 32), 32);
+                writer.write_bits(static_cast<uint32_t>(residuals[i]), 32);
+            }
+        }
+    }
+
+    writer.flush();
+}
+
+static bool decode_block(const uint8_t *data, size_t size, size_t count, float *samples) {
+    if (size < 1) {
+        return false;
+    }
+
+    e_block_type block_type = static_cast<e_block_type>(data[0]);
+    ++data;
+    --size;
+
+    if (block_type == e_block_type::k_verbatim) {
+        if (size != count * sizeof(float)) {
+            return false;
+        }
+
+        for (size_t i = 0; i < count; ++i) {
+            uint32_t bits = read_u32(data + i * sizeof(bits));
+            memcpy(&samples[i], &bits, sizeof(bits));
+        }
+
+        return true;
+    }
+
+    if (block_type != e_block_type::k_predicted || size < 3) {
+        return false;
+    }
+
+    uint32_t wasted_bit_count = data[0];
+    uint32_t order = data[1];
+    uint32_t partition_order = data[2];
+    data += 3;
+    size -= 3;
+
+    if (wasted_bit_count >= 32
+        || order > k_max_predictor_order
+        || order > count
+        || partition_order > k_max_partition_order
+        || size < order * sizeof(int32_t)) {
+        return false;
+    }
+
+    std::vector<int32_t> values(count);
+    for (uint32_t i = 0; i < order; ++i) {
+        values[i] = static_cast<int32_t>(read_u32(data + i * sizeof(int32_t)));
+    }
+
+    data += order * sizeof(int32_t);
+    size -= order * sizeof(int32_t);
+
+    c_bit_reader reader(data, size);
+    size_t residual_count = count - order;
+    size_t partition_count = static_cast<size_t>(1) << partition_order;
+    for (size_t partition_index = 0; partition_index < partition_count; ++partition_index) {
+        size_t start = partition_index * residual_count / partition_count;
+        size_t end = (partition_index + 1) * residual_count / partition_count;
+        uint32_t rice_parameter = reader.read_bits(k_rice_parameter_bits);
+        if (rice_parameter > k_max_rice_parameter) {
+            return false;
+        }
+
+        for (size_t i = start; i < end; ++i) {
+            uint64_t residual;
+            uint32_t quotient = reader.read_unary(k_rice_escape_quotient);
+            if (quotient < k_rice_escape_quotient) {
+                residual = (static_cast<uint64_t>(quotient) << rice_parameter) | reader.read_bits(rice_parameter);
+            } else {
+                residual = static_cast<uint64_t>(reader.read_bits(32)) << 32;
+                residual |= reader.read_bits(32);
+            }
+
+            size_t index = order + i;
+            values[index] = static_cast<int32_t>(zigzag_decode(residual) + predict(values.data(), index, order));
+        }
+    }
+
+    if (reader.overran()) {
+        return false;
+    }
+
+    for (size_t i = 0; i < count; ++i) {
+        samples[i] = static_cast<float>(static_cast<int32_t>(static_cast<uint32_t>(values[i]) << wasted_bit_count))
+            * k_inverse_integer_scale;
+    }
+
+    return true;
+}
+
+bool is_lossless_file(const char *filename) {
+    std::ifstream file;
+    file.open(filename, std::ios::binary);
+    if (!file.is_open()) {
+        return false;
+    }
+
+    uint8_t signature[sizeof(k_signature)];
+    file.read(reinterpret_cast<char *>(signature), sizeof(signature));
+    return !file.fail() && memcmp(signature, k_signature, sizeof(k_signature)) == 0;
+}
+
+bool read_lossless(const char *filename, std::vector<float> &samples, uint32_t &sample_rate, uint32_t thread_count) {
+    std::ifstream file;
+    file.open(filename, std::ios::binary | std::ios::ate);
+    if (!file.is_open()) {
+        return false;
+    }
+
+    std::streamoff file_size = file.tellg();
+    if (file_size < static_cast<std::streamoff>(k_header_size)) {
+        return false;
+    }
+
+    std::vector<uint8_t> data(static_cast<size_t>(file_size));
+    file.seekg(0);
+    file.read(reinterpret_cast<char *>(data.data()), file_size);
+    if (file.fail()) {
+        return false;
+    }
+
+    if (memcmp(data.data(), k_signature, sizeof(k_signature)) != 0 || read_u32(&data[4]) != k_version) {
+        return false;
+    }
+
+    uint32_t file_sample_rate = read_u32(&data[8]);
+    uint32_t block_size = read_u32(&data[12]);
+    uint64_t sample_count = read_u64(&data[16]);
+    if (block_size == 0) {
+        return false;
+    }
+
+    uint64_t block_count = (sample_count + block_size - 1) / block_size;
+    uint64_t block_table_size = (block_count + 1) * sizeof(uint64_t);
+    if (block_table_size > data.size() - k_header_size) {
+        return false;
+    }
+
+    const uint8_t *block_table = data.data() + k_header_size;
+    const uint8_t *block_data = block_table + block_table_size;
+    size_t block_data_size = data.size() - k_header_size - static_cast<size_t>(block_table_size);
+    if (read_u64(block_table + block_count * sizeof(uint64_t)) != block_data_size) {
+        return false;
+    }
+
+    samples.resize(static_cast<size_t>(sample_count));
+    std::atomic<bool> success = true;
+    parallel_for(static_cast<size_t>(block_count), thread_count,
+        [&](size_t block_index) {
+            uint64_t start = read_u64(block_table + block_index * sizeof(uint64_t));
+            uint64_t end = read_u64(block_table + (block_index + 1) * sizeof(uint64_t));
+            size_t first_sample = block_index * block_size;
+            size_t count = std::min<size_t>(block_size, samples.size() - first_sample);
+            if (start > end
+                || end > block_data_size
+                || !decode_block(block_data + start, static_cast<size_t>(end - start), count, &samples[first_sample])) {
+                success = false;
+            }
+        });
+
+    sample_rate = file_sample_rate;
+    return success;
+}
+
+bool write_lossless(
+    const char *filename,
+    const float *samples,
+    size_t sample_count,
+    uint32_t sample_rate,
+    uint32_t thread_count) {
+    size_t block_count = (sample_count + k_block_size - 1) / k_block_size;
+    std::vector<std::vector<uint8_t>> blocks(block_count);
+    parallel_for(block_count, thread_count,
+        [&](size_t block_index) {
+            size_t first_sample = block_index * k_block_size;
+            size_t count = std::min<size_t>(k_block_size, sample_count - first_sample);
+            encode_block(samples + first_sample, count, blocks[block_index]);
+        });
+
+    std::vector<uint8_t> header;
+    header.insert(header.end(), k_signature, k_signature + sizeof(k_signature));
+    write_u32(header, k_version);
+    write_u32(header, sample_rate);
+    write_u32(header, k_block_size);
+    write_u64(header, sample_count);
+
+    uint64_t offset = 0;
+    write_u64(header, offset);
+    for (const std::vector<uint8_t> &block : blocks) {
+        offset += block.size();
+        write_u64(header, offset);
+    }
+
+    std::ofstream file;
+    file.open(filename, std::ios::binary);
+    if (!file.is_open()) {
+        return false;
+    }
+
+    file.write(reinterpret_cast<const char *>(header.data()), header.size());
+    for (const std::vector<uint8_t> &block : blocks) {
+        file.write(reinterpret_cast<const char *>(block.data()), block.size());
+    }
+
+    return !file.fail();
+}
@@ -0,0 +1,20 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <vector>
+
+// Reads/writes single channel float clips using a lossless block-based codec. Blocks are coded independently and
+// indexed, so encoding and decoding are spread across threads and any block can be decoded without the others.
+// A thread_count of 0 uses one thread per core.
+
+// Returns true if the file starts with the lossless clip signature
+bool is_lossless_file(const char *filename);
+
+bool read_lossless(const char *filename, std::vector<float> &samples, uint32_t &sample_rate, uint32_t thread_count);
+bool write_lossless(
+    const char *filename,
+    const float *samples,
+    size_t sample_count,
+    uint32_t sample_rate,
+    uint32_t thread_count);
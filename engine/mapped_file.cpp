@@ -0,0 +1,207 @@
+#include "mapped_file.h"
+
+#include <algorithm>
+
+#ifdef _WIN32
+#define NOMINMAX
+#include <windows.h>
+#else
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
+c_mapped_file::~c_mapped_file() {
+    close();
+}
+
+#ifdef _WIN32
+
+bool c_mapped_file::open(const char *filename) {
+    close();
+
+    HANDLE file_handle = CreateFileA(
+        filename,
+        GENERIC_READ,
+        FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+        nullptr,
+        OPEN_EXISTING,
+        FILE_ATTRIBUTE_NORMAL,
+        nullptr);
+    if (file_handle == INVALID_HANDLE_VALUE) {
+        return false;
+    }
+
+    LARGE_INTEGER file_size;
+    if (!GetFileSizeEx(file_handle, &file_size) || file_size.QuadPart == 0) {
+        CloseHandle(file_handle);
+        return false;
+    }
+
+    HANDLE mapping_handle = CreateFileMappingA(file_handle, nullptr, PAGE_READONLY, 0, 0, nullptr);
+    if (!mapping_handle) {
+        CloseHandle(file_handle);
+        return false;
+    }
+
+    void *data = MapViewOfFile(mapping_handle, FILE_MAP_READ, 0, 0, 0);
+    if (!data) {
+        CloseHandle(mapping_handle);
+        CloseHandle(file_handle);
+        return false;
+    }
+
+    m_file_handle = file_handle;
+    m_mapping_handle = mapping_handle;
+    m_data = static_cast<const uint8_t *>(data);
+    m_size = static_cast<size_t>(file_size.QuadPart);
+    return true;
+}
+
+void c_mapped_file::close() {
+    if (m_data) {
+        UnmapViewOfFile(m_data);
+        m_data = nullptr;
+    }
+
+    if (m_mapping_handle) {
+        CloseHandle(m_mapping_handle);
+        m_mapping_handle = nullptr;
+    }
+
+    if (m_file_handle) {
+        CloseHandle(m_file_handle);
+        m_file_handle = nullptr;
+    }
+
+    m_size = 0;
+}
+
+bool c_mapped_file::is_same_file(const char *filename) const {
+    if (!m_file_handle) {
+        return false;
+    }
+
+    HANDLE file_handle = CreateFileA(
+        filename,
+        0,
+        FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+        nullptr,
+        OPEN_EXISTING,
+        FILE_ATTRIBUTE_NORMAL,
+        nullptr);
+    if (file_handle == INVALID_HANDLE_VALUE) {
+        return false;
+    }
+
+    BY_HANDLE_FILE_INFORMATION a;
+    BY_HANDLE_FILE_INFORMATION b;
+    bool result = GetFileInformationByHandle(m_file_handle, &a)
+        && GetFileInformationByHandle(file_handle, &b)
+        && a.dwVolumeSerialNumber == b.dwVolumeSerialNumber
+        && a.nFileIndexHigh == b.nFileIndexHigh
+        && a.nFileIndexLow == b.nFileIndexLow;
+    CloseHandle(file_handle);
+    return result;
+}
+
+void c_mapped_file::advise(size_t offset, size_t size, e_mapped_file_access_hint hint) const {
+#if defined(_WIN32_WINNT_WIN8) && _WIN32_WINNT >= _WIN32_WINNT_WIN8
+    // Windows only supports prefetching
+    if (!m_data || hint != e_mapped_file_access_hint::k_will_need || offset >= m_size) {
+        return;
+    }
+
+    WIN32_MEMORY_RANGE_ENTRY range;
+    range.VirtualAddress = const_cast<uint8_t *>(m_data + offset);
+    range.NumberOfBytes = std::min(size, m_size - offset);
+    PrefetchVirtualMemory(GetCurrentProcess(), 1, &range, 0);
+#endif
+}
+
+#else
+
+bool c_mapped_file::open(const char *filename) {
+    close();
+
+    int file_descriptor = ::open(filename, O_RDONLY);
+    if (file_descriptor < 0) {
+        return false;
+    }
+
+    struct stat file_stat;
+    if (fstat(file_descriptor, &file_stat) != 0 || file_stat.st_size <= 0) {
+        ::close(file_descriptor);
+        return false;
+    }
+
+    size_t size = static_cast<size_t>(file_stat.st_size);
+    void *data = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, file_descriptor, 0);
+    if (data == MAP_FAILED) {
+        ::close(file_descriptor);
+        return false;
+    }
+
+    m_file_descriptor = file_descriptor;
+    m_data = static_cast<const uint8_t *>(data);
+    m_size = size;
+    return true;
+}
+
+void c_mapped_file::close() {
+    if (m_data) {
+        munmap(const_cast<uint8_t *>(m_data), m_size);
+        m_data = nullptr;
+    }
+
+    if (m_file_descriptor >= 0) {
+        ::close(m_file_descriptor);
+        m_file_descriptor = -1;
+    }
+
+    m_size = 0;
+}
+
+bool c_mapped_file::is_same_file(const char *filename) const {
+    struct stat a;
+    struct stat b;
+    return m_file_descriptor >= 0
+        && fstat(m_file_descriptor, &a) == 0
+        && stat(filename, &b) == 0
+        && a.st_dev == b.st_dev
+        && a.st_ino == b.st_ino;
+}
+
+void c_mapped_file::advise(size_t offset, size_t size, e_mapped_file_access_hint hint) const {
+    if (!m_data || offset >= m_size) {
+        return;
+    }
+
+    int advice;
+    switch (hint) {
+    case e_mapped_file_access_hint::k_sequential:
+        advice = MADV_SEQUENTIAL;
+        break;
+
+    case e_mapped_file_access_hint::k_will_need:
+        advice = MADV_WILLNEED;
+        break;
+
+    case e_mapped_file_access_hint::k_dont_need:
+        advice = MADV_DONTNEED;
+        break;
+
+    default:
+        advice = MADV_NORMAL;
+        break;
+    }
+
+    // madvise requires a page-aligned address
+    size_t page_size = static_cast<size_t>(sysconf(_SC_PAGESIZE));
+    size_t aligned_offset = offset - offset % page_size;
+    size_t end = offset + size < m_size ? offset + size : m_size;
+    madvise(const_cast<uint8_t *>(m_data + aligned_offset), end - aligned_offset, advice);
+}
+
+#endif
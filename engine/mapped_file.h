@@ -0,0 +1,44 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+
+enum class e_mapped_file_access_hint {
+    k_normal,
+    k_sequential,
+    k_will_need,
+    k_dont_need
+};
+
+// A read-only memory mapping of an entire file
+class c_mapped_file {
+public:
+    c_mapped_file() = default;
+    ~c_mapped_file();
+
+    c_mapped_file(const c_mapped_file &) = delete;
+    c_mapped_file &operator=(const c_mapped_file &) = delete;
+
+    bool open(const char *filename);
+    void close();
+
+    bool is_open() const { return m_data != nullptr; }
+    const uint8_t *get_data() const { return m_data; }
+    size_t get_size() const { return m_size; }
+
+    // Returns true if filename refers to the file backing this mapping
+    bool is_same_file(const char *filename) const;
+
+    // Passes an access hint for a byte range on to the OS, hints which aren't supported are ignored
+    void advise(size_t offset, size_t size, e_mapped_file_access_hint hint) const;
+
+private:
+#ifdef _WIN32
+    void *m_file_handle = nullptr;
+    void *m_mapping_handle = nullptr;
+#else
+    int m_file_descriptor = -1;
+#endif
+    const uint8_t *m_data = nullptr;
+    size_t m_size = 0;
+};
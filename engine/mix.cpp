@@ -0,0 +1,244 @@
+#include "mix.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+
+static uint32_t float_to_bits(float value) {
+    uint32_t bits;
+    memcpy(&bits, &value, sizeof(bits));
+    return bits;
+}
+
+static float bits_to_float(uint32_t bits) {
+    float value;
+    memcpy(&value, &bits, sizeof(value));
+    return value;
+}
+
+// Rounds to nearest even, values too large for a half become infinity
+static uint16_t float_to_float16(float value) {
+    static const uint32_t k_float32_infinity = 255u << 23;
+    static const uint32_t k_float16_overflow = (127u + 16u) << 23;
+    static const uint32_t k_float16_min_normal = 113u << 23;
+    const float denormal_magic = bits_to_float(((127u - 15u) + (23u - 10u) + 1u) << 23);
+
+    uint32_t bits = float_to_bits(value);
+    uint32_t sign = bits & 0x80000000u;
+    bits ^= sign;
+
+    uint16_t result;
+    if (bits >= k_float16_overflow) {
+        result = bits > k_float32_infinity ? 0x7e00 : 0x7c00;
+    } else if (bits < k_float16_min_normal) {
+        // Adding the magic number lines the mantissa up so the FPU does the rounding
+        result = static_cast<uint16_t>(float_to_bits(bits_to_float(bits) + denormal_magic) - float_to_bits(denormal_magic));
+    } else {
+        uint32_t mantissa_odd = (bits >> 13) & 1;
+        bits += (static_cast<uint32_t>(15 - 127) << 23) + 0xfff + mantissa_odd;
+        result = static_cast<uint16_t>(bits >> 13);
+    }
+
+    return static_cast<uint16_t>(result | (sign >> 16));
+}
+
+// Written without branches so that loops over it can be vectorized
+static float float16_to_float(uint16_t value) {
+    uint32_t magnitude = value & 0x7fffu;
+    uint32_t sign = static_cast<uint32_t>(value & 0x8000u) << 16;
+
+    // Rebias the exponent, and for infinity and NaN also saturate it
+    uint32_t normal_bits = (magnitude << 13) + ((127u - 15u) << 23);
+    normal_bits += (0u - static_cast<uint32_t>(magnitude >= 0x7c00u)) & ((128u - 16u) << 23);
+    float normal = bits_to_float(normal_bits | sign);
+
+    // Denormals are just the mantissa scaled by 2^-24
+    float denormal = static_cast<float>(static_cast<int32_t>(magnitude)) * (1.0f / 16777216.0f);
+    denormal = (value & 0x8000u) ? -denormal : denormal;
+
+    return magnitude < 0x400u ? denormal : normal;
+}
+
+// Adds decode(i) to output[i] with a gain ramp. Kept as a template so each format's loop is compiled (and vectorized)
+// separately.
+template<typename t_decode>
+static void mix_block(float *output, size_t count, float gain, float gain_step, size_t step_offset, t_decode decode) {
+    // Blocks are short, so 32-bit indices are enough and convert to float faster
+    int32_t block_count = static_cast<int32_t>(count);
+    if (gain_step == 0.0f) {
+        for (int32_t i = 0; i < block_count; ++i) {
+            output[i] += decode(i) * gain;
+        }
+    } else {
+        gain += gain_step * static_cast<float>(step_offset + 1);
+        for (int32_t i = 0; i < block_count; ++i) {
+            output[i] += decode(i) * (gain + gain_step * static_cast<float>(i));
+        }
+    }
+}
+
+void measure_levels(const float *samples, size_t sample_count, float &peak, float &sum_of_squares) {
+    // Several independent accumulators let the compiler vectorize the loop without reordering a single sum
+    float peaks[4] = { 0.0f, 0.0f, 0.0f, 0.0f };
+    float sums[4] = { 0.0f, 0.0f, 0.0f, 0.0f };
+    size_t vector_count = sample_count & ~size_t(3);
+    for (size_t i = 0; i < vector_count; i += 4) {
+        for (size_t j = 0; j < 4; ++j) {
+            peaks[j] = std::max(peaks[j], std::abs(samples[i + j]));
+            sums[j] += samples[i + j] * samples[i + j];
+        }
+    }
+
+    for (size_t i = vector_count; i < sample_count; ++i) {
+        peaks[0] = std::max(peaks[0], std::abs(samples[i]));
+        sums[0] += samples[i] * samples[i];
+    }
+
+    peak = std::max(std::max(peaks[0], peaks[1]), std::max(peaks[2], peaks[3]));
+    sum_of_squares = (sums[0] + sums[1]) + (sums[2] + sums[3]);
+}
+
+void find_sample_range(const float *samples, size_t sample_count, float &min_sample, float &max_sample) {
+    float mins[4] = { samples[0], samples[0], samples[0], samples[0] };
+    float maxes[4] = { samples[0], samples[0], samples[0], samples[0] };
+    size_t vector_count = sample_count & ~size_t(3);
+    for (size_t i = 0; i < vector_count; i += 4) {
+        for (size_t j = 0; j < 4; ++j) {
+            mins[j] = std::min(mins[j], samples[i + j]);
+            maxes[j] = std::max(maxes[j], samples[i + j]);
+        }
+    }
+
+    for (size_t i = vector_count; i < sample_count; ++i) {
+        mins[0] = std::min(mins[0], samples[i]);
+        maxes[0] = std::max(maxes[0], samples[i]);
+    }
+
+    min_sample = std::min(std::min(mins[0], mins[1]), std::min(mins[2], mins[3]));
+    max_sample = std::max(std::max(maxes[0], maxes[1]), std::max(maxes[2], maxes[3]));
+}
+
+void compute_block_levels(
+    const float *samples,
+    size_t sample_count,
+    std::vector<float> &block_peaks,
+    std::vector<float> &block_mean_squares) {
+    size_t block_count = (sample_count + k_peak_block_size - 1) / k_peak_block_size;
+    block_peaks.resize(block_count);
+    block_mean_squares.resize(block_count);
+    for (size_t block_index = 0; block_index < block_count; ++block_index) {
+        size_t first_sample_index = block_index * k_peak_block_size;
+        size_t block_sample_count = std::min(k_peak_block_size, sample_count - first_sample_index);
+        float sum_of_squares;
+        measure_levels(samples + first_sample_index, block_sample_count, block_peaks[block_index], sum_of_squares);
+        block_mean_squares[block_index] = sum_of_squares / static_cast<float>(block_sample_count);
+    }
+}
+
+float encode_samples(const float *samples, size_t sample_count, e_sample_format format, uint16_t *encoded_samples) {
+    if (format == e_sample_format::k_float16) {
+        for (size_t i = 0; i < sample_count; ++i) {
+            encoded_samples[i] = float_to_float16(samples[i]);
+        }
+
+        return 1.0f;
+    }
+
+    // Scale to the clip's own peak so that quiet takes don't lose resolution
+    float peak = 0.0f;
+    for (size_t i = 0; i < sample_count; ++i) {
+        peak = std::max(peak, std::abs(samples[i]));
+    }
+
+    float scale = peak > 0.0f ? peak / 32767.0f : 1.0f;
+    float inverse_scale = 1.0f / scale;
+    for (size_t i = 0; i < sample_count; ++i) {
+        float value = std::min(std::max(std::round(samples[i] * inverse_scale), -32767.0f), 32767.0f);
+        encoded_samples[i] = static_cast<uint16_t>(static_cast<int16_t>(value));
+    }
+
+    return scale;
+}
+
+void decode_samples(const s_mix_source &source, size_t first_sample_index, size_t sample_count, float *samples) {
+    switch (source.m_format) {
+    case e_sample_format::k_float32:
+        memcpy(samples, static_cast<const float *>(source.m_samples) + first_sample_index, sample_count * sizeof(float));
+        break;
+
+    case e_sample_format::k_int16:
+    {
+        const int16_t *encoded_samples = static_cast<const int16_t *>(source.m_samples) + first_sample_index;
+        for (size_t i = 0; i < sample_count; ++i) {
+            samples[i] = static_cast<float>(encoded_samples[i]) * source.m_scale;
+        }
+        break;
+    }
+
+    case e_sample_format::k_float16:
+    {
+        const uint16_t *encoded_samples = static_cast<const uint16_t *>(source.m_samples) + first_sample_index;
+        for (size_t i = 0; i < sample_count; ++i) {
+            samples[i] = float16_to_float(encoded_samples[i]);
+        }
+        break;
+    }
+
+    default:
+        break;
+    }
+}
+
+void mix_samples(
+    float *output,
+    const s_mix_source &source,
+    size_t first_sample_index,
+    size_t sample_count,
+    float gain,
+    float gain_step) {
+    size_t offset = 0;
+    while (offset < sample_count) {
+        // Work one peak block at a time so silent blocks can be skipped
+        size_t sample_index = first_sample_index + offset;
+        size_t block_index = sample_index / k_peak_block_size;
+        size_t count = std::min((block_index + 1) * k_peak_block_size - sample_index, sample_count - offset);
+
+        if (!source.m_block_peaks || source.m_block_peaks[block_index] > k_silence_threshold) {
+            float *block_output = output + offset;
+            switch (source.m_format) {
+            case e_sample_format::k_float32:
+            {
+                const float *samples = static_cast<const float *>(source.m_samples) + sample_index;
+                mix_block(block_output, count, gain, gain_step, offset, [&](int32_t i) { return samples[i]; });
+                break;
+            }
+
+            case e_sample_format::k_int16:
+            {
+                // The scale is folded into the gain
+                const int16_t *samples = static_cast<const int16_t *>(source.m_samples) + sample_index;
+                mix_block(
+                    block_output,
+                    count,
+                    gain * source.m_scale,
+                    gain_step * source.m_scale,
+                    offset,
+                    [&](int32_t i) { return static_cast<float>(samples[i]); });
+                break;
+            }
+
+            case e_sample_format::k_float16:
+            {
+                const uint16_t *samples = static_cast<const uint16_t *>(source.m_samples) + sample_index;
+                mix_block(block_output, count, gain, gain_step, offset, [&](int32_t i) { return float16_to_float(samples[i]); });
+                break;
+            }
+
+            default:
+                break;
+            }
+        }
+
+        offset += count;
+    }
+}
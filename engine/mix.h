@@ -0,0 +1,59 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <vector>
+
+// Clips keep the peak absolute sample value and mean square of each block of this many samples so that silence can be
+// skipped and levels can be metered without touching the samples
+static const size_t k_peak_block_size = 256;
+
+// Blocks whose peak is at or below this level (about -96dB) are treated as silent
+static const float k_silence_threshold = 1.0f / 65536.0f;
+
+// How a clip's samples are stored in memory
+enum class e_sample_format {
+    k_float32,  // Full precision
+    k_int16,    // 16-bit integers scaled to the clip's peak, about 96dB of dynamic range below the peak
+    k_float16,  // IEEE half precision, 11 bits of precision at every level
+
+    k_count
+};
+
+// Samples to mix, along with how they're stored
+struct s_mix_source {
+    const void *m_samples;
+    e_sample_format m_format;
+    float m_scale;                  // int16 samples are multiplied by this to get float samples
+    const float *m_block_peaks;     // May be null
+};
+
+// Measures the peak absolute value and the sum of squares of samples
+void measure_levels(const float *samples, size_t sample_count, float &peak, float &sum_of_squares);
+
+// Finds the lowest and highest of samples, which must not be empty
+void find_sample_range(const float *samples, size_t sample_count, float &min_sample, float &max_sample);
+
+// Computes the peak and mean square of each block of samples, the last block may be partial
+void compute_block_levels(
+    const float *samples,
+    size_t sample_count,
+    std::vector<float> &block_peaks,
+    std::vector<float> &block_mean_squares);
+
+// Converts float samples to a 16-bit format and returns the scale to store in the s_mix_source
+float encode_samples(const float *samples, size_t sample_count, e_sample_format format, uint16_t *encoded_samples);
+
+// Converts samples [first_sample_index, first_sample_index + sample_count) of source back to float
+void decode_samples(const s_mix_source &source, size_t first_sample_index, size_t sample_count, float *samples);
+
+// Adds samples [first_sample_index, first_sample_index + sample_count) to output, scaled by a gain which starts at
+// gain + gain_step for output[0] and increases by gain_step per sample. Blocks which the source's block peaks mark as
+// silent are skipped, and reduced precision samples are decoded as they're mixed.
+void mix_samples(
+    float *output,
+    const s_mix_source &source,
+    size_t first_sample_index,
+    size_t sample_count,
+    float gain,
+    float gain_step = 0.0f);
@@ -0,0 +1,50 @@
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+#include <thread>
+#include <vector>
+
+// Returns thread_count, or the number of cores if thread_count is 0
+inline uint32_t resolve_thread_count(uint32_t thread_count) {
+    if (thread_count == 0) {
+        thread_count = std::max(std::thread::hardware_concurrency(), 1u);
+    }
+
+    return thread_count;
+}
+
+// Calls func(i) for each i in [0, count), spreading the calls across up to thread_count threads. Work is handed out one
+// index at a time so uneven items balance out.
+template<typename t_func>
+void parallel_for(size_t count, uint32_t thread_count, const t_func &func) {
+    size_t worker_count = std::min(static_cast<size_t>(resolve_thread_count(thread_count)), count);
+    if (worker_count <= 1) {
+        for (size_t i = 0; i < count; ++i) {
+            func(i);
+        }
+
+        return;
+    }
+
+    std::atomic<size_t> next_index = 0;
+    auto worker_main = [&]() {
+        for (size_t i = next_index++; i < count; i = next_index++) {
+            func(i);
+        }
+    };
+
+    // The calling thread does its share of the work too
+    std::vector<std::thread> workers;
+    workers.reserve(worker_count - 1);
+    for (size_t i = 0; i < worker_count - 1; ++i) {
+        workers.emplace_back(worker_main);
+    }
+
+    worker_main();
+    for (std::thread &worker : workers) {
+        worker.join();
+    }
+}
@@ -0,0 +1,135 @@
+#include "render_cache.h"
+
+#include <algorithm>
+#include <cstring>
+#include <tuple>
+
+bool s_render_cache_clip::operator==(const s_render_cache_clip &other) const {
+    // Gains are compared bitwise so that the comparison agrees with the hash
+    return m_clip_id == other.m_clip_id
+        && m_clip_sample_index == other.m_clip_sample_index
+        && m_segment_offset == other.m_segment_offset
+        && m_sample_count == other.m_sample_count
+        && memcmp(&m_gain, &other.m_gain, sizeof(m_gain)) == 0;
+}
+
+bool s_render_cache_clip::operator<(const s_render_cache_clip &other) const {
+    uint32_t gain_bits;
+    uint32_t other_gain_bits;
+    memcpy(&gain_bits, &m_gain, sizeof(gain_bits));
+    memcpy(&other_gain_bits, &other.m_gain, sizeof(other_gain_bits));
+    return std::tie(m_segment_offset, m_clip_id, m_clip_sample_index, m_sample_count, gain_bits)
+        < std::tie(other.m_segment_offset, other.m_clip_id, other.m_clip_sample_index, other.m_sample_count, other_gain_bits);
+}
+
+bool s_render_cache_key::operator==(const s_render_cache_key &other) const {
+    return m_sample_count == other.m_sample_count && m_clips == other.m_clips;
+}
+
+size_t s_render_cache_key_hash::operator()(const s_render_cache_key &key) const {
+    // FNV-1a over the key's fields
+    uint64_t hash = 14695981039346656037ull;
+    auto combine = [&](uint32_t value) {
+        for (size_t i = 0; i < sizeof(value); ++i) {
+            hash = (hash ^ ((value >> (i * 8)) & 0xff)) * 1099511628211ull;
+        }
+    };
+
+    combine(static_cast<uint32_t>(key.m_sample_count));
+    for (const s_render_cache_clip &clip : key.m_clips) {
+        uint32_t gain_bits;
+        memcpy(&gain_bits, &clip.m_gain, sizeof(gain_bits));
+        combine(static_cast<uint32_t>(clip.m_clip_id));
+        combine(static_cast<uint32_t>(clip.m_clip_sample_index));
+        combine(static_cast<uint32_t>(clip.m_segment_offset));
+        combine(static_cast<uint32_t>(clip.m_sample_count));
+        combine(gain_bits);
+    }
+
+    return static_cast<size_t>(hash);
+}
+
+c_render_cache::~c_render_cache() {
+    stop();
+}
+
+void c_render_cache::begin_update() {
+    stop();
+    for (auto &entry : m_entries) {
+        entry.second.m_requested = false;
+    }
+}
+
+std::shared_ptr<s_render_cache_entry> c_render_cache::request(
+    const s_render_cache_key &key,
+    const std::vector<s_mix_source> &clip_sources) {
+    auto result = m_entries.emplace(key, s_cached_entry());
+    s_cached_entry &cached_entry = result.first->second;
+    if (result.second) {
+        cached_entry.m_entry = std::make_shared<s_render_cache_entry>();
+    }
+
+    // A segment can appear more than once in a song but only needs to be rendered once
+    if (!cached_entry.m_requested && !cached_entry.m_entry->m_ready) {
+        s_job job = { cached_entry.m_entry, &result.first->first, clip_sources };
+        m_jobs.push_back(std::move(job));
+    }
+
+    cached_entry.m_requested = true;
+    return cached_entry.m_entry;
+}
+
+void c_render_cache::end_update() {
+    for (auto it = m_entries.begin(); it != m_entries.end();) {
+        if (it->second.m_requested) {
+            ++it;
+        } else {
+            it = m_entries.erase(it);
+        }
+    }
+
+    if (!m_jobs.empty()) {
+        m_terminate = false;
+        m_thread = new std::thread(&c_render_cache::thread_main, this);
+    }
+}
+
+void c_render_cache::stop() {
+    if (m_thread) {
+        m_terminate = true;
+        m_thread->join();
+        delete m_thread;
+        m_thread = nullptr;
+    }
+
+    m_jobs.clear();
+}
+
+void c_render_cache::clear() {
+    stop();
+    m_entries.clear();
+}
+
+void c_render_cache::thread_main() {
+    // Jobs are in playback order, so the start of the song becomes available first
+    for (const s_job &job : m_jobs) {
+        if (m_terminate) {
+            break;
+        }
+
+        const s_render_cache_key &key = *job.m_key;
+        std::vector<float> &samples = job.m_entry->m_samples;
+        samples.assign(key.m_sample_count, 0.0f);
+        for (size_t clip_index = 0; clip_index < key.m_clips.size(); ++clip_index) {
+            const s_render_cache_clip &clip = key.m_clips[clip_index];
+            mix_samples(
+                samples.data() + clip.m_segment_offset,
+                job.m_clip_sources[clip_index],
+                static_cast<size_t>(clip.m_clip_sample_index),
+                static_cast<size_t>(clip.m_sample_count),
+                clip.m_gain);
+        }
+
+        job.m_entry->m_ready.store(true, std::memory_order_release);
+    }
+}
@@ -0,0 +1,90 @@
+#pragma once
+
+#include "mix.h"
+
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+#include <memory>
+#include <thread>
+#include <unordered_map>
+#include <vector>
+
+// A clip's contribution to one segment of pre-mixed output
+struct s_render_cache_clip {
+    int32_t m_clip_id;
+    int32_t m_clip_sample_index;    // First sample of the clip which plays in the segment
+    int32_t m_segment_offset;       // Offset into the segment where that sample plays
+    int32_t m_sample_count;
+    float m_gain;
+
+    bool operator==(const s_render_cache_clip &other) const;
+    bool operator<(const s_render_cache_clip &other) const;
+};
+
+// Identifies a segment's mixed output by its content, so segments whose clips and gains haven't changed are found again
+// after the playback is rebuilt, wherever they've moved to
+struct s_render_cache_key {
+    int32_t m_sample_count = 0;
+    std::vector<s_render_cache_clip> m_clips = {};  // Sorted
+
+    bool operator==(const s_render_cache_key &other) const;
+};
+
+struct s_render_cache_key_hash {
+    size_t operator()(const s_render_cache_key &key) const;
+};
+
+struct s_render_cache_entry {
+    std::vector<float> m_samples = {};
+    std::atomic<bool> m_ready = false;  // Set once m_samples has been rendered
+};
+
+// Stores pre-mixed segments of playback and renders new ones on a background thread. Between begin_update and
+// end_update, every segment of the new playback is requested. Segments which are already cached are reused and the
+// rest are queued to be rendered. Entries which weren't requested are dropped.
+class c_render_cache {
+public:
+    c_render_cache() = default;
+    ~c_render_cache();
+
+    c_render_cache(const c_render_cache &) = delete;
+    c_render_cache &operator=(const c_render_cache &) = delete;
+
+    void begin_update();
+
+    // clip_sources holds the sample data of each clip in the key, which must stay valid until the render thread is
+    // stopped
+    std::shared_ptr<s_render_cache_entry> request(
+        const s_render_cache_key &key,
+        const std::vector<s_mix_source> &clip_sources);
+
+    void end_update();
+
+    // Stops rendering. Entries which haven't been rendered yet will be queued again on the next update.
+    void stop();
+
+    void clear();
+
+    size_t get_entry_count() const { return m_entries.size(); }
+
+private:
+    struct s_job {
+        std::shared_ptr<s_render_cache_entry> m_entry;
+        const s_render_cache_key *m_key;
+        std::vector<s_mix_source> m_clip_sources;
+    };
+
+    void thread_main();
+
+    struct s_cached_entry {
+        std::shared_ptr<s_render_cache_entry> m_entry;
+        bool m_requested;
+    };
+
+    std::unordered_map<s_render_cache_key, s_cached_entry, s_render_cache_key_hash> m_entries = {};
+    std::vector<s_job> m_jobs = {};
+
+    std::thread *m_thread = nullptr;
+    std::atomic<bool> m_terminate = false;
+};
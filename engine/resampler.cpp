@@ -0,0 +1,178 @@
+#include "resampler.h"
+#include "parallel.h"
+
+#include <algorithm>
+#include <cmath>
+#include <numeric>
+
+// Zero crossings of the sinc on each side of the center, more gives a sharper transition band
+static const uint32_t k_zero_crossing_count = 32;
+
+// The cutoff sits slightly below the lower Nyquist frequency so the transition band doesn't alias
+static const double k_cutoff_scale = 0.95;
+
+// Kaiser window shape, about 90dB of stopband attenuation
+static const double k_kaiser_beta = 9.0;
+
+// Above this many phases, taps are interpolated between tabulated phases rather than tabulating every phase
+static const uint64_t k_max_phase_count = 1024;
+
+// Number of output samples computed per unit of work when spreading resampling across threads
+static const size_t k_output_block_size = 16384;
+
+static const double k_pi = 3.141592653589793238463;
+
+// Zeroth order modified Bessel function of the first kind
+static double bessel_i0(double x) {
+    double sum = 1.0;
+    double term = 1.0;
+    double half_x = 0.5 * x;
+    for (uint32_t k = 1; k < 64; ++k) {
+        term *= (half_x / k) * (half_x / k);
+        sum += term;
+        if (term < sum * 1e-12) {
+            break;
+        }
+    }
+
+    return sum;
+}
+
+// Uses several independent accumulators so the compiler can vectorize the loop without reordering a single sum.
+// count must be a multiple of 4.
+static float dot_product(const float *a, const float *b, size_t count) {
+    float sums[4] = { 0.0f, 0.0f, 0.0f, 0.0f };
+    for (size_t i = 0; i < count; i += 4) {
+        sums[0] += a[i] * b[i];
+        sums[1] += a[i + 1] * b[i + 1];
+        sums[2] += a[i + 2] * b[i + 2];
+        sums[3] += a[i + 3] * b[i + 3];
+    }
+
+    return (sums[0] + sums[1]) + (sums[2] + sums[3]);
+}
+
+c_resampler::c_resampler(uint32_t input_sample_rate, uint32_t output_sample_rate) {
+    uint64_t divisor = std::gcd(static_cast<uint64_t>(input_sample_rate), static_cast<uint64_t>(output_sample_rate));
+    m_interpolation_factor = output_sample_rate / divisor;
+    m_decimation_factor = input_sample_rate / divisor;
+    m_phase_count = static_cast<uint32_t>(std::min(m_interpolation_factor, k_max_phase_count));
+
+    // When downsampling, the cutoff drops below the input's Nyquist frequency and the filter widens to match
+    double cutoff = k_cutoff_scale
+        * std::min(1.0, static_cast<double>(m_interpolation_factor) / static_cast<double>(m_decimation_factor));
+    uint32_t half_tap_count = static_cast<uint32_t>(std::ceil(k_zero_crossing_count / cutoff));
+    m_tap_count = (2 * half_tap_count + 3) / 4 * 4;
+
+    double half_width = 0.5 * m_tap_count;
+    double inverse_i0_beta = 1.0 / bessel_i0(k_kaiser_beta);
+    m_taps.resize((m_phase_count + 1) * m_tap_count);
+    for (uint32_t phase = 0; phase <= m_phase_count; ++phase) {
+        // The output lies this far past the input sample at tap half_width - 1
+        double fraction = static_cast<double>(phase) / m_phase_count;
+        float *taps = &m_taps[phase * m_tap_count];
+
+        double sum = 0.0;
+        for (uint32_t tap = 0; tap < m_tap_count; ++tap) {
+            double x = tap - half_width + 1.0 - fraction;
+            double window_position = x / half_width;
+            double value = 0.0;
+            if (std::abs(window_position) < 1.0) {
+                double window = bessel_i0(k_kaiser_beta * std::sqrt(1.0 - window_position * window_position))
+                    * inverse_i0_beta;
+                double sinc = x == 0.0 ? 1.0 : std::sin(k_pi * cutoff * x) / (k_pi * cutoff * x);
+                value = cutoff * sinc * window;
+            }
+
+            taps[tap] = static_cast<float>(value);
+            sum += value;
+        }
+
+        // Normalize each phase to unity gain at DC so there's no ripple from phase to phase
+        float scale = static_cast<float>(1.0 / sum);
+        for (uint32_t tap = 0; tap < m_tap_count; ++tap) {
+            taps[tap] *= scale;
+        }
+    }
+}
+
+size_t c_resampler::get_output_count(size_t input_count) const {
+    return static_cast<size_t>(
+        (static_cast<uint64_t>(input_count) * m_interpolation_factor + m_decimation_factor - 1) / m_decimation_factor);
+}
+
+void c_resampler::resample(
+    const float *input,
+    size_t input_count,
+    float *output,
+    size_t first_output_index,
+    size_t output_count) const {
+    for (size_t i = 0; i < output_count; ++i) {
+        output[i] = compute_sample(input, input_count, first_output_index + i);
+    }
+}
+
+float c_resampler::compute_sample(const float *input, size_t input_count, size_t output_index) const {
+    uint64_t position = static_cast<uint64_t>(output_index) * m_decimation_factor;
+    uint64_t phase = position % m_interpolation_factor;
+    int64_t first_input_index = static_cast<int64_t>(position / m_interpolation_factor)
+        - static_cast<int64_t>(m_tap_count / 2) + 1;
+
+    const float *taps = nullptr;
+    const float *next_taps = nullptr;
+    float next_weight = 0.0f;
+    if (m_phase_count == m_interpolation_factor) {
+        taps = &m_taps[phase * m_tap_count];
+    } else {
+        double tabulated_phase = static_cast<double>(phase) * m_phase_count / m_interpolation_factor;
+        uint32_t phase_index = static_cast<uint32_t>(tabulated_phase);
+        taps = &m_taps[phase_index * m_tap_count];
+        next_taps = taps + m_tap_count;
+        next_weight = static_cast<float>(tabulated_phase - phase_index);
+    }
+
+    if (first_input_index >= 0 && static_cast<uint64_t>(first_input_index) + m_tap_count <= input_count) {
+        const float *samples = input + first_input_index;
+        float result = dot_product(samples, taps, m_tap_count);
+        if (next_taps) {
+            result += next_weight * (dot_product(samples, next_taps, m_tap_count) - result);
+        }
+
+        return result;
+    }
+
+    // Near the edges of the input, only some of the taps line up with input samples
+    float result = 0.0f;
+    float next_result = 0.0f;
+    for (uint32_t tap = 0; tap < m_tap_count; ++tap) {
+        int64_t input_index = first_input_index + tap;
+        if (input_index >= 0 && static_cast<uint64_t>(input_index) < input_count) {
+            result += input[input_index] * taps[tap];
+            if (next_taps) {
+                next_result += input[input_index] * next_taps[tap];
+            }
+        }
+    }
+
+    if (next_taps) {
+        result += next_weight * (next_result - result);
+    }
+
+    return result;
+}
+
+void resample(
+    const c_resampler &resampler,
+    const float *input,
+    size_t input_count,
+    std::vector<float> &output,
+    uint32_t thread_count) {
+    output.resize(resampler.get_output_count(input_count));
+    size_t block_count = (output.size() + k_output_block_size - 1) / k_output_block_size;
+    parallel_for(block_count, thread_count,
+        [&](size_t block_index) {
+            size_t first_output_index = block_index * k_output_block_size;
+            size_t count = std::min(k_output_block_size, output.size() - first_output_index);
+            resampler.resample(input, input_count, &output[first_output_index], first_output_index, count);
+        });
+}
@@ -0,0 +1,43 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <vector>
+
+// Converts single channel float samples between sample rates using a polyphase windowed-sinc filter. The ratio between
+// the rates is reduced to L/M, and output sample n lies at input position n * M / L. Each of the L possible fractional
+// positions (phases) gets its own set of Kaiser-windowed sinc taps, so producing a sample is a single dot product.
+// When L is too large for a table of every phase, the taps of the two nearest tabulated phases are interpolated.
+class c_resampler {
+public:
+    c_resampler(uint32_t input_sample_rate, uint32_t output_sample_rate);
+
+    // Returns the number of samples produced from input_count input samples
+    size_t get_output_count(size_t input_count) const;
+
+    // Computes output samples [first_output_index, first_output_index + output_count). Samples outside of the input are
+    // treated as silence. Ranges can be computed independently, e.g. on separate threads.
+    void resample(
+        const float *input,
+        size_t input_count,
+        float *output,
+        size_t first_output_index,
+        size_t output_count) const;
+
+private:
+    float compute_sample(const float *input, size_t input_count, size_t output_index) const;
+
+    uint64_t m_interpolation_factor = 1;    // L
+    uint64_t m_decimation_factor = 1;       // M
+    uint32_t m_phase_count = 0;             // Number of tabulated phases, L unless L is very large
+    uint32_t m_tap_count = 0;               // Taps per phase, a multiple of 4
+    std::vector<float> m_taps = {};         // (m_phase_count + 1) sets of taps, the last is phase 0 shifted by a sample
+};
+
+// Resamples a whole clip, spreading the work across up to thread_count threads (0 uses one thread per core)
+void resample(
+    const c_resampler &resampler,
+    const float *input,
+    size_t input_count,
+    std::vector<float> &output,
+    uint32_t thread_count);
@@ -9,7 +9,20 @@ extension = Extension(
     include_dirs = ["../portaudio/include"],
     libraries = [portaudio_library_name],
     library_dirs = [portaudio_library_directory],
-    sources = ["bind.cpp", "libengine.cpp", "wav.cpp"]
+    sources = [
+        "analysis.cpp",
+        "archive.cpp",
+        "bind.cpp",
+        "libengine.cpp",
+        "lossless.cpp",
+        "mapped_file.cpp",
+        "mix.cpp",
+        "render_cache.cpp",
+        "resampler.cpp",
+        "time_stretch.cpp",
+        "virtual_device.cpp",
+        "wav.cpp"
+    ]
 )
 
 setup(
@@ -0,0 +1,48 @@
+#pragma once
+
+#include <array>
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+
+// A fixed-size single producer, single consumer queue. Pushing never blocks or allocates: when the ring is full,
+// elements are dropped and counted instead.
+template<typename t_element, size_t k_ring_capacity>
+class c_spsc_ring {
+public:
+    static const size_t k_capacity = k_ring_capacity;
+
+    bool push(const t_element &element) {
+        uint64_t write_index = m_write_index.load(std::memory_order_relaxed);
+        if (write_index - m_read_index.load(std::memory_order_acquire) == k_capacity) {
+            m_dropped_count.fetch_add(1, std::memory_order_relaxed);
+            return false;
+        }
+
+        m_elements[write_index % k_capacity] = element;
+        m_write_index.store(write_index + 1, std::memory_order_release);
+        return true;
+    }
+
+    bool pop(t_element &element) {
+        uint64_t read_index = m_read_index.load(std::memory_order_relaxed);
+        if (read_index == m_write_index.load(std::memory_order_acquire)) {
+            return false;
+        }
+
+        element = m_elements[read_index % k_capacity];
+        m_read_index.store(read_index + 1, std::memory_order_release);
+        return true;
+    }
+
+    // Returns the number of elements dropped since the last call
+    uint64_t take_dropped_count() {
+        return m_dropped_count.exchange(0, std::memory_order_relaxed);
+    }
+
+private:
+    std::array<t_element, k_capacity> m_elements = {};
+    std::atomic<uint64_t> m_write_index = 0;
+    std::atomic<uint64_t> m_read_index = 0;
+    std::atomic<uint64_t> m_dropped_count = 0;
+};
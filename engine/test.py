@@ -1,10 +1,16 @@
 import engine
 import faulthandler
+import sys
+import threading
 import time
 
 faulthandler.enable()
 
-print(engine.initialize())
+# With --virtual, streams run on the engine's virtual devices as fast as possible, so no sound card is needed and the
+# results are deterministic
+virtual = "--virtual" in sys.argv
+
+print(engine.initialize(virtual))
 
 for i in range(engine.get_input_device_count()):
     print(engine.get_input_device_name(i))
@@ -12,19 +18,35 @@ for i in range(engine.get_input_device_count()):
 for i in range(engine.get_output_device_count()):
     print(engine.get_output_device_name(i))
 
-engine.set_sample_rate(44100)
-engine.set_metronome_samples_per_beat(44100 / 2.0)
+sample_rate = 44100
+engine.set_sample_rate(sample_rate)
+engine.set_metronome_samples_per_beat(sample_rate / 2.0)
+
+if virtual:
+    input_device_index = engine.get_input_device_count() - 1
+    output_device_index = engine.get_output_device_count() - 1
+    engine.set_virtual_input(440.0)
+else:
+    input_device_index = engine.get_default_input_device_index()
+    output_device_index = engine.get_default_output_device_index()
+
+# Runs the current stream for the given duration
+def run(seconds):
+    if virtual:
+        engine.wait_virtual_device()
+    else:
+        time.sleep(seconds)
+
+if virtual:
+    engine.set_virtual_device(False, int(3.0 * sample_rate))
 
-clip_id = engine.start_recording_clip(
-    engine.get_default_input_device_index(),
-    engine.get_default_output_device_index(),
-    1024)
+clip_id = engine.start_recording_clip(input_device_index, output_device_index, 1024)
 
-time.sleep(1.5)
+run(1.5)
 x = engine.get_latest_recorded_samples(100000)
 print(x[:50])
 print(x[len(x)-50:])
-time.sleep(1.5)
+run(1.5)
 
 engine.stop_recording_clip()
 engine.save_clip(clip_id, "test.wav")
@@ -37,13 +59,76 @@ print(engine.get_clip_samples(new_clip_id, 128))
 print(len(engine.get_clip_samples(new_clip_id, 0)))
 
 engine.playback_builder_begin()
-engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), -44100)
-engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), 0)
-engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), 44100)
+engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), -44100, 1.0)
+engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), 0, 1.0)
+engine.playback_builder_add_clip(new_clip_id, 0, engine.get_clip_sample_count(new_clip_id), 44100, 1.0)
 engine.playback_builder_finalize()
 
-engine.start_playback(engine.get_default_output_device_index(), 1024, 0)
-time.sleep(3.0)
+if virtual:
+    engine.set_virtual_device(False, int(3.0 * sample_rate))
+    engine.clear_virtual_output()
+
+engine.start_playback(output_device_index, 1024, 0)
+run(3.0)
 engine.stop_playback()
 
+if virtual:
+    output = engine.get_virtual_output()
+    print(len(output), max(output), min(output))
+
+# Engines are independent, so two of them rendering the same playback on their own threads should match each other and
+# the default engine exactly
+def render_test_playback(target_engine):
+    render_clip_id = target_engine.load_clip("test.wav")
+    render_clip_sample_count = target_engine.get_clip_sample_count(render_clip_id)
+    target_engine.playback_builder_begin()
+    target_engine.playback_builder_add_clip(render_clip_id, 0, render_clip_sample_count, -44100, 1.0)
+    target_engine.playback_builder_add_clip(render_clip_id, 0, render_clip_sample_count, 0, 1.0)
+    target_engine.playback_builder_add_clip(render_clip_id, 0, render_clip_sample_count, 44100, 0.5)
+    target_engine.playback_builder_finalize()
+    return target_engine.render_playback(0, 3 * sample_rate)
+
+engines = [engine.Engine(), engine.Engine()]
+for render_engine in engines:
+    render_engine.set_sample_rate(sample_rate)
+renders = [None] * len(engines)
+
+def render_on_engine(index):
+    renders[index] = render_test_playback(engines[index])
+
+render_threads = [threading.Thread(target = render_on_engine, args = (i,)) for i in range(len(engines))]
+for render_thread in render_threads:
+    render_thread.start()
+for render_thread in render_threads:
+    render_thread.join()
+
+expected_render = render_test_playback(engine)
+print("Engine renders match:", all(x == expected_render for x in renders), max(expected_render), min(expected_render))
+del engines
+
+if virtual:
+    # The loop doesn't line up with the buffer size, so it wraps partway through buffers. Looped playback should be the
+    # loop's span rendered over and over with no gap or repeated samples at the wraps.
+    engine.set_metronome_samples_per_beat(0.0)
+    loop_start_sample_index = sample_rate // 4
+    loop_end_sample_index = loop_start_sample_index + 10000
+    loop_repeat_count = 5
+    loop_output_sample_count = (loop_end_sample_index - loop_start_sample_index) * loop_repeat_count
+    engine.set_loop(loop_start_sample_index, loop_end_sample_index)
+    engine.set_virtual_device(False, loop_output_sample_count)
+    engine.clear_virtual_output()
+    engine.poll_events()
+    engine.start_playback(output_device_index, 1024, loop_start_sample_index)
+    run(loop_output_sample_count / sample_rate)
+    engine.stop_playback()
+    engine.clear_loop()
+
+    loop_output = engine.get_virtual_output()[:loop_output_sample_count]
+    expected_loop_output = engine.render_playback(loop_start_sample_index, loop_end_sample_index) * loop_repeat_count
+    loop_error = max(abs(x - y) for x, y in zip(loop_output, expected_loop_output))
+    wrap_count = sum(1 for x in engine.poll_events() if x[0] == "loop_wrapped")
+    print("Loop is gapless:", len(loop_output) == len(expected_loop_output) and loop_error < 1e-6, wrap_count)
+
+print(engine.get_stats())
+
 print(engine.shutdown())
@@ -0,0 +1,126 @@
+#include "time_stretch.h"
+
+#include <algorithm>
+#include <cmath>
+
+// Long enough to hold a couple of periods of most bass notes, short enough that transients don't smear audibly
+static const double k_hop_seconds = 0.02;
+
+// How far a frame can be moved to line up with the previous one, which needs to cover at least one period
+static const double k_tolerance_seconds = 0.01;
+
+// Frame positions are first searched at this spacing, then the best one is refined sample by sample
+static const ptrdiff_t k_coarse_search_step = 4;
+
+static const double k_pi = 3.141592653589793238463;
+
+// Uses several independent accumulators so the compiler can vectorize the loop without reordering a single sum.
+// count must be a multiple of 4.
+static float dot_product(const float *a, const float *b, size_t count) {
+    float sums[4] = { 0.0f, 0.0f, 0.0f, 0.0f };
+    for (size_t i = 0; i < count; i += 4) {
+        sums[0] += a[i] * b[i];
+        sums[1] += a[i + 1] * b[i + 1];
+        sums[2] += a[i + 2] * b[i + 2];
+        sums[3] += a[i + 3] * b[i + 3];
+    }
+
+    return (sums[0] + sums[1]) + (sums[2] + sums[3]);
+}
+
+c_time_stretcher::c_time_stretcher(uint32_t sample_rate, double ratio) {
+    m_ratio = ratio;
+    m_hop = std::max<size_t>(static_cast<size_t>(std::lround(sample_rate * k_hop_seconds / 4.0)), 1) * 4;
+    m_frame_length = m_hop * 2;
+    m_tolerance = static_cast<ptrdiff_t>(std::lround(sample_rate * k_tolerance_seconds));
+
+    // A periodic Hann window, so that frames overlapping by half sum to exactly 1
+    m_window.resize(m_frame_length);
+    for (size_t i = 0; i < m_frame_length; ++i) {
+        m_window[i] = static_cast<float>(0.5 - 0.5 * cos(2.0 * k_pi * static_cast<double>(i) / m_frame_length));
+    }
+}
+
+size_t c_time_stretcher::get_output_count(size_t input_count) const {
+    return static_cast<size_t>(std::llround(static_cast<double>(input_count) * m_ratio));
+}
+
+void c_time_stretcher::stretch(const float *input, size_t input_count, float *output) const {
+    size_t output_count = get_output_count(input_count);
+    if (m_ratio == 1.0) {
+        std::copy(input, input + input_count, output);
+        return;
+    }
+
+    // Padding the input with silence means frames near the edges don't need bounds checks
+    double analysis_hop = static_cast<double>(m_hop) / m_ratio;
+    size_t padding = m_frame_length + static_cast<size_t>(m_tolerance) + static_cast<size_t>(ceil(analysis_hop)) * 2;
+    std::vector<float> padded_input(padding + input_count + padding, 0.0f);
+    std::copy(input, input + input_count, padded_input.data() + padding);
+    ptrdiff_t max_frame_start = static_cast<ptrdiff_t>(padded_input.size() - m_frame_length);
+
+    // Output frame k covers output samples [(k - 1) * hop, (k + 1) * hop), so every output sample is covered by two
+    // frames. The frames are accumulated into a buffer which starts a hop before the output.
+    size_t frame_count = output_count / m_hop + 2;
+    std::vector<float> frame_output((frame_count + 1) * m_hop, 0.0f);
+    ptrdiff_t previous_frame_start = 0;
+    for (size_t frame_index = 0; frame_index < frame_count; ++frame_index) {
+        ptrdiff_t frame_start = static_cast<ptrdiff_t>(padding)
+            + static_cast<ptrdiff_t>(std::llround(static_cast<double>(frame_index) * analysis_hop))
+            - static_cast<ptrdiff_t>(m_hop);
+        frame_start = std::min(std::max(frame_start, ptrdiff_t(0)), max_frame_start);
+        if (frame_index > 0) {
+            // The input which followed the previous frame is what this frame should look like where they overlap
+            ptrdiff_t target_start = std::min(previous_frame_start + static_cast<ptrdiff_t>(m_hop), max_frame_start);
+            frame_start = find_best_frame_start(
+                padded_input.data(),
+                frame_start,
+                max_frame_start,
+                padded_input.data() + target_start);
+        }
+
+        const float *frame = padded_input.data() + frame_start;
+        float *frame_destination = frame_output.data() + frame_index * m_hop;
+        for (size_t i = 0; i < m_frame_length; ++i) {
+            frame_destination[i] += frame[i] * m_window[i];
+        }
+
+        previous_frame_start = frame_start;
+    }
+
+    std::copy(frame_output.begin() + m_hop, frame_output.begin() + m_hop + output_count, output);
+}
+
+ptrdiff_t c_time_stretcher::find_best_frame_start(
+    const float *input,
+    ptrdiff_t frame_start,
+    ptrdiff_t max_frame_start,
+    const float *target) const {
+    ptrdiff_t first_candidate = std::max(frame_start - m_tolerance, ptrdiff_t(0));
+    ptrdiff_t last_candidate = std::min(frame_start + m_tolerance, max_frame_start);
+
+    ptrdiff_t best_frame_start = frame_start;
+    float best_correlation = -INFINITY;
+    auto try_candidate = [&](ptrdiff_t candidate) {
+        float correlation = dot_product(input + candidate, target, m_hop);
+        if (correlation > best_correlation) {
+            best_correlation = correlation;
+            best_frame_start = candidate;
+        }
+    };
+
+    for (ptrdiff_t candidate = first_candidate; candidate <= last_candidate; candidate += k_coarse_search_step) {
+        try_candidate(candidate);
+    }
+
+    ptrdiff_t coarse_frame_start = best_frame_start;
+    ptrdiff_t first_fine_candidate = std::max(coarse_frame_start - (k_coarse_search_step - 1), first_candidate);
+    ptrdiff_t last_fine_candidate = std::min(coarse_frame_start + (k_coarse_search_step - 1), last_candidate);
+    for (ptrdiff_t candidate = first_fine_candidate; candidate <= last_fine_candidate; ++candidate) {
+        if (candidate != coarse_frame_start) {
+            try_candidate(candidate);
+        }
+    }
+
+    return best_frame_start;
+}
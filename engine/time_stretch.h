@@ -0,0 +1,37 @@
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <vector>
+
+// Changes the length of single channel float samples without changing their pitch using WSOLA (waveform similarity
+// overlap-add). The output is built from Hann-windowed frames of the input which overlap by half. Each frame is taken
+// from near the input position which the stretch ratio calls for, shifted by up to a small tolerance so that it lines up
+// with the waveform which followed the previous frame. This avoids the phasing which plain overlap-add produces.
+class c_time_stretcher {
+public:
+    // ratio is the output length divided by the input length
+    c_time_stretcher(uint32_t sample_rate, double ratio);
+
+    // Returns the number of samples produced from input_count input samples
+    size_t get_output_count(size_t input_count) const;
+
+    // Computes all get_output_count(input_count) output samples. Frames depend on the frames before them, so a clip is
+    // stretched by a single thread.
+    void stretch(const float *input, size_t input_count, float *output) const;
+
+private:
+    // Returns the frame start within [frame_start - m_tolerance, frame_start + m_tolerance] (clamped to
+    // [0, max_frame_start]) whose first half best matches target
+    ptrdiff_t find_best_frame_start(
+        const float *input,
+        ptrdiff_t frame_start,
+        ptrdiff_t max_frame_start,
+        const float *target) const;
+
+    double m_ratio = 1.0;
+    size_t m_hop = 0;                   // Output frames start every m_hop samples, a multiple of 4
+    size_t m_frame_length = 0;          // Twice the hop
+    ptrdiff_t m_tolerance = 0;          // How far a frame can be moved from its nominal position
+    std::vector<float> m_window = {};
+};
@@ -0,0 +1,29 @@
+#pragma once
+
+#include "spsc_ring.h"
+
+#include <chrono>
+#include <cstddef>
+#include <cstdint>
+
+// Returns the time in nanoseconds on the clock used for trace events
+inline int64_t get_trace_time() {
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(
+        std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+enum class e_trace_phase : uint8_t {
+    k_begin,
+    k_end,
+    k_instant
+};
+
+struct s_trace_event {
+    int64_t m_time;         // From get_trace_time()
+    e_trace_phase m_phase;
+    uint8_t m_name;         // Interpreted by the owner of the ring
+    int32_t m_argument;
+};
+
+// Trace events are pushed by the audio thread and read by Python
+using c_trace_ring = c_spsc_ring<s_trace_event, 1 << 16>;
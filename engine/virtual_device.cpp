@@ -0,0 +1,172 @@
+#include "virtual_device.h"
+
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstring>
+
+const float c_virtual_device::k_input_sine_amplitude = 0.5f;
+
+static const double k_pi = 3.141592653589793238463;
+
+c_virtual_device::~c_virtual_device() {
+    stop();
+}
+
+void c_virtual_device::start(
+    uint32_t sample_rate,
+    uint32_t frames_per_buffer,
+    bool has_input,
+    PaStreamCallback *callback,
+    void *user_data,
+    const std::function<bool()> &ready) {
+    stop();
+
+    m_stream_settings = m_settings;
+    m_sample_rate = sample_rate;
+    m_frames_per_buffer = frames_per_buffer;
+    m_has_input = has_input;
+    m_callback = callback;
+    m_user_data = user_data;
+    m_ready = ready;
+
+    // Whole buffers are captured, so the last one may run past the frame limit
+    size_t capture_frame_count = 0;
+    if (m_stream_settings.m_capture_output && m_stream_settings.m_frame_limit > 0) {
+        uint64_t buffer_count = (m_stream_settings.m_frame_limit + frames_per_buffer - 1) / frames_per_buffer;
+        capture_frame_count = static_cast<size_t>(buffer_count * frames_per_buffer);
+    }
+
+    m_output.resize(m_output_count + capture_frame_count);
+
+    m_terminate = false;
+    m_frame_count = 0;
+    {
+        std::lock_guard<std::mutex> lock(m_finished_mutex);
+        m_finished = false;
+    }
+
+    m_thread = new std::thread(&c_virtual_device::thread_main, this);
+}
+
+void c_virtual_device::stop() {
+    if (m_thread) {
+        m_terminate = true;
+        m_thread->join();
+        delete m_thread;
+        m_thread = nullptr;
+    }
+}
+
+void c_virtual_device::wait() {
+    std::unique_lock<std::mutex> lock(m_finished_mutex);
+    m_finished_condition.wait(lock, [this]() { return m_finished; });
+}
+
+void c_virtual_device::get_output(std::vector<float> &output) const {
+    size_t output_count = m_output_count.load(std::memory_order_acquire);
+    output.assign(m_output.begin(), m_output.begin() + output_count);
+}
+
+void c_virtual_device::clear_output() {
+    m_output_count = 0;
+    m_output.clear();
+}
+
+void c_virtual_device::thread_main() {
+    std::vector<float> input(m_has_input ? m_frames_per_buffer : 0);
+    std::vector<float> output(m_frames_per_buffer);
+
+    std::chrono::steady_clock::time_point start_time = std::chrono::steady_clock::now();
+    uint64_t frame_count = 0;
+    bool complete = false;
+    while (!m_terminate && !complete) {
+        if (m_stream_settings.m_frame_limit > 0 && frame_count >= m_stream_settings.m_frame_limit) {
+            break;
+        }
+
+        if (m_stream_settings.m_realtime) {
+            // Call back once per buffer period, like a sound card pulling buffers at a fixed rate
+            std::chrono::duration<double> buffer_time(static_cast<double>(frame_count) / m_sample_rate);
+            std::this_thread::sleep_until(
+                start_time + std::chrono::duration_cast<std::chrono::steady_clock::duration>(buffer_time));
+        } else if (m_ready) {
+            while (!m_terminate && !m_ready()) {
+                std::this_thread::sleep_for(std::chrono::milliseconds(1));
+            }
+
+            if (m_terminate) {
+                break;
+            }
+        }
+
+        if (m_has_input) {
+            generate_input(input.data(), input.size());
+        }
+
+        // Stream time is the simulated time, with no latency between input, callback and output
+        PaStreamCallbackTimeInfo time_info;
+        time_info.currentTime = static_cast<double>(frame_count) / m_sample_rate;
+        time_info.inputBufferAdcTime = time_info.currentTime;
+        time_info.outputBufferDacTime = time_info.currentTime;
+
+        int result = m_callback(
+            m_has_input ? input.data() : nullptr,
+            output.data(),
+            m_frames_per_buffer,
+            &time_info,
+            0,
+            m_user_data);
+        complete = result != paContinue;
+
+        size_t output_count = m_output_count.load(std::memory_order_relaxed);
+        if (output_count + output.size() <= m_output.size()) {
+            std::copy(output.begin(), output.end(), m_output.begin() + output_count);
+            m_output_count.store(output_count + output.size(), std::memory_order_release);
+        }
+
+        frame_count += m_frames_per_buffer;
+        m_frame_count = frame_count;
+    }
+
+    {
+        std::lock_guard<std::mutex> lock(m_finished_mutex);
+        m_finished = true;
+    }
+
+    m_finished_condition.notify_all();
+}
+
+void c_virtual_device::generate_input(float *input, size_t frame_count) {
+    uint64_t first_frame_index = m_frame_count;
+    switch (m_stream_settings.m_input_source) {
+    case e_virtual_input_source::k_silence:
+        memset(input, 0, frame_count * sizeof(float));
+        break;
+
+    case e_virtual_input_source::k_sine:
+    {
+        // Computed from the absolute frame index so the phase never drifts
+        double sample_sine_multiplier = m_stream_settings.m_input_sine_frequency * 2.0 * k_pi / m_sample_rate;
+        for (size_t i = 0; i < frame_count; ++i) {
+            double phase = static_cast<double>(first_frame_index + i) * sample_sine_multiplier;
+            input[i] = static_cast<float>(sin(phase)) * k_input_sine_amplitude;
+        }
+        break;
+    }
+
+    case e_virtual_input_source::k_samples:
+    {
+        const std::vector<float> &samples = m_stream_settings.m_input_samples;
+        size_t copy_count = first_frame_index < samples.size()
+            ? std::min(frame_count, static_cast<size_t>(samples.size() - first_frame_index))
+            : 0;
+        if (copy_count > 0) {
+            memcpy(input, &samples[first_frame_index], copy_count * sizeof(float));
+        }
+
+        memset(input + copy_count, 0, (frame_count - copy_count) * sizeof(float));
+        break;
+    }
+    }
+}
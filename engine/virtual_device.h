@@ -0,0 +1,98 @@
+#pragma once
+
+#include <portaudio.h>
+
+#include <atomic>
+#include <condition_variable>
+#include <cstddef>
+#include <cstdint>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+enum class e_virtual_input_source {
+    k_silence,
+    k_sine,
+    k_samples
+};
+
+struct s_virtual_device_settings {
+    bool m_realtime = false;        // Pace callbacks like a sound card rather than running them back to back
+    uint64_t m_frame_limit = 0;     // Stop calling back once this many frames have been processed, 0 for no limit
+    bool m_capture_output = true;   // Only streams with a frame limit are captured
+
+    e_virtual_input_source m_input_source = e_virtual_input_source::k_silence;
+    double m_input_sine_frequency = 0.0;
+    std::vector<float> m_input_samples = {};    // Followed by silence once they run out
+};
+
+// A stand-in for a sound card which drives a portaudio stream callback from its own thread. Input is generated from
+// the settings and output is captured to memory, so streams can run with no audio hardware. Space for the captured
+// output is allocated when a stream starts, so the callback thread never allocates or takes a lock.
+class c_virtual_device {
+public:
+    static const float k_input_sine_amplitude;
+
+    c_virtual_device() = default;
+    ~c_virtual_device();
+
+    c_virtual_device(const c_virtual_device &) = delete;
+    c_virtual_device &operator=(const c_virtual_device &) = delete;
+
+    // Settings are copied when a stream starts, so changes take effect on the next stream
+    s_virtual_device_settings &get_settings() { return m_settings; }
+
+    // Starts calling back on a new thread. If ready is provided, the thread waits for it to return true before each
+    // callback when not running in real time, which lets helper threads keep up with a stream running flat out.
+    void start(
+        uint32_t sample_rate,
+        uint32_t frames_per_buffer,
+        bool has_input,
+        PaStreamCallback *callback,
+        void *user_data,
+        const std::function<bool()> &ready);
+    void stop();
+    bool is_running() const { return m_thread != nullptr; }
+
+    // Blocks until the stream has reached its frame limit or its callback has returned something other than paContinue
+    void wait();
+
+    // Returns the number of frames the stream has processed
+    uint64_t get_frame_count() const { return m_frame_count; }
+
+    // Returns the frame limit of the running stream
+    uint64_t get_stream_frame_limit() const { return m_stream_settings.m_frame_limit; }
+
+    // Captured output accumulates across streams until it is cleared. It can be read while a stream is running, but
+    // only cleared while none is.
+    void get_output(std::vector<float> &output) const;
+    void clear_output();
+
+private:
+    void thread_main();
+    void generate_input(float *input, size_t frame_count);
+
+    s_virtual_device_settings m_settings = {};
+
+    // Only used by the callback thread while a stream is running
+    s_virtual_device_settings m_stream_settings = {};
+    uint32_t m_sample_rate = 0;
+    uint32_t m_frames_per_buffer = 0;
+    bool m_has_input = false;
+    PaStreamCallback *m_callback = nullptr;
+    void *m_user_data = nullptr;
+    std::function<bool()> m_ready = nullptr;
+
+    std::thread *m_thread = nullptr;
+    std::atomic<bool> m_terminate = false;
+    std::atomic<uint64_t> m_frame_count = 0;
+
+    std::mutex m_finished_mutex;
+    std::condition_variable m_finished_condition;
+    bool m_finished = false;
+
+    // Sized when a stream starts, the callback thread fills it up to m_output_count
+    std::vector<float> m_output = {};
+    std::atomic<size_t> m_output_count = 0;
+};
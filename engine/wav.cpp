@@ -1,5 +1,8 @@
 #include "wav.h"
 
+#include <algorithm>
+#include <cassert>
+#include <cstring>
 #include <fstream>
 
 struct s_wav_header {
@@ -50,70 +53,371 @@ t_value native_to_little_endian(t_value value) {
     return value;
 }
 
-bool read_wav(const char *filename, std::vector<float> &samples, uint32_t &sample_rate) {
-    std::ifstream file;
-    file.open(filename, std::ios::binary);
-    if (!file.is_open()) {
-        return false;
+static bool is_native_little_endian() {
+    uint16_t value = 1;
+    uint8_t first_byte;
+    memcpy(&first_byte, &value, sizeof(first_byte));
+    return first_byte == 1;
+}
+
+// Audio format tags
+static const uint16_t k_wave_format_pcm = 1;
+static const uint16_t k_wave_format_ieee_float = 3;
+static const uint16_t k_wave_format_extensible = 0xfffe;
+
+// Number of frames read and converted at a time while streaming samples from disk
+static const size_t k_read_block_frame_count = 65536;
+
+enum class e_wav_sample_format {
+    k_pcm_8,
+    k_pcm_16,
+    k_pcm_24,
+    k_pcm_32,
+    k_float_32,
+    k_float_64
+};
+
+struct s_wav_format {
+    e_wav_sample_format m_sample_format;
+    uint32_t m_channel_count;
+    uint32_t m_sample_rate;
+    uint32_t m_block_align;         // Bytes per frame
+    uint64_t m_data_offset;
+    uint64_t m_frame_count;
+};
+
+static uint16_t read_u16(const uint8_t *data) {
+    return static_cast<uint16_t>(data[0] | (data[1] << 8));
+}
+
+static uint32_t read_u32(const uint8_t *data) {
+    return static_cast<uint32_t>(data[0])
+        | (static_cast<uint32_t>(data[1]) << 8)
+        | (static_cast<uint32_t>(data[2]) << 16)
+        | (static_cast<uint32_t>(data[3]) << 24);
+}
+
+static uint64_t read_u64(const uint8_t *data) {
+    return static_cast<uint64_t>(read_u32(data)) | (static_cast<uint64_t>(read_u32(data + 4)) << 32);
+}
+
+// Sample converters, each reads one little endian sample and returns it as a float in [-1, 1]
+struct s_pcm_8_sample {
+    static const size_t k_size = 1;
+    static float to_float(const uint8_t *data) {
+        // 8-bit wavs are unsigned
+        return static_cast<float>(static_cast<int32_t>(data[0]) - 128) * (1.0f / 128.0f);
     }
+};
 
-    s_wav_header header;
-    file.read(reinterpret_cast<char *>(&header), sizeof(header));
-    if (file.fail()) {
+struct s_pcm_16_sample {
+    static const size_t k_size = 2;
+    static float to_float(const uint8_t *data) {
+        return static_cast<float>(static_cast<int16_t>(read_u16(data))) * (1.0f / 32768.0f);
+    }
+};
+
+struct s_pcm_24_sample {
+    static const size_t k_size = 3;
+    static float to_float(const uint8_t *data) {
+        // Place the value in the top 24 bits and shift back down to sign extend it
+        int32_t value = static_cast<int32_t>(
+            (static_cast<uint32_t>(data[0]) << 8)
+            | (static_cast<uint32_t>(data[1]) << 16)
+            | (static_cast<uint32_t>(data[2]) << 24)) >> 8;
+        return static_cast<float>(value) * (1.0f / 8388608.0f);
+    }
+};
+
+struct s_pcm_32_sample {
+    static const size_t k_size = 4;
+    static float to_float(const uint8_t *data) {
+        return static_cast<float>(static_cast<int32_t>(read_u32(data))) * (1.0f / 2147483648.0f);
+    }
+};
+
+struct s_float_32_sample {
+    static const size_t k_size = 4;
+    static float to_float(const uint8_t *data) {
+        uint32_t bits = read_u32(data);
+        float value;
+        memcpy(&value, &bits, sizeof(value));
+        return value;
+    }
+};
+
+struct s_float_64_sample {
+    static const size_t k_size = 8;
+    static float to_float(const uint8_t *data) {
+        uint64_t bits = read_u64(data);
+        double value;
+        memcpy(&value, &bits, sizeof(value));
+        return static_cast<float>(value);
+    }
+};
+
+// Converts interleaved frames to single channel float samples, averaging the channels together. Each sample type gets
+// its own instantiation with a fixed stride so the compiler can vectorize the loops.
+template<typename t_sample>
+static void convert_frames(const uint8_t *data, size_t frame_count, uint32_t channel_count, float *samples) {
+    if (channel_count == 1) {
+        for (size_t i = 0; i < frame_count; ++i) {
+            samples[i] = t_sample::to_float(data + i * t_sample::k_size);
+        }
+    } else if (channel_count == 2) {
+        for (size_t i = 0; i < frame_count; ++i) {
+            const uint8_t *frame = data + i * 2 * t_sample::k_size;
+            samples[i] = (t_sample::to_float(frame) + t_sample::to_float(frame + t_sample::k_size)) * 0.5f;
+        }
+    } else {
+        float scale = 1.0f / static_cast<float>(channel_count);
+        for (size_t i = 0; i < frame_count; ++i) {
+            const uint8_t *frame = data + i * channel_count * t_sample::k_size;
+            float sum = 0.0f;
+            for (uint32_t channel = 0; channel < channel_count; ++channel) {
+                sum += t_sample::to_float(frame + channel * t_sample::k_size);
+            }
+            samples[i] = sum * scale;
+        }
+    }
+}
+
+static void convert_frames(const s_wav_format &format, const uint8_t *data, size_t frame_count, float *samples) {
+    switch (format.m_sample_format) {
+    case e_wav_sample_format::k_pcm_8:
+        convert_frames<s_pcm_8_sample>(data, frame_count, format.m_channel_count, samples);
+        break;
+
+    case e_wav_sample_format::k_pcm_16:
+        convert_frames<s_pcm_16_sample>(data, frame_count, format.m_channel_count, samples);
+        break;
+
+    case e_wav_sample_format::k_pcm_24:
+        convert_frames<s_pcm_24_sample>(data, frame_count, format.m_channel_count, samples);
+        break;
+
+    case e_wav_sample_format::k_pcm_32:
+        convert_frames<s_pcm_32_sample>(data, frame_count, format.m_channel_count, samples);
+        break;
+
+    case e_wav_sample_format::k_float_32:
+        if (format.m_channel_count == 1 && is_native_little_endian()) {
+            // Already in the right format
+            memcpy(samples, data, frame_count * sizeof(float));
+        } else {
+            convert_frames<s_float_32_sample>(data, frame_count, format.m_channel_count, samples);
+        }
+        break;
+
+    case e_wav_sample_format::k_float_64:
+        convert_frames<s_float_64_sample>(data, frame_count, format.m_channel_count, samples);
+        break;
+
+    default:
+        assert(false);
+    }
+}
+
+// Determines the sample format from the contents of a fmt chunk
+static bool parse_fmt_chunk(const uint8_t *data, size_t size, s_wav_format &format) {
+    if (size < 16) {
         return false;
     }
 
-    header.m_chunk_size = little_to_native_endian(header.m_chunk_size);
-    header.m_subchunk_1_size = little_to_native_endian(header.m_subchunk_1_size);
-    header.m_audio_format = little_to_native_endian(header.m_audio_format);
-    header.m_channel_count = little_to_native_endian(header.m_channel_count);
-    header.m_sample_rate = little_to_native_endian(header.m_sample_rate);
-    header.m_byte_rate = little_to_native_endian(header.m_byte_rate);
-    header.m_block_align = little_to_native_endian(header.m_block_align);
-    header.m_bits_per_sample = little_to_native_endian(header.m_bits_per_sample);
-    header.m_subchunk_2_size = little_to_native_endian(header.m_subchunk_2_size);
+    uint16_t audio_format = read_u16(data);
+    uint16_t channel_count = read_u16(data + 2);
+    uint32_t sample_rate = read_u32(data + 4);
+    uint16_t block_align = read_u16(data + 12);
 
-    static const uint8_t k_riff[] = { 'R', 'I', 'F', 'F' };
-    if (memcmp(header.m_riff, k_riff, sizeof(k_riff)) != 0) {
+    if (audio_format == k_wave_format_extensible) {
+        // The extension holds the valid bit count, the channel mask and then a sub-format GUID whose first two bytes are
+        // the actual format tag
+        if (size < 40 || read_u16(data + 16) < 22) {
+            return false;
+        }
+
+        audio_format = read_u16(data + 24);
+    }
+
+    if (channel_count == 0 || sample_rate == 0 || block_align == 0 || block_align % channel_count != 0) {
         return false;
     }
 
-    static const uint8_t k_wave[] = { 'W', 'A', 'V', 'E' };
-    if (memcmp(header.m_wave, k_wave, sizeof(k_wave)) != 0) {
+    // Go by the container size rather than bits per sample, e.g. 20-bit samples are stored in 3 bytes. Samples are
+    // left-justified within their container so the extra low bits are zero.
+    uint32_t bytes_per_sample = block_align / channel_count;
+    if (audio_format == k_wave_format_pcm) {
+        switch (bytes_per_sample) {
+        case 1:
+            format.m_sample_format = e_wav_sample_format::k_pcm_8;
+            break;
+
+        case 2:
+            format.m_sample_format = e_wav_sample_format::k_pcm_16;
+            break;
+
+        case 3:
+            format.m_sample_format = e_wav_sample_format::k_pcm_24;
+            break;
+
+        case 4:
+            format.m_sample_format = e_wav_sample_format::k_pcm_32;
+            break;
+
+        default:
+            return false;
+        }
+    } else if (audio_format == k_wave_format_ieee_float) {
+        switch (bytes_per_sample) {
+        case 4:
+            format.m_sample_format = e_wav_sample_format::k_float_32;
+            break;
+
+        case 8:
+            format.m_sample_format = e_wav_sample_format::k_float_64;
+            break;
+
+        default:
+            return false;
+        }
+    } else {
         return false;
     }
 
+    format.m_channel_count = channel_count;
+    format.m_sample_rate = sample_rate;
+    format.m_block_align = block_align;
+    return true;
+}
+
+// Walks the RIFF chunks to find the format and the sample data, skipping any other chunks (LIST, fact, etc.).
+// read(offset, buffer, size) reads bytes from the file and returns false on failure.
+template<typename t_read>
+static bool find_wav_format(uint64_t file_size, const t_read &read, s_wav_format &format) {
+    static const uint8_t k_riff[] = { 'R', 'I', 'F', 'F' };
+    static const uint8_t k_wave[] = { 'W', 'A', 'V', 'E' };
     static const uint8_t k_fmt[] = { 'f', 'm', 't', ' ' };
-    if (memcmp(header.m_subchunk_1_id, k_fmt, sizeof(k_fmt)) != 0) {
+    static const uint8_t k_data[] = { 'd', 'a', 't', 'a' };
+
+    uint8_t riff_header[12];
+    if (file_size < sizeof(riff_header)
+        || !read(0, riff_header, sizeof(riff_header))
+        || memcmp(riff_header, k_riff, sizeof(k_riff)) != 0
+        || memcmp(riff_header + 8, k_wave, sizeof(k_wave)) != 0) {
         return false;
     }
 
-    if (header.m_subchunk_1_size != 16
-        || header.m_audio_format != 3 // float format
-        || header.m_channel_count != 1
-        || header.m_byte_rate != header.m_channel_count * header.m_sample_rate * header.m_bits_per_sample / 8
-        || header.m_block_align != header.m_channel_count * header.m_bits_per_sample / 8
-        || header.m_bits_per_sample != sizeof(float) * 8) { // 32 bits per float sample
+    bool found_fmt = false;
+    uint64_t offset = sizeof(riff_header);
+    while (file_size - offset >= 8) {
+        uint8_t chunk_header[8];
+        if (!read(offset, chunk_header, sizeof(chunk_header))) {
+            return false;
+        }
+
+        uint64_t chunk_size = read_u32(chunk_header + 4);
+        uint64_t chunk_data_offset = offset + sizeof(chunk_header);
+        if (memcmp(chunk_header, k_fmt, sizeof(k_fmt)) == 0) {
+            uint8_t fmt_data[40];
+            size_t fmt_size = static_cast<size_t>(std::min<uint64_t>(chunk_size, sizeof(fmt_data)));
+            if (fmt_size > file_size - chunk_data_offset
+                || !read(chunk_data_offset, fmt_data, fmt_size)
+                || !parse_fmt_chunk(fmt_data, fmt_size, format)) {
+                return false;
+            }
+
+            found_fmt = true;
+        } else if (memcmp(chunk_header, k_data, sizeof(k_data)) == 0) {
+            if (!found_fmt) {
+                return false;
+            }
+
+            // Writers which were interrupted (or which stream) can leave the size too large, so only use what's there
+            uint64_t data_size = std::min(chunk_size, file_size - chunk_data_offset);
+            format.m_data_offset = chunk_data_offset;
+            format.m_frame_count = data_size / format.m_block_align;
+            return true;
+        }
+
+        // Chunks are padded to an even size
+        offset = chunk_data_offset + chunk_size + (chunk_size & 1);
+        if (offset > file_size) {
+            return false;
+        }
+    }
+
+    return false;
+}
+
+bool read_wav(const char *filename, std::vector<float> &samples, uint32_t &sample_rate) {
+    std::ifstream file;
+    file.open(filename, std::ios::binary | std::ios::ate);
+    if (!file.is_open()) {
         return false;
     }
 
-    static const uint8_t k_data[] = { 'd', 'a', 't', 'a' };
-    if (memcmp(header.m_subchunk_2_id, k_data, sizeof(k_data)) != 0) {
+    uint64_t file_size = static_cast<uint64_t>(file.tellg());
+    auto read = [&](uint64_t offset, uint8_t *buffer, size_t size) {
+        file.seekg(static_cast<std::streamoff>(offset));
+        file.read(reinterpret_cast<char *>(buffer), static_cast<std::streamsize>(size));
+        return !file.fail();
+    };
+
+    s_wav_format format;
+    if (!find_wav_format(file_size, read, format)) {
         return false;
     }
 
-    if (header.m_subchunk_2_size % (header.m_channel_count * header.m_bits_per_sample / 8) != 0) {
+    // Stream the data through a fixed size buffer, converting a block at a time
+    size_t frame_count = static_cast<size_t>(format.m_frame_count);
+    samples.resize(frame_count);
+    std::vector<uint8_t> block(std::min(frame_count, k_read_block_frame_count) * format.m_block_align);
+    file.seekg(static_cast<std::streamoff>(format.m_data_offset));
+    for (size_t first_frame = 0; first_frame < frame_count; first_frame += k_read_block_frame_count) {
+        size_t block_frame_count = std::min(frame_count - first_frame, k_read_block_frame_count);
+        file.read(reinterpret_cast<char *>(block.data()), block_frame_count * format.m_block_align);
+        if (file.fail()) {
+            return false;
+        }
+
+        convert_frames(format, block.data(), block_frame_count, &samples[first_frame]);
+    }
+
+    sample_rate = format.m_sample_rate;
+    return true;
+}
+
+bool find_wav_samples(
+    const uint8_t *data,
+    size_t size,
+    const float *&samples,
+    size_t &sample_count,
+    uint32_t &sample_rate) {
+    // The samples are used in place, so they must already be in the right byte order
+    if (!is_native_little_endian()) {
         return false;
     }
 
-    uint32_t sample_count = header.m_subchunk_2_size / sizeof(float);
+    auto read = [&](uint64_t offset, uint8_t *buffer, size_t read_size) {
+        memcpy(buffer, data + offset, read_size);
+        return true;
+    };
 
-    samples.resize(sample_count);
-    if (sample_count > 0) {
-        file.read(reinterpret_cast<char *>(&samples.front()), sample_count * sizeof(float));
+    s_wav_format format;
+    if (!find_wav_format(size, read, format)
+        || format.m_sample_format != e_wav_sample_format::k_float_32
+        || format.m_channel_count != 1) {
+        return false;
+    }
+
+    const uint8_t *sample_data = data + format.m_data_offset;
+    if (reinterpret_cast<uintptr_t>(sample_data) % alignof(float) != 0) {
+        return false;
     }
-    sample_rate = header.m_sample_rate;
 
+    samples = reinterpret_cast<const float *>(sample_data);
+    sample_count = static_cast<size_t>(format.m_frame_count);
+    sample_rate = format.m_sample_rate;
     return true;
 }
 
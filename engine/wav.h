@@ -1,7 +1,21 @@
 #pragma once
 
+#include <cstddef>
+#include <cstdint>
 #include <vector>
 
-// Reads/writes single channel float wavs
+// Reads a wav with 8/16/24/32-bit PCM or 32/64-bit float samples (including WAVE_FORMAT_EXTENSIBLE files), converting
+// to single channel float. Multiple channels are downmixed by averaging them.
 bool read_wav(const char *filename, std::vector<float> &samples, uint32_t &sample_rate);
+
+// Writes a single channel float wav
 bool write_wav(const char *filename, const float *samples, size_t sample_count, uint32_t sample_rate);
+
+// Locates the samples of a single channel float wav which is already in memory (e.g. memory-mapped) so they can be used
+// in place. Fails if the samples can't be used directly because of their format, byte order or alignment.
+bool find_wav_samples(
+    const uint8_t *data,
+    size_t size,
+    const float *&samples,
+    size_t &sample_count,
+    uint32_t &sample_rate);
@@ -8,10 +8,12 @@ from pygame.locals import *
 from song_sketcher import drawing
 from song_sketcher import editor
 from song_sketcher import engine
+from song_sketcher import engine_events
 from song_sketcher import parameter
 from song_sketcher import project_manager
 from song_sketcher import settings
 from song_sketcher import timer
+from song_sketcher import trace
 from song_sketcher import units
 from song_sketcher import widget_manager
 
@@ -38,6 +40,8 @@ class SongSketcher:
         widget_manager.initialize(self._display_size)
         project_manager.initialize()
         engine.initialize()
+        engine_events.initialize()
+        trace.initialize()
         settings.initialize()
 
         self._editor = editor.Editor()
@@ -46,6 +50,8 @@ class SongSketcher:
         self._editor.shutdown()
 
         settings.shutdown()
+        trace.shutdown()
+        engine_events.shutdown()
         engine.shutdown()
         project_manager.shutdown()
         widget_manager.shutdown()
@@ -61,6 +67,10 @@ class SongSketcher:
         while not self._editor.should_quit():
             clock.tick(fps)
 
+            trace.begin("frame")
+            trace.update()
+
+            engine_events.update()
             parameter.update(dt)
             timer.update(dt)
 
@@ -74,11 +84,17 @@ class SongSketcher:
 
             self._editor.update(dt)
 
+            trace.begin("draw")
             drawing.drawing_begin(self._display_size[0], self._display_size[1])
             widget_manager.get().draw()
             drawing.drawing_end()
+            trace.end("draw")
 
+            trace.begin("flip")
             pygame.display.flip()
+            trace.end("flip")
+
+            trace.end("frame")
 
 song_sketcher = SongSketcher()
 song_sketcher.run()
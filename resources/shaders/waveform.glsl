@@ -50,6 +50,12 @@ uniform vec4 waveform_rgba;
 uniform vec4 border_rgba;
 uniform float border_thickness;
 
+// Added to the texture coordinate, used to scroll ring textures
+uniform float texture_offset;
+
+// If true, each texel holds the (min, max) range of a column of samples rather than a single sample
+uniform bool min_max;
+
 uniform vec2 xy1;
 uniform vec2 xy2;
 
@@ -89,15 +95,21 @@ void main()
     float inner_edge = left_inner_edge * bottom_inner_edge * right_inner_edge * top_inner_edge;
 
     vec2 uv = (xy - xy_min + vec2(border_thickness)) / (xy_max - xy_min - 2.0 * vec2(border_thickness));
-    float waveform_y = texture(waveform_texture, uv.x).r;
+    vec2 waveform_texel = texture(waveform_texture, uv.x + texture_offset).rg;
 
     float fragment_y = uv.y * 2.0 - 1.0;
-    float waveform_edge = 1.0 - smooth_edge(fragment_y, waveform_y); // 0 if background, 1 if waveform
-    bool is_waveform_positive = waveform_y >= 0.0;
-    bool is_fragment_positive = fragment_y >= 0.0;
-    bool is_side_correct = is_waveform_positive == is_fragment_positive;
-    waveform_edge = is_waveform_positive ? waveform_edge : 1.0 - waveform_edge;
-    waveform_edge *= float(is_side_correct);
+    float waveform_edge; // 0 if background, 1 if waveform
+    if (min_max) {
+        waveform_edge = smooth_edge(fragment_y, waveform_texel.r) * (1.0 - smooth_edge(fragment_y, waveform_texel.g));
+    } else {
+        float waveform_y = waveform_texel.r;
+        waveform_edge = 1.0 - smooth_edge(fragment_y, waveform_y);
+        bool is_waveform_positive = waveform_y >= 0.0;
+        bool is_fragment_positive = fragment_y >= 0.0;
+        bool is_side_correct = is_waveform_positive == is_fragment_positive;
+        waveform_edge = is_waveform_positive ? waveform_edge : 1.0 - waveform_edge;
+        waveform_edge *= float(is_side_correct);
+    }
 
     vec4 inner_color = mix(background_rgba, waveform_rgba, waveform_edge);
     vec4 color = mix(border_rgba, inner_color, inner_edge);
@@ -0,0 +1,112 @@
+from song_sketcher import drawing
+from song_sketcher import engine
+from song_sketcher import engine_events
+from song_sketcher import modal_dialog
+from song_sketcher.units import *
+from song_sketcher import widget
+
+class ChangeTempoDialog:
+    # on_accept_func takes the new beats per minute and a list of engine clips, one per project clip, holding the clip's
+    # samples stretched to the new tempo. on_closed_func is called once the dialog closes, whether or not it was accepted,
+    # which is when clips can be saved again.
+    def __init__(self, stack_widget, project, on_accept_func, on_closed_func):
+        self._project = project
+        self._on_accept_func = on_accept_func
+        self._on_closed_func = on_closed_func
+        self._stretch_event_subscription = None
+
+        layout = widget.VStackedLayoutWidget()
+
+        title = widget.TextWidget()
+        title.text = "Change tempo"
+        title.size.value = points(20.0)
+        title.horizontal_alignment = drawing.HorizontalAlignment.CENTER
+        title.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+        layout.add_child(title)
+
+        layout.add_padding(points(12.0))
+
+        options_layout = widget.GridLayoutWidget()
+        layout.add_child(options_layout)
+
+        options_layout.set_column_size(1, points(4.0))
+
+        beats_per_minute_title = widget.TextWidget()
+        options_layout.add_child(0, 0, beats_per_minute_title, horizontal_placement = widget.HorizontalPlacement.RIGHT)
+        beats_per_minute_title.text = "Beats per minute:"
+        beats_per_minute_title.horizontal_alignment = drawing.HorizontalAlignment.RIGHT
+        beats_per_minute_title.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+
+        self._beats_per_minute = widget.SpinnerWidget()
+        self._beats_per_minute.min_value = 40.0
+        self._beats_per_minute.max_value = 160.0
+        self._beats_per_minute.value = project.beats_per_minute
+        self._beats_per_minute.decimals = 1
+        options_layout.add_child(0, 2, self._beats_per_minute)
+
+        layout.add_padding(points(12.0))
+
+        self._progress_text = widget.TextWidget()
+        layout.add_child(self._progress_text)
+        self._progress_text.text = "Clips are stretched to keep their length in measures."
+        self._progress_text.horizontal_alignment = drawing.HorizontalAlignment.CENTER
+        self._progress_text.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+
+        layout.add_padding(points(12.0))
+
+        buttons_layout = widget.HStackedLayoutWidget()
+        layout.add_child(buttons_layout)
+        buttons_layout.add_padding(0.0, weight = 1.0)
+
+        cancel_button = widget.TextButtonWidget()
+        buttons_layout.add_child(cancel_button)
+        cancel_button.text = "Cancel"
+        cancel_button.action_func = self.cancel
+
+        buttons_layout.add_padding(points(4.0))
+
+        self._ok_button = widget.TextButtonWidget()
+        buttons_layout.add_child(self._ok_button)
+        self._ok_button.text = "OK"
+        self._ok_button.action_func = self._accept
+
+        self._destroy_func = modal_dialog.show_modal_dialog(stack_widget, layout)
+
+    def cancel(self):
+        if self._stretch_event_subscription is not None:
+            self._stretch_event_subscription.cancel()
+            self._stretch_event_subscription = None
+            engine.cancel_time_stretch()
+        self._close()
+
+    def _close(self):
+        self._destroy_func()
+        self._on_closed_func()
+
+    def _accept(self):
+        beats_per_minute = self._beats_per_minute.value
+        if beats_per_minute == self._project.beats_per_minute:
+            self._close()
+            return
+
+        # A clip keeps its measure count if its length scales inversely with the tempo
+        self._beats_per_minute.set_enabled(False)
+        self._ok_button.set_enabled(False)
+        engine.start_time_stretch(
+            [x.engine_clip for x in self._project.clips],
+            self._project.beats_per_minute / beats_per_minute)
+        self._update_progress_text(0)
+        self._stretch_event_subscription = engine_events.Subscription(self._on_stretch_event)
+
+    def _on_stretch_event(self, name, sample_index, argument):
+        if name == "time_stretch_progress":
+            self._update_progress_text(argument)
+        elif name == "time_stretch_finished":
+            self._stretch_event_subscription.cancel()
+            self._stretch_event_subscription = None
+            engine_clips = engine.finish_time_stretch()
+            self._close()
+            self._on_accept_func(self._beats_per_minute.value, engine_clips)
+
+    def _update_progress_text(self, completed_clip_count):
+        self._progress_text.text = "Stretching clips: {} / {}".format(completed_clip_count, len(self._project.clips))
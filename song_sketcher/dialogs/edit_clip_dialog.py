@@ -3,6 +3,8 @@ from enum import Enum
 from song_sketcher import constants
 from song_sketcher import drawing
 from song_sketcher import engine
+from song_sketcher import engine_events
+from song_sketcher import level_meter
 import math
 from song_sketcher import modal_dialog
 from song_sketcher import project
@@ -15,7 +17,7 @@ from song_sketcher import waveform_texture
 from song_sketcher import widget
 from song_sketcher import widget_event
 
-_LATEST_WAVEFORM_SAMPLES_COUNT = 128
+_LIVE_WAVEFORM_SAMPLES_PER_COLUMN = 512
 _MAX_WAVEFORM_SAMPLES = 1024
 
 # $TODO improve the waveform texture to be a 2D texture containing (min,max) sample height instead of just one value
@@ -92,6 +94,14 @@ class EditClipDialog:
             self._waveform_viewer.start_sample_index = clip.start_sample_index
             self._waveform_viewer.end_sample_index = clip.end_sample_index
 
+        layout.add_padding(points(4.0))
+
+        # Shows the input level while recording and the output level during playback
+        self._level_meter = level_meter.LevelMeterWidget()
+        layout.add_child(self._level_meter)
+        self._level_meter.desired_width = inches(8.0)
+        self._level_meter.desired_height = points(8.0)
+
         layout.add_padding(points(12.0))
 
         measures_layout = widget.HStackedLayoutWidget()
@@ -189,8 +199,10 @@ class EditClipDialog:
         self._engine_clip = None
         self._is_recording = False
         self._recording_updater = None
+        self._live_waveform_column_count = 0
         self._is_playing = False
         self._playback_updater = None
+        self._playback_event_subscription = None
         self._last_clicked_sample_index = None
 
         self._update_time_bar()
@@ -225,7 +237,7 @@ class EditClipDialog:
                 samples_per_beat = song_timing.get_samples_per_beat(
                     self._project.sample_rate,
                     self._project.beats_per_minute)
-                engine.set_metronome_samples_per_beat(samples_per_beat)
+                engine.set_metronome_samples_per_beat(samples_per_beat, self._project.beats_per_measure)
             else:
                 engine.set_metronome_samples_per_beat(0.0)
 
@@ -235,6 +247,8 @@ class EditClipDialog:
                 s.frames_per_buffer)
             self._is_recording = True
             self._recording_updater = timer.Updater(self._recording_update)
+            self._waveform_viewer.start_live_waveform()
+            self._live_waveform_column_count = 0
 
             self._record_button.icon_name = "stop"
             self._play_pause_button.set_enabled(False)
@@ -250,10 +264,12 @@ class EditClipDialog:
 
             self._update_measures_text()
         else:
-            engine.stop_recording_clip()
+            engine.stop_recording_clip(True)
+            engine.set_clip_storage_format(self._engine_clip, self._project.clip_storage_format)
             self._is_recording = False
             self._recording_updater.cancel()
             self._recording_updater = None
+            self._level_meter.reset()
 
             self._record_button.icon_name = "record"
             self._play_pause_button.set_enabled(True)
@@ -267,8 +283,19 @@ class EditClipDialog:
 
             self._waveform_viewer.set_waveform_samples(engine.get_clip_samples(self._engine_clip, _MAX_WAVEFORM_SAMPLES))
             self._waveform_viewer.sample_count = engine.get_clip_sample_count(self._engine_clip)
-            self._waveform_viewer.start_sample_index = 0
-            self._waveform_viewer.end_sample_index = self._waveform_viewer.sample_count
+
+            # Start from the engine's guess at where the take begins and ends
+            samples_per_measure = song_timing.get_samples_per_measure(
+                self._project.sample_rate,
+                self._project.beats_per_minute,
+                self._project.beats_per_measure)
+            start_sample_index, end_sample_index, has_intro, has_outro = engine.analyze_clip_boundaries(
+                self._engine_clip,
+                samples_per_measure)
+            self._waveform_viewer.start_sample_index = start_sample_index
+            self._waveform_viewer.end_sample_index = end_sample_index
+            self._intro_checkbox.set_checked(has_intro, True)
+            self._outro_checkbox.set_checked(has_outro, True)
             self._waveform_viewer.enabled = True
 
             self._update_measures_text()
@@ -297,13 +324,14 @@ class EditClipDialog:
             gain = self._gain_spinner.value
             engine.playback_builder_begin()
             engine.playback_builder_add_clip(engine_clip, start_sample_index, end_sample_index, start_sample_index, gain)
+            engine.playback_builder_set_end_sample_index(engine.get_clip_sample_count(engine_clip))
             engine.playback_builder_finalize()
 
             if s.recording_metronome_enabled:
                 samples_per_beat = song_timing.get_samples_per_beat(
                     self._project.sample_rate,
                     self._project.beats_per_minute)
-                engine.set_metronome_samples_per_beat(samples_per_beat)
+                engine.set_metronome_samples_per_beat(samples_per_beat, self._project.beats_per_measure)
             else:
                 engine.set_metronome_samples_per_beat(0.0)
 
@@ -313,18 +341,26 @@ class EditClipDialog:
                 int(self._time_bar.sample))
             self._is_playing = True
             self._playback_updater = timer.Updater(self._playback_update)
+            self._playback_event_subscription = engine_events.Subscription(self._on_playback_event)
 
             self._record_button.set_enabled(False)
             self._play_pause_button.icon_name = "pause"
         else:
-            engine.stop_playback()
-            self._is_playing = False
-            self._playback_updater.cancel()
-            self._playback_updater = None
+            self._stop_playback()
 
             self._record_button.set_enabled(True)
             self._play_pause_button.icon_name = "play"
 
+    def _stop_playback(self):
+        assert self._is_playing
+        engine.stop_playback(True)
+        self._is_playing = False
+        self._playback_updater.cancel()
+        self._playback_updater = None
+        self._playback_event_subscription.cancel()
+        self._playback_event_subscription = None
+        self._level_meter.reset()
+
     def _stop(self):
         if self._is_playing:
             self._play_pause()
@@ -346,7 +382,7 @@ class EditClipDialog:
             samples_per_beat = song_timing.get_samples_per_beat(
                 self._project.sample_rate,
                 self._project.beats_per_minute)
-            engine.set_metronome_samples_per_beat(samples_per_beat)
+            engine.set_metronome_samples_per_beat(samples_per_beat, self._project.beats_per_measure)
         else:
             engine.set_metronome_samples_per_beat(0.0)
         self._metronome_button.icon_name = self._get_metronome_icon()
@@ -354,10 +390,7 @@ class EditClipDialog:
     def _accept(self):
         assert not self._is_recording
         if self._is_playing:
-            engine.stop_playback()
-            self._is_playing = False
-            self._playback_updater.cancel()
-            self._playback_updater = None
+            self._stop_playback()
 
         name = self._name.text.strip()
         if len(name) == 0:
@@ -426,10 +459,7 @@ class EditClipDialog:
     def _delete(self):
         assert not self._is_recording
         if self._is_playing:
-            engine.stop_playback()
-            self._is_playing = False
-            self._playback_updater.cancel()
-            self._playback_updater = None
+            self._stop_playback()
 
         self._destroy_func()
         self._on_delete_func()
@@ -437,10 +467,7 @@ class EditClipDialog:
     def _reject(self):
         assert not self._is_recording
         if self._is_playing:
-            engine.stop_playback()
-            self._is_playing = False
-            self._playback_updater.cancel()
-            self._playback_updater = None
+            self._stop_playback()
 
         if self._engine_clip is not None:
             engine.delete_clip(self._engine_clip)
@@ -461,26 +488,28 @@ class EditClipDialog:
         return measure_count
 
     def _recording_update(self, dt):
-        self._waveform_viewer.set_waveform_samples(engine.get_latest_recorded_samples(_LATEST_WAVEFORM_SAMPLES_COUNT))
+        # Only the blocks recorded since the last update are fetched and uploaded
+        columns = engine.get_recorded_peak_blocks(self._live_waveform_column_count, _LIVE_WAVEFORM_SAMPLES_PER_COLUMN)
+        self._live_waveform_column_count += len(columns)
+        self._waveform_viewer.append_live_waveform_columns(columns)
         self._waveform_viewer.sample_count = 0
         self._waveform_viewer.start_sample_index = 0
         self._waveform_viewer.end_sample_index = 0
 
+        input_peak, input_rms = engine.get_meters()["input"]
+        self._level_meter.update_levels(input_peak, input_rms, dt)
+
         self._update_measures_text()
 
     def _playback_update(self, dt):
-        playback_sample_index = engine.get_playback_sample_index()
-        self._time_bar.sample = playback_sample_index
-
-        engine_clip = self._engine_clip
-        if engine_clip is None:
-            assert self._clip is not None
-            engine_clip = self._clip.engine_clip
+        self._time_bar.sample = engine.get_playback_position()
 
-        assert engine_clip is not None
+        output_peak, output_rms = engine.get_meters()["output"]
+        self._level_meter.update_levels(output_peak, output_rms, dt)
 
+    def _on_playback_event(self, name, sample_index, argument):
         # Stop playback if we reach the end
-        if playback_sample_index >= engine.get_clip_sample_count(engine_clip):
+        if name == "playback_end":
             self._stop()
 
     def _update_time_bar(self):
@@ -524,7 +553,7 @@ class EditClipDialog:
             assert s.output_device_index is not None # Should not have changed
 
             # Stopping and starting the stream at the new position should be good enough
-            engine.stop_playback()
+            engine.stop_playback(True)
             engine.start_playback(
                 s.output_device_index,
                 s.frames_per_buffer,
@@ -574,7 +603,9 @@ class WaveformWidget(widget.WidgetWithSize):
     def set_waveform_samples(self, samples):
         if len(samples) == 0:
             samples = [0.0]
-        if self._waveform_texture is None or len(samples) != self._displayed_sample_count:
+        if (self._waveform_texture is None
+            or self._waveform_texture.is_min_max
+            or len(samples) != self._displayed_sample_count):
             if self._waveform_texture is not None:
                 self._waveform_texture.destroy()
             self._waveform_texture = waveform_texture.WaveformTexture(samples = samples)
@@ -582,6 +613,19 @@ class WaveformWidget(widget.WidgetWithSize):
             self._waveform_texture.update_samples(samples)
         self._displayed_sample_count = len(samples)
 
+    # Switches to a texture of (min, max) columns which scrolls as columns are appended during recording. There is one
+    # column per pixel inside the border so that nearest filtering never skips or doubles up columns.
+    def start_live_waveform(self):
+        if self._waveform_texture is not None:
+            self._waveform_texture.destroy()
+        width_without_border = self.width.value - _get_waveform_border_thickness() * 2.0
+        column_count = max(int(round(width_without_border)), 1)
+        self._waveform_texture = waveform_texture.WaveformTexture(ring_column_count = column_count)
+        self._displayed_sample_count = 0
+
+    def append_live_waveform_columns(self, columns):
+        self._waveform_texture.append_columns(columns)
+
     def process_event(self, event):
         if not self._enabled:
             return False
@@ -644,7 +688,9 @@ class WaveformWidget(widget.WidgetWithSize):
                     background_color,
                     color,
                     border_thickness = _get_waveform_border_thickness(),
-                    border_color = constants.Color.BLACK)
+                    border_color = constants.Color.BLACK,
+                    texture_offset = self._waveform_texture.texture_offset,
+                    min_max = self._waveform_texture.is_min_max)
 
             pad = 10.0
             active_start_x = -pad
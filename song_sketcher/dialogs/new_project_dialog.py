@@ -85,6 +85,42 @@ class NewProjectDialog:
         self._beats_per_measure.decimals = 0
         options_layout.add_child(6, 2, self._beats_per_measure)
 
+        options_layout.set_row_size(7, points(12.0))
+
+        compress_clips_title = widget.TextWidget()
+        options_layout.add_child(8, 0, compress_clips_title, horizontal_placement = widget.HorizontalPlacement.RIGHT)
+        compress_clips_title.text = "Compress clips:"
+        compress_clips_title.horizontal_alignment = drawing.HorizontalAlignment.RIGHT
+        compress_clips_title.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+
+        self._compress_clips = widget.CheckboxWidget()
+        options_layout.add_child(8, 2, self._compress_clips, horizontal_placement = widget.HorizontalPlacement.LEFT)
+
+        options_layout.set_row_size(9, points(12.0))
+
+        single_file_title = widget.TextWidget()
+        options_layout.add_child(10, 0, single_file_title, horizontal_placement = widget.HorizontalPlacement.RIGHT)
+        single_file_title.text = "Single file:"
+        single_file_title.horizontal_alignment = drawing.HorizontalAlignment.RIGHT
+        single_file_title.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+
+        self._single_file = widget.CheckboxWidget()
+        options_layout.add_child(10, 2, self._single_file, horizontal_placement = widget.HorizontalPlacement.LEFT)
+        self._single_file.action_func = self._update_compress_clips
+
+        options_layout.set_row_size(11, points(12.0))
+
+        clip_storage_format_title = widget.TextWidget()
+        options_layout.add_child(12, 0, clip_storage_format_title, horizontal_placement = widget.HorizontalPlacement.RIGHT)
+        clip_storage_format_title.text = "Clip precision:"
+        clip_storage_format_title.horizontal_alignment = drawing.HorizontalAlignment.RIGHT
+        clip_storage_format_title.vertical_alignment = drawing.VerticalAlignment.MIDDLE
+
+        self._clip_storage_format = widget.DropdownWidget()
+        self._clip_storage_format.set_options(project.CLIP_STORAGE_FORMATS)
+        self._clip_storage_format.selected_option_index = 0
+        options_layout.add_child(12, 2, self._clip_storage_format)
+
         layout.add_padding(points(12.0))
 
         buttons_layout = widget.HStackedLayoutWidget()
@@ -105,6 +141,12 @@ class NewProjectDialog:
 
         self._destroy_func = modal_dialog.show_modal_dialog(stack_widget, layout)
 
+    # Single file projects store clips uncompressed so that they can be mapped in place
+    def _update_compress_clips(self):
+        if self._single_file.checked:
+            self._compress_clips.set_checked(False)
+        self._compress_clips.set_enabled(not self._single_file.checked)
+
     def _cancel(self):
         self._destroy_func()
 
@@ -146,10 +188,13 @@ class NewProjectDialog:
         new_project.sample_rate = _SAMPLE_RATES[self._sample_rate.selected_option_index][0]
         new_project.beats_per_minute = self._beats_per_minute.value
         new_project.beats_per_measure = int(self._beats_per_measure.value)
+        new_project.compress_clips = self._compress_clips.checked
+        new_project.single_file = self._single_file.checked
+        new_project.clip_storage_format = project.CLIP_STORAGE_FORMATS[self._clip_storage_format.selected_option_index][0]
 
         project_directory = pm.get_project_directory(name)
         try:
-            new_project.save(project_directory / project.PROJECT_FILENAME)
+            new_project.save(project_directory)
         except:
             modal_dialog.show_simple_modal_dialog(
                 self._stack_widget,
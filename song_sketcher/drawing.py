@@ -475,7 +475,7 @@ def draw_spinner(x, y, color_inner, color_outer, color_outer_background, radius_
 
 def draw_waveform(
     x1, y1, x2, y2, waveform_texture, background_color, waveform_color,
-    border_thickness = 0.0, border_color = None):
+    border_thickness = 0.0, border_color = None, texture_offset = 0.0, min_max = False):
     mvp_matrix = _projection_matrix * transform.get_current_transform()
     shader = _resource_registry.waveform_shader
     if border_color is None or border_thickness == 0.0:
@@ -492,6 +492,8 @@ def draw_waveform(
         glUniform4f(shader.uniform_loc("waveform_rgba"), *_get_rgba(waveform_color))
         glUniform1f(shader.uniform_loc("border_thickness"), border_thickness)
         glUniform4f(shader.uniform_loc("border_rgba"), *_get_rgba(border_color))
+        glUniform1f(shader.uniform_loc("texture_offset"), texture_offset)
+        glUniform1i(shader.uniform_loc("min_max"), int(min_max))
 
         glDrawArrays(GL_POINTS, 0, 1)
 
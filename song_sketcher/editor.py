@@ -1,12 +1,15 @@
 from song_sketcher import constants
+from song_sketcher.dialogs import change_tempo_dialog
 from song_sketcher.dialogs import load_project_dialog
 from song_sketcher.dialogs import new_project_dialog
 from song_sketcher.dialogs import save_project_as_dialog
 from song_sketcher.dialogs import settings_dialog
 from song_sketcher import drawing
 from song_sketcher import engine
+from song_sketcher import engine_events
 from song_sketcher import history_manager
 from song_sketcher import library
+import math
 from song_sketcher import modal_dialog
 from song_sketcher import project
 from song_sketcher import project_manager
@@ -53,7 +56,13 @@ class Editor:
 
         # Playback-related fields
         self._is_playing = False
+        self._is_stopping = False           # Whether the engine is still stopping the stream in the background
         self._playback_updater = None
+        self._engine_event_subscription = engine_events.Subscription(self._on_engine_event)
+        self._playback_track_buses = {}     # Maps Track -> engine bus index for the current playback
+
+        # Clips can't be saved while they're being stretched to a new tempo
+        self._change_tempo_dialog = None
 
         # This will set up the appropriate "no project loaded" layout
         self._close_project()
@@ -61,7 +70,7 @@ class Editor:
         self._update_controls_enabled(False)
 
     def shutdown(self):
-        pass
+        self._engine_event_subscription.cancel()
 
     def update(self, dt):
         pass
@@ -70,8 +79,13 @@ class Editor:
         return self._quit
 
     def request_quit(self):
+        if self._change_tempo_dialog is not None:
+            self._change_tempo_dialog.cancel()
         if self._is_playing:
             self._stop()
+        if self._is_stopping:
+            engine.wait_for_stop()
+            self._on_stopped()
 
         def on_save_complete(success):
             if success:
@@ -146,7 +160,9 @@ class Editor:
             self._project,
             self._history_manager,
             lambda: self._library.selected_clip_id,
-            self._on_time_bar_sample_changed)
+            self._on_time_bar_sample_changed,
+            self._change_tempo,
+            self._on_track_mix_changed)
         timeline_library_layout.add_child(self._timeline.root_layout, weight = 1.0)
 
         timeline_library_divider = widget.RectangleWidget()
@@ -162,7 +178,8 @@ class Editor:
             self._root_stack_widget,
             self._project,
             self._history_manager,
-            lambda: self._timeline.update_tracks())
+            lambda: self._timeline.update_tracks(),
+            self._preview_clip)
         timeline_library_layout.add_child(self._library.root_layout, weight = 1.0)
 
         edit_menu_widget = self._build_edit_menu_widget(project_widgets)
@@ -255,6 +272,7 @@ class Editor:
 
         if self._project is not None:
             self._project.engine_unload()
+            engine.clear_render_cache()
 
         self._project_name = None
         self._project = None
@@ -283,7 +301,7 @@ class Editor:
         new_project = project.Project()
 
         try:
-            new_project.load(pm.get_project_directory(project_name) / project.PROJECT_FILENAME)
+            new_project.load(pm.get_project_directory(project_name))
         except:
             modal_dialog.show_simple_modal_dialog(
                 self._root_stack_widget,
@@ -296,7 +314,7 @@ class Editor:
         if self._history_manager is not None:
             self._history_manager.destroy()
             self._history_manager = None
-        self._history_manager = history_manager.HistoryManager(self._update_controls_enabled)
+        self._history_manager = history_manager.HistoryManager(self._on_history_state_changed)
 
         if self._project is not None:
             self._project.engine_unload()
@@ -322,12 +340,13 @@ class Editor:
             widget.VerticalPlacement.FILL)
 
         self._update_controls_enabled()
+        self._build_playback()
         return True
 
     def _save_project(self):
         try:
             project_directory = project_manager.get().get_project_directory(self._project_name)
-            self._project.save(project_directory / project.PROJECT_FILENAME)
+            self._project.save(project_directory)
             self._history_manager.save()
             return True
         except:
@@ -364,6 +383,9 @@ class Editor:
                 on_dialog_close)
 
     def _play_pause(self):
+        if self._is_stopping:
+            return
+
         if not self._is_playing:
             s = settings.get()
             if s.output_device_index is None:
@@ -375,42 +397,13 @@ class Editor:
                     None)
                 return
 
-            soloed_tracks = set(x for x in self._project.tracks if x.soloed and not x.muted)
-            if len(soloed_tracks) > 0:
-                active_tracks = [x for x in self._project.tracks if x in soloed_tracks]
-            else:
-                active_tracks = [x for x in self._project.tracks if not x.muted]
-
-            # Build the playback clip
-            engine.playback_builder_begin()
-
-            samples_per_measure = song_timing.get_samples_per_measure(
-                self._project.sample_rate,
-                self._project.beats_per_minute,
-                self._project.beats_per_measure)
-            for track in active_tracks:
-                for i, clip_id in enumerate(track.measure_clip_ids):
-                    if clip_id is not None:
-                        clip = self._project.get_clip_by_id(clip_id)
-                        measure_index = i
-                        if clip.has_intro:
-                            measure_index -= 1
-                        playback_start_sample_index = round(measure_index * samples_per_measure + clip.start_sample_index)
-                        gain = clip.gain * clip.category.gain * track.gain
-                        engine.playback_builder_add_clip(
-                            clip.engine_clip,
-                            clip.start_sample_index,
-                            clip.end_sample_index,
-                            playback_start_sample_index,
-                            gain)
-
-            engine.playback_builder_finalize()
+            self._build_playback()
 
             if s.playback_metronome_enabled:
                 samples_per_beat = song_timing.get_samples_per_beat(
                     self._project.sample_rate,
                     self._project.beats_per_minute)
-                engine.set_metronome_samples_per_beat(samples_per_beat)
+                engine.set_metronome_samples_per_beat(samples_per_beat, self._project.beats_per_measure)
             else:
                 engine.set_metronome_samples_per_beat(0.0)
 
@@ -424,13 +417,86 @@ class Editor:
             self._project_widgets.play_pause_button.icon_name = "pause"
             self._update_controls_enabled()
         else:
-            engine.stop_playback()
-            self._is_playing = False
-            self._playback_updater.cancel()
-            self._playback_updater = None
+            # Discard queued buffers so that pausing is instant
+            self._stop_playback(True)
 
-            self._project_widgets.play_pause_button.icon_name = "play"
-            self._update_controls_enabled()
+    # Lets the engine close the stream in the background. Editing stays disabled until the stream has stopped. Unless
+    # immediate is True, buffers which are already queued are played first.
+    def _stop_playback(self, immediate):
+        engine.stop_playback(immediate, False)
+        self._is_playing = False
+        self._is_stopping = True
+        self._playback_updater.cancel()
+        self._playback_updater = None
+        self._playback_track_buses = {}
+        self._timeline.reset_track_levels()
+
+        self._project_widgets.play_pause_button.icon_name = "play"
+        self._update_controls_enabled()
+
+    def _preview_clip(self, clip):
+        # Clips are auditioned over the running playback, when stopped they can be auditioned by editing them
+        if self._is_playing:
+            engine.preview_clip(
+                clip.engine_clip,
+                clip.start_sample_index,
+                clip.end_sample_index,
+                clip.gain * clip.category.gain)
+
+    def _on_engine_event(self, name, sample_index, argument):
+        if name == "playback_end" and self._is_playing:
+            # The end of the song has only just been queued, so let it drain rather than cutting it off
+            self._stop(False)
+        elif name == "stream_stopped" and self._is_stopping:
+            self._on_stopped()
+
+    def _on_stopped(self):
+        self._is_stopping = False
+        self._update_controls_enabled()
+
+        # Edits made while the stream was stopping didn't rebuild the playback
+        if self._project is not None:
+            self._build_playback()
+
+    def _build_playback(self):
+        # Build the playback clip. Every track and category gets a bus so that mute, solo and gain can be applied by
+        # the engine, which lets them change during playback.
+        engine.playback_builder_begin()
+
+        self._playback_track_buses = {
+            track: engine.playback_builder_add_bus(track.gain, track.muted, track.soloed)
+            for track in self._project.tracks
+        }
+        category_buses = {
+            category: engine.playback_builder_add_bus(category.gain)
+            for category in self._project.clip_categories
+        }
+
+        samples_per_measure = song_timing.get_samples_per_measure(
+            self._project.sample_rate,
+            self._project.beats_per_minute,
+            self._project.beats_per_measure)
+        for track in self._project.tracks:
+            for i, clip_id in enumerate(track.measure_clip_ids):
+                if clip_id is not None:
+                    clip = self._project.get_clip_by_id(clip_id)
+                    measure_index = i
+                    if clip.has_intro:
+                        measure_index -= 1
+                    playback_start_sample_index = round(measure_index * samples_per_measure + clip.start_sample_index)
+                    engine.playback_builder_add_clip(
+                        clip.engine_clip,
+                        clip.start_sample_index,
+                        clip.end_sample_index,
+                        playback_start_sample_index,
+                        clip.gain,
+                        (self._playback_track_buses[track], category_buses[clip.category]))
+
+        if settings.get().render_cache_enabled:
+            engine.playback_builder_enable_render_cache(samples_per_measure)
+
+        engine.playback_builder_set_end_sample_index(math.ceil(self._timeline.get_song_length_samples()))
+        engine.playback_builder_finalize()
 
     def _on_time_bar_sample_changed(self):
         sample_index = self._timeline.get_playback_sample_index()
@@ -441,16 +507,96 @@ class Editor:
             assert s.output_device_index is not None # Should not have changed
 
             # Stopping and starting the stream at the new position should be good enough
-            engine.stop_playback()
+            engine.stop_playback(True)
             engine.start_playback(
                 s.output_device_index,
                 s.frames_per_buffer,
                 int(sample_index))
 
-    def _stop(self):
+    def _change_tempo(self):
+        if self._is_playing or self._is_stopping:
+            return
+
+        def on_accept(beats_per_minute, stretched_engine_clips):
+            ratio = self._project.beats_per_minute / beats_per_minute
+            old_beats_per_minute = self._project.beats_per_minute
+            old_clip_samples = [
+                (clip, clip.engine_clip, clip.sample_count, clip.start_sample_index, clip.end_sample_index)
+                for clip in self._project.clips
+            ]
+
+            # Sample positions within a clip scale with its length
+            new_clip_samples = []
+            for clip, engine_clip in zip(self._project.clips, stretched_engine_clips):
+                sample_count = engine.get_clip_sample_count(engine_clip)
+                new_clip_samples.append((
+                    clip,
+                    engine_clip,
+                    sample_count,
+                    min(round(clip.start_sample_index * ratio), sample_count),
+                    min(round(clip.end_sample_index * ratio), sample_count)))
+
+            def set_tempo(beats_per_minute, clip_samples):
+                playback_sample_index = self._timeline.get_playback_sample_index()
+                position_ratio = self._project.beats_per_minute / beats_per_minute
+                self._project.beats_per_minute = beats_per_minute
+                for clip, engine_clip, sample_count, start_sample_index, end_sample_index in clip_samples:
+                    clip.engine_clip = engine_clip
+                    clip.sample_count = sample_count
+                    clip.start_sample_index = start_sample_index
+                    clip.end_sample_index = end_sample_index
+
+                # Keep the playhead at the same point in the song
+                self._timeline.update_tracks()
+                self._timeline.set_playback_sample_index(playback_sample_index * position_ratio)
+                self._last_clicked_sample_index = None
+
+            def do():
+                set_tempo(beats_per_minute, new_clip_samples)
+
+            def undo():
+                set_tempo(old_beats_per_minute, old_clip_samples)
+
+            def destroy(was_undone):
+                if was_undone:
+                    # We undid the tempo change, so delete the stretched engine clips
+                    for clip, engine_clip, sample_count, start_sample_index, end_sample_index in new_clip_samples:
+                        engine.delete_clip(engine_clip)
+                else:
+                    # We're holding the last references to the original engine clips, so delete them
+                    for clip, engine_clip, sample_count, start_sample_index, end_sample_index in old_clip_samples:
+                        engine.delete_clip(engine_clip)
+
+            do()
+
+            entry = history_manager.Entry()
+            entry.undo_func = undo
+            entry.redo_func = do
+            entry.destroy_func = destroy
+            self._history_manager.add_entry(entry)
+
+        def on_closed():
+            self._change_tempo_dialog = None
+            self._update_controls_enabled()
+
+        self._change_tempo_dialog = change_tempo_dialog.ChangeTempoDialog(
+            self._root_stack_widget,
+            self._project,
+            on_accept,
+            on_closed)
+        self._update_controls_enabled()
+
+    def _on_track_mix_changed(self, track):
+        # Tracks added during playback aren't part of it
+        bus_index = self._playback_track_buses.get(track)
+        if self._is_playing and bus_index is not None:
+            engine.set_bus_gain(bus_index, track.gain)
+            engine.set_bus_muted(bus_index, track.muted)
+            engine.set_bus_soloed(bus_index, track.soloed)
+
+    def _stop(self, immediate = True):
         if self._is_playing:
-            self._play_pause()
-            assert not self._is_playing
+            self._stop_playback(immediate)
 
         if self._timeline.get_playback_sample_index() == self._last_clicked_sample_index:
             self._timeline.set_playback_sample_index(0.0)
@@ -468,7 +614,7 @@ class Editor:
             samples_per_beat = song_timing.get_samples_per_beat(
                 self._project.sample_rate,
                 self._project.beats_per_minute)
-            engine.set_metronome_samples_per_beat(samples_per_beat)
+            engine.set_metronome_samples_per_beat(samples_per_beat, self._project.beats_per_measure)
         else:
             engine.set_metronome_samples_per_beat(0.0)
         self._project_widgets.metronome_button.icon_name = self._get_metronome_icon()
@@ -481,25 +627,36 @@ class Editor:
         if self._history_manager.can_redo():
             self._history_manager.redo()
 
+    def _on_history_state_changed(self):
+        self._update_controls_enabled()
+
+        # Rebuild the playback after every edit so that the render cache can mix the changed parts of the song in the
+        # background before playback starts
+        if not self._is_playing and not self._is_stopping:
+            self._build_playback()
+
     def _update_controls_enabled(self, animate = True):
-        can_save_as = self._project is not None
+        can_save_as = self._project is not None and self._change_tempo_dialog is None
         can_save = can_save_as and self._history_manager.has_unsaved_changes()
+        stopped = not self._is_playing and not self._is_stopping
 
-        self._new_project_button.set_enabled(not self._is_playing, animate)
-        self._load_project_button.set_enabled(not self._is_playing, animate)
-        self._save_project_button.set_enabled(not self._is_playing and can_save, animate)
-        self._save_project_as_button.set_enabled(not self._is_playing and can_save_as, animate)
-        self._settings_button.set_enabled(not self._is_playing, animate)
+        self._new_project_button.set_enabled(stopped, animate)
+        self._load_project_button.set_enabled(stopped, animate)
+        self._save_project_button.set_enabled(stopped and can_save, animate)
+        self._save_project_as_button.set_enabled(stopped and can_save_as, animate)
+        self._settings_button.set_enabled(stopped, animate)
 
         if self._project is not None:
-            self._library.set_enabled(not self._is_playing)
-            self._timeline.set_enabled(not self._is_playing)
+            self._library.set_enabled(stopped)
+            self._timeline.set_enabled(stopped, mix_controls_enabled = True)
 
-            self._project_widgets.undo_button.set_enabled(self._history_manager.can_undo() and not self._is_playing, animate)
-            self._project_widgets.redo_button.set_enabled(self._history_manager.can_redo() and not self._is_playing, animate)
+            self._project_widgets.undo_button.set_enabled(self._history_manager.can_undo() and stopped, animate)
+            self._project_widgets.redo_button.set_enabled(self._history_manager.can_redo() and stopped, animate)
 
     def _playback_update(self, dt):
-        playback_sample_index = engine.get_playback_sample_index()
-        self._timeline.set_playback_sample_index(playback_sample_index)
-        if playback_sample_index >= self._timeline.get_song_length_samples():
-            self._stop()
+        self._timeline.set_playback_sample_index(engine.get_playback_position())
+
+        bus_levels = engine.get_meters()["buses"]
+        self._timeline.update_track_levels(
+            {track: bus_levels[bus_index] for track, bus_index in self._playback_track_buses.items()},
+            dt)
@@ -0,0 +1,54 @@
+from song_sketcher import engine
+
+# engine.poll_events removes the events it returns, so they're drained in one place each frame and passed on to every
+# subscriber. Otherwise whichever caller polled first would swallow the events the others are waiting for.
+
+_event_dispatcher = None
+
+def initialize():
+    global _event_dispatcher
+    _event_dispatcher = _EventDispatcher()
+
+def shutdown():
+    global _event_dispatcher
+    if _event_dispatcher is not None:
+        _event_dispatcher.shutdown()
+        _event_dispatcher = None
+
+def update():
+    _event_dispatcher.update()
+
+class _EventDispatcher:
+    def __init__(self):
+        self._subscriptions = []
+
+    def shutdown(self):
+        pass
+
+    def update(self):
+        for name, sample_index, argument in engine.poll_events():
+            # A subscriber may subscribe or cancel while handling an event
+            for subscription in list(self._subscriptions):
+                subscription.dispatch(name, sample_index, argument)
+
+        self._subscriptions = [x for x in self._subscriptions if x.is_running()]
+
+    def add_subscription(self, subscription):
+        self._subscriptions.append(subscription)
+
+class Subscription:
+    # func takes the event's name, sample_index and argument
+    def __init__(self, func):
+        self._func = func
+        self._running = True
+        _event_dispatcher.add_subscription(self)
+
+    def dispatch(self, name, sample_index, argument):
+        if self._running:
+            self._func(name, sample_index, argument)
+
+    def is_running(self):
+        return self._running
+
+    def cancel(self):
+        self._running = False
@@ -0,0 +1,79 @@
+import math
+
+from song_sketcher import constants
+from song_sketcher import drawing
+from song_sketcher.units import *
+from song_sketcher import widget
+
+# Levels are drawn on a decibel scale from _MIN_DB to 0dB
+_MIN_DB = -60.0
+
+# How quickly the held peak falls back once the signal gets quieter
+_PEAK_FALL_DB_PER_SECOND = 20.0
+
+def _level_to_ratio(level):
+    if level <= 0.0:
+        return 0.0
+    db = 20.0 * math.log10(level)
+    return min(max(1.0 - db / _MIN_DB, 0.0), 1.0)
+
+class LevelMeterWidget(widget.WidgetWithSize):
+    _BACKGROUND_COLOR = (0.5, 0.5, 0.5, 1.0)
+    _RMS_COLOR = (0.25, 0.75, 0.25, 1.0)
+    _PEAK_COLOR = (0.125, 0.375, 0.125, 1.0)
+    _CLIPPED_COLOR = (0.75, 0.0, 0.0, 1.0)
+
+    # show_clipping should be False for levels whose peak is only an upper bound, such as engine bus levels
+    def __init__(self, show_clipping = True):
+        super().__init__()
+        self.desired_width = 0.0
+        self.desired_height = 0.0
+        self._show_clipping = show_clipping
+        self._peak_ratio = 0.0
+        self._rms_ratio = 0.0
+        self._clipped = False
+
+    # Takes the (peak, rms) levels from engine.get_meters and the time since the last update
+    def update_levels(self, peak, rms, dt):
+        fallen_peak_ratio = self._peak_ratio - _PEAK_FALL_DB_PER_SECOND * dt / -_MIN_DB
+        self._peak_ratio = max(_level_to_ratio(peak), fallen_peak_ratio, 0.0)
+        self._rms_ratio = _level_to_ratio(rms)
+        self._clipped = self._clipped or (self._show_clipping and peak >= 1.0)
+
+    def reset(self):
+        self._peak_ratio = 0.0
+        self._rms_ratio = 0.0
+        self._clipped = False
+
+    def get_desired_size(self):
+        return (self.desired_width, self.desired_height)
+
+    def draw_visible(self, parent_transform):
+        transform = parent_transform * self.get_transform()
+        with transform:
+            border_thickness = points(1.0)
+            drawing.draw_rectangle(
+                0.0,
+                0.0,
+                self.width.value,
+                self.height.value,
+                self._BACKGROUND_COLOR,
+                border_thickness = border_thickness,
+                border_color = constants.Color.BLACK)
+
+            x1 = border_thickness
+            y1 = border_thickness
+            x2 = self.width.value - border_thickness
+            y2 = self.height.value - border_thickness
+            width = x2 - x1
+            if self._rms_ratio > 0.0:
+                drawing.draw_rectangle(x1, y1, x1 + width * self._rms_ratio, y2, self._RMS_COLOR)
+
+            if self._peak_ratio > 0.0:
+                peak_x = x1 + width * self._peak_ratio
+                drawing.draw_rectangle(
+                    max(peak_x - points(1.0), x1),
+                    y1,
+                    peak_x,
+                    y2,
+                    self._CLIPPED_COLOR if self._clipped else self._PEAK_COLOR)
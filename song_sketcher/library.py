@@ -10,11 +10,12 @@ from song_sketcher import widget
 from song_sketcher import widget_event
 
 class Library:
-    def __init__(self, root_stack_widget, project, history_manager, update_tracks_func):
+    def __init__(self, root_stack_widget, project, history_manager, update_tracks_func, preview_clip_func):
         self._root_stack_widget = root_stack_widget
         self._project = project
         self._history_manager = history_manager
         self._update_tracks_func = update_tracks_func
+        self._preview_clip_func = preview_clip_func
 
         self._selected_clip_id = None
 
@@ -114,7 +115,8 @@ class Library:
                         clip,
                         clip_id == self._selected_clip_id,
                         lambda clip_id = clip_id: self._select_clip(clip_id),
-                        lambda clip = clip: self._edit_clip(clip))
+                        lambda clip = clip: self._edit_clip(clip),
+                        lambda clip = clip: self._preview_clip_func(clip))
 
         self._categories_layout.add_padding(self._padding)
         self._clips_layout.set_row_size(0, self._padding)
@@ -534,12 +536,13 @@ class ClipWidget(widget.AbsoluteLayoutWidget):
     SELECTED_COLOR = constants.Color.WHITE
     UNSELECTED_COLOR = constants.Color.BLACK
 
-    def __init__(self, category, clip, is_selected, on_click_func, on_double_click_func):
+    def __init__(self, category, clip, is_selected, on_click_func, on_double_click_func, on_preview_func):
         super().__init__()
         self.category = category
         self.clip = clip
         self.on_click_func = on_click_func
         self.on_double_click_func = on_double_click_func
+        self.on_preview_func = on_preview_func
         self.enabled = True
 
         self.desired_width = inches(1.5)
@@ -567,6 +570,13 @@ class ClipWidget(widget.AbsoluteLayoutWidget):
         return self.background.color
 
     def process_event(self, event):
+        # Previewing doesn't modify the project, so it's allowed even while editing is disabled during playback
+        if (isinstance(event, widget_event.MouseEvent)
+            and event.button is widget_event.MouseButton.RIGHT
+            and event.event_type is widget_event.MouseEventType.PRESS):
+            self.on_preview_func()
+            return True
+
         if not self.enabled:
             return False
 
@@ -1,3 +1,4 @@
+import concurrent.futures
 import json
 import os
 import pathlib
@@ -5,6 +6,18 @@ import pathlib
 from song_sketcher import engine
 
 PROJECT_FILENAME = "project.json"
+ARCHIVE_FILENAME = "project.sketch"
+
+WAV_CLIP_EXTENSION = "wav"
+COMPRESSED_CLIP_EXTENSION = "sslc"
+
+# The 16-bit formats halve the memory used by clips at the cost of precision. Clips mapped from uncompressed files are
+# left at full precision since their memory can already be paged back out to the file.
+CLIP_STORAGE_FORMATS = [
+    ("float32", "Full"),
+    ("int16", "16-bit integer"),
+    ("float16", "16-bit float")
+]
 
 # These are chosen using HSV values of (x, 240, 140) where x ranges from 0 to 360
 CATEGORY_COLORS = [
@@ -34,6 +47,7 @@ class Clip:
         self.has_outro = False          # Whether the clip has an outro measure
         self.gain = 1.0                 # Gain of the clip, from 0-1
         self.engine_clip = None         # Audio clip data stored in the engine
+        self.filename = None            # Name of the clip's file in the project folder, None until saved
 
         self.category = None            # Used for quick access to the category
 
@@ -57,18 +71,87 @@ class Project:
         self.sample_rate = 48000
         self.beats_per_minute = 60.0
         self.beats_per_measure = 4
+        self.compress_clips = False     # Whether clip files use the engine's lossless codec rather than float wavs, not
+                                        # supported for single file projects
+        self.single_file = False        # Whether the project is stored as a single archive rather than a folder of files
+        self.clip_storage_format = "float32"    # How the engine stores clip samples in memory, see CLIP_STORAGE_FORMATS
 
         self.clips = []
         self.clip_categories = []
         self.tracks = []
 
+        self.folder = None
         self._next_clip_id = None
 
-    def save(self, path):
+        # Maps clip filename -> the engine clip whose samples were last written to (or loaded from) that file
+        self._saved_engine_clips = {}
+
+    def save(self, folder):
+        folder = pathlib.Path(folder)
+        if self.single_file:
+            self._save_archive(folder)
+        else:
+            self._save_folder(folder)
+
+    def load(self, folder):
+        folder = pathlib.Path(folder)
+        archive_path = folder / ARCHIVE_FILENAME
+        if archive_path.exists():
+            project = json.loads(engine.get_archive_metadata(str(archive_path)))
+            self.single_file = True
+        else:
+            with open(str(folder / PROJECT_FILENAME), "r") as file:
+                project = json.load(file)
+            self.single_file = False
+
+        self.folder = folder
+        self._from_json(project)
+        if self.single_file:
+            # Older archives may have recorded the setting, but their clips were never compressed
+            self.compress_clips = False
+
+    def engine_load(self):
+        engine.set_sample_rate(self.sample_rate)
+        if self.single_file:
+            # The whole archive is mapped at once and each clip is a view into it
+            engine_clips = engine.load_archive(str(self.folder / ARCHIVE_FILENAME))
+            for clip in self.clips:
+                clip.engine_clip = engine_clips[clip.id]
+        else:
+            for clip in self.clips:
+                # Map the clip files rather than reading them so that opening a project doesn't have to touch every sample
+                clip.engine_clip = engine.load_clip(str(self.folder / clip.filename), True)
+                self._saved_engine_clips[clip.filename] = clip.engine_clip
+
+        for clip in self.clips:
+            engine.set_clip_storage_format(clip.engine_clip, self.clip_storage_format)
+
+    def engine_unload(self):
+        for clip in self.clips:
+            engine.delete_clip(clip.engine_clip)
+
+    # Converts every clip to a new sample rate, scaling sample positions to match. Use this rather than calling
+    # engine.resample_clips() directly, which keeps the same engine clips and so wouldn't mark them as needing saving.
+    def resample(self, sample_rate):
+        engine.resample_clips(sample_rate)
+        ratio = sample_rate / self.sample_rate
+        for clip in self.clips:
+            clip.sample_count = engine.get_clip_sample_count(clip.engine_clip)
+            clip.start_sample_index = min(round(clip.start_sample_index * ratio), clip.sample_count)
+            clip.end_sample_index = min(round(clip.end_sample_index * ratio), clip.sample_count)
+        self.sample_rate = sample_rate
+
+        # Every clip's samples have changed so they all need to be written again. The files stay tracked so that the
+        # next save removes them once they've been replaced.
+        self._saved_engine_clips = dict.fromkeys(self._saved_engine_clips)
+
+    def _to_json(self):
         project = {
             "sample_rate": self.sample_rate,
             "beats_per_minutes": self.beats_per_minute,
             "beats_per_measure": self.beats_per_measure,
+            "compress_clips": self.compress_clips,
+            "clip_storage_format": self.clip_storage_format
         }
 
         clips = []
@@ -80,7 +163,8 @@ class Project:
                 "start_sample_index": clip.start_sample_index,
                 "end_sample_index": clip.end_sample_index,
                 "measure_count": clip.measure_count,
-                "gain": clip.gain
+                "gain": clip.gain,
+                "filename": clip.filename
             })
         project["clips"] = clips
 
@@ -104,22 +188,14 @@ class Project:
                 "measure_clip_ids": track.measure_clip_ids
             })
         project["tracks"] = tracks
+        return project
 
-        with open(str(path), "w") as file:
-            json.dump(project, file, indent = 4)
-
-        folder = pathlib.Path(os.path.dirname(path))
-        for clip in self.clips:
-            engine.save_clip(clip.engine_clip, str(folder / "{}.wav".format(clip.id)))
-
-    def load(self, path):
-        with open(str(path), "r") as file:
-            project = json.load(file)
-
-        self.folder = pathlib.Path(os.path.dirname(path))
+    def _from_json(self, project):
         self.sample_rate = int(project["sample_rate"])
         self.beats_per_minute = project["beats_per_minutes"]
         self.beats_per_measure = int(project["beats_per_measure"])
+        self.compress_clips = bool(project.get("compress_clips", False))
+        self.clip_storage_format = project.get("clip_storage_format", "float32")
 
         self.clips = []
         for loaded_clip in project["clips"]:
@@ -131,6 +207,9 @@ class Project:
             clip.end_sample_index = int(loaded_clip["end_sample_index"])
             clip.measure_count = int(loaded_clip["measure_count"])
             clip.gain = float(loaded_clip["gain"])
+
+            # Older projects always named clip files after the clip ID
+            clip.filename = loaded_clip.get("filename", None) or "{}.{}".format(clip.id, self._get_clip_extension())
             self.clips.append(clip)
 
         self.clip_categories = []
@@ -154,14 +233,94 @@ class Project:
             track.measure_clip_ids = [None if x is None else int(x) for x in loaded_track["measure_clip_ids"]]
             self.tracks.append(track)
 
-    def engine_load(self):
-        engine.set_sample_rate(self.sample_rate)
-        for clip in self.clips:
-            clip.engine_clip = engine.load_clip(str(self.folder / "{}.wav".format(clip.id)))
+    def _save_folder(self, folder):
+        if folder != self.folder:
+            # Saving to a new location, so none of the clip files exist there yet
+            self._saved_engine_clips = {}
 
-    def engine_unload(self):
-        for clip in self.clips:
-            engine.delete_clip(clip.engine_clip)
+        # Only new or re-recorded clips need to be written. Each goes to a file name which isn't in use rather than over
+        # its old file, since that file may still be mapped by an engine clip (one kept for undo, for example) and
+        # Windows can't replace a mapped file.
+        dirty_clips = [
+            x for x in self.clips
+            if x.filename is None or self._saved_engine_clips.get(x.filename) != x.engine_clip
+        ]
+        dirty_clip_filenames = [self._generate_clip_filename(folder, x) for x in dirty_clips]
+
+        # Clips are saved in parallel, or a single clip is compressed on every core, but not both at once, which would
+        # start a thread per core for every clip
+        thread_count = 1 if len(dirty_clips) > 1 else 0
+
+        def save_clip(clip, filename):
+            temp_filename = folder / "{}.tmp".format(filename)
+            try:
+                engine.save_clip(clip.engine_clip, str(temp_filename), self.compress_clips, thread_count)
+                os.replace(str(temp_filename), str(folder / filename))
+            except:
+                # Don't leave a partially written file behind
+                try:
+                    os.remove(str(temp_filename))
+                except OSError:
+                    pass
+                raise
+
+        if len(dirty_clips) > 1:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                # Consuming the results re-raises the first failure
+                list(executor.map(save_clip, dirty_clips, dirty_clip_filenames))
+        else:
+            for clip, filename in zip(dirty_clips, dirty_clip_filenames):
+                save_clip(clip, filename)
+
+        for clip, filename in zip(dirty_clips, dirty_clip_filenames):
+            clip.filename = filename
+            self._saved_engine_clips[filename] = clip.engine_clip
+
+        # The project file is written last so that it never refers to clip files which haven't been written yet
+        path = folder / PROJECT_FILENAME
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w") as file:
+            json.dump(self._to_json(), file, indent = 4)
+        os.replace(temp_path, str(path))
+        self.folder = folder
+
+        # Now that the project file no longer refers to them, remove the files of clips which were deleted or written
+        # again. Only files this project loaded or wrote are touched. A file which is still mapped can't be removed on
+        # Windows, so it stays tracked for a later save to remove.
+        referenced_filenames = set(x.filename for x in self.clips)
+        for filename in [x for x in self._saved_engine_clips if x not in referenced_filenames]:
+            try:
+                os.remove(str(folder / filename))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            del self._saved_engine_clips[filename]
+
+    def _save_archive(self, folder):
+        # Archives hold float samples so that clips can be mapped in place, which compressed clips couldn't be
+        if self.compress_clips:
+            raise ValueError("Single file projects cannot compress clips")
+
+        # Only clips which aren't already stored in the archive get written, appended to the end of the file
+        engine.save_archive(
+            str(folder / ARCHIVE_FILENAME),
+            json.dumps(self._to_json(), indent = 4),
+            [(x.id, x.engine_clip) for x in self.clips])
+        self.folder = folder
+
+    def _get_clip_extension(self):
+        return COMPRESSED_CLIP_EXTENSION if self.compress_clips else WAV_CLIP_EXTENSION
+
+    # Returns a name for a new file holding the clip's samples which no other file in the folder is using
+    def _generate_clip_filename(self, folder, clip):
+        extension = self._get_clip_extension()
+        filename = "{}.{}".format(clip.id, extension)
+        version = 1
+        while filename in self._saved_engine_clips or (folder / filename).exists():
+            filename = "{}_{}.{}".format(clip.id, version, extension)
+            version += 1
+        return filename
 
     def generate_clip_id(self):
         if self._next_clip_id is None:
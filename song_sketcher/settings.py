@@ -20,3 +20,4 @@ class Settings:
         self.frames_per_buffer = 1024
         self.recording_metronome_enabled = True
         self.playback_metronome_enabled = False
+        self.render_cache_enabled = True        # Pre-mix unchanged measures in the background to reduce playback CPU
@@ -16,6 +16,7 @@ class TimeBarWidget(widget.WidgetWithSize):
         self.min_sample = 0.0
         self.max_sample = 0.0
         self.on_sample_changed_func = None
+        self.on_double_click_func = None
         self._sample = 0.0
         self._enabled = True
         self._pressed = False
@@ -61,6 +62,10 @@ class TimeBarWidget(widget.WidgetWithSize):
                     self.release_capture()
                     self._pressed = False
                     result = True
+                elif event.event_type is widget_event.MouseEventType.DOUBLE_CLICK:
+                    if self.on_double_click_func is not None:
+                        self.on_double_click_func()
+                    result = True
             elif event.event_type is widget_event.MouseEventType.MOVE:
                 result = True
                 if self._pressed:
@@ -2,6 +2,7 @@ from song_sketcher import constants
 from song_sketcher.dialogs import edit_track_dialog
 from song_sketcher import drawing
 from song_sketcher import history_manager
+from song_sketcher import level_meter
 from song_sketcher import project
 from song_sketcher import song_timing
 from song_sketcher import time_bar
@@ -12,11 +13,20 @@ from song_sketcher import widget_event
 _SONG_LENGTH_MEASURE_PADDING = 3
 
 class Timeline:
-    def __init__(self, root_stack_widget, project, history_manager, get_selected_clip_id_func, on_time_bar_sample_changed_func):
+    def __init__(
+        self,
+        root_stack_widget,
+        project,
+        history_manager,
+        get_selected_clip_id_func,
+        on_time_bar_sample_changed_func,
+        on_time_bar_double_click_func,
+        on_track_mix_changed_func):
         self._root_stack_widget = root_stack_widget
         self._project = project
         self._history_manager = history_manager
         self._get_selected_clip_id_func = get_selected_clip_id_func
+        self._on_track_mix_changed_func = on_track_mix_changed_func # Called when a track's gain, mute or solo changes
 
         self._padding = _get_measure_padding()
 
@@ -41,6 +51,7 @@ class Timeline:
         self._time_bar.max_sample = 1.0
         self._time_bar.end_sample = 1.0
         self._time_bar.on_sample_changed_func = on_time_bar_sample_changed_func
+        self._time_bar.on_double_click_func = on_time_bar_double_click_func
 
         h_scrollbar = widget.HScrollbarWidget()
         self._root_layout.add_child(2, 0, h_scrollbar)
@@ -79,9 +90,13 @@ class Timeline:
     def root_layout(self):
         return self._root_layout
 
-    def set_enabled(self, enabled):
+    # Mute and solo can be enabled separately so that they can still be used during playback
+    def set_enabled(self, enabled, mix_controls_enabled = None):
+        if mix_controls_enabled is None:
+            mix_controls_enabled = enabled
         for widget in self._track_widgets.values():
             widget.enabled = enabled
+            widget.set_mix_controls_enabled(mix_controls_enabled)
         self._add_track_widget.set_enabled(enabled)
         for widget in self._measure_widgets.values():
             widget.enabled = enabled
@@ -96,6 +111,17 @@ class Timeline:
             self._project.beats_per_measure)
         return self._get_song_length_measures() * samples_per_measure
 
+    # Takes a dict mapping Track -> (peak, rms) and the time since the last update
+    def update_track_levels(self, track_levels, dt):
+        for track, (peak, rms) in track_levels.items():
+            track_widget = self._track_widgets.get(track, None)
+            if track_widget is not None:
+                track_widget.level_meter.update_levels(peak, rms, dt)
+
+    def reset_track_levels(self):
+        for track_widget in self._track_widgets.values():
+            track_widget.level_meter.reset()
+
     def get_playback_sample_index(self):
         return self._time_bar.sample
 
@@ -286,11 +312,13 @@ class Timeline:
             def do():
                 track.name = name
                 track.gain = gain
+                self._on_track_mix_changed_func(track)
                 self._layout_widgets()
 
             def undo():
                 track.name = old_name
                 track.gain = old_gain
+                self._on_track_mix_changed_func(track)
                 self._layout_widgets()
 
             do()
@@ -330,10 +358,12 @@ class Timeline:
         def do():
             track.muted = muted
             self._track_widgets[track].muted.set_checked(track.muted)
+            self._on_track_mix_changed_func(track)
 
         def undo():
             track.muted = old_muted
             self._track_widgets[track].muted.set_checked(track.muted)
+            self._on_track_mix_changed_func(track)
 
         do()
 
@@ -349,10 +379,12 @@ class Timeline:
         def do():
             track.soloed = soloed
             self._track_widgets[track].soloed.set_checked(track.soloed)
+            self._on_track_mix_changed_func(track)
 
         def undo():
             track.soloed = old_soloed
             self._track_widgets[track].soloed.set_checked(track.soloed)
+            self._on_track_mix_changed_func(track)
 
         do()
 
@@ -557,6 +589,15 @@ class TrackWidget(widget.AbsoluteLayoutWidget):
         soloed_text.vertical_alignment = drawing.VerticalAlignment.MIDDLE
         controls_layout.add_child(2, 2, soloed_text, horizontal_placement = widget.HorizontalPlacement.LEFT)
 
+        # Runs along the bottom edge inside the border. Track levels come from the engine's bus estimates, whose peaks
+        # are only an upper bound, so they don't show clipping.
+        self.level_meter = level_meter.LevelMeterWidget(show_clipping = False)
+        self.level_meter.desired_width = self.desired_width - points(16.0)
+        self.level_meter.desired_height = points(4.0)
+        self.level_meter.x.value = points(8.0)
+        self.level_meter.y.value = points(6.0)
+        self.add_child(self.level_meter)
+
     @property
     def enabled(self):
         return self._enabled
@@ -564,6 +605,9 @@ class TrackWidget(widget.AbsoluteLayoutWidget):
     @enabled.setter
     def enabled(self, enabled):
         self._enabled = enabled
+        self.set_mix_controls_enabled(enabled)
+
+    def set_mix_controls_enabled(self, enabled):
         self.muted.set_enabled(enabled)
         self.soloed.set_enabled(enabled)
 
@@ -0,0 +1,87 @@
+import json
+import os
+
+from song_sketcher import engine
+
+# Set this environment variable to a filename to record a trace of the audio thread and the main loop. The trace is
+# written on shutdown in Chrome's trace event format, which can be viewed in chrome://tracing or ui.perfetto.dev.
+TRACE_FILENAME_ENVIRONMENT_VARIABLE = "SONG_SKETCHER_TRACE"
+
+_PROCESS_ID = 1
+_MAIN_THREAD_ID = 1
+_AUDIO_THREAD_ID = 2
+
+_tracer = None
+
+def initialize():
+    global _tracer
+    filename = os.environ.get(TRACE_FILENAME_ENVIRONMENT_VARIABLE)
+    if filename:
+        _tracer = Tracer(filename)
+
+def shutdown():
+    global _tracer
+    if _tracer is not None:
+        _tracer.shutdown()
+        _tracer = None
+
+# Drains events from the engine, call this regularly so the engine's trace ring doesn't overflow
+def update():
+    if _tracer is not None:
+        _tracer.update()
+
+def begin(name):
+    if _tracer is not None:
+        _tracer.add_event(engine.get_time(), "B", name, _MAIN_THREAD_ID)
+
+def end(name):
+    if _tracer is not None:
+        _tracer.add_event(engine.get_time(), "E", name, _MAIN_THREAD_ID)
+
+def instant(name):
+    if _tracer is not None:
+        _tracer.add_event(engine.get_time(), "i", name, _MAIN_THREAD_ID)
+
+class Tracer:
+    def __init__(self, filename):
+        self._filename = filename
+        self._start_time = engine.get_time()
+        self._events = []
+        engine.set_trace_enabled(True)
+
+    def shutdown(self):
+        engine.set_trace_enabled(False)
+        self.update()
+        self.write()
+
+    def update(self):
+        for time, phase, name, argument in engine.drain_trace():
+            self.add_event(time, phase, name, _AUDIO_THREAD_ID, { "value": argument })
+
+    def add_event(self, time, phase, name, thread_id, args = None):
+        event = {
+            "name": name,
+            "ph": phase,
+            "ts": (time - self._start_time) * 1000000.0, # Microseconds
+            "pid": _PROCESS_ID,
+            "tid": thread_id
+        }
+        if phase == "i":
+            event["s"] = "t" # Instant events are scoped to their thread
+        if args is not None:
+            event["args"] = args
+        self._events.append(event)
+
+    def write(self):
+        thread_names = [(_MAIN_THREAD_ID, "Main"), (_AUDIO_THREAD_ID, "Audio")]
+        metadata_events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": _PROCESS_ID,
+                "tid": thread_id,
+                "args": { "name": thread_name }
+            } for thread_id, thread_name in thread_names]
+
+        with open(self._filename, "w") as file:
+            json.dump({ "traceEvents": metadata_events + self._events }, file)
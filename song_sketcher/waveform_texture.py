@@ -3,7 +3,24 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 
 class WaveformTexture:
-    def __init__(self, samples = None, sample_count = None):
+    # If ring_column_count is provided, the texture holds that many (min, max) columns which are appended to as a
+    # recording advances, wrapping around once full so that only the newest columns are kept
+    def __init__(self, samples = None, sample_count = None, ring_column_count = None):
+        self._ring_column_count = ring_column_count
+        self._written_column_count = 0
+        if ring_column_count is not None:
+            assert samples is None and sample_count is None
+            self._sample_count = ring_column_count
+            self._waveform_texture = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_1D, self._waveform_texture)
+            glTexImage1D(GL_TEXTURE_1D, 0, GL_RG32F, ring_column_count, 0, GL_RG, GL_FLOAT, [0.0] * (ring_column_count * 2))
+
+            # Filtering would blend the newest and oldest columns where the ring wraps
+            glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+            return
+
         if samples is not None:
             assert sample_count is None
             sample_count = len(samples)
@@ -17,13 +34,44 @@ class WaveformTexture:
         glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
 
     def update_samples(self, samples):
+        assert self._ring_column_count is None
         assert len(samples) == self._sample_count
         glBindTexture(GL_TEXTURE_1D, self._waveform_texture)
         glTexSubImage1D(GL_TEXTURE_1D, 0, 0, len(samples), GL_RED, GL_FLOAT, samples)
 
+    # Appends (min, max) columns to a ring texture, uploading only the new columns
+    def append_columns(self, columns):
+        assert self._ring_column_count is not None
+        if len(columns) > self._ring_column_count:
+            self._written_column_count += len(columns) - self._ring_column_count
+            columns = columns[-self._ring_column_count:]
+
+        glBindTexture(GL_TEXTURE_1D, self._waveform_texture)
+        while len(columns) > 0:
+            # Split the upload where the ring wraps
+            offset = self._written_column_count % self._ring_column_count
+            count = min(len(columns), self._ring_column_count - offset)
+            data = [value for column in columns[:count] for value in column]
+            glTexSubImage1D(GL_TEXTURE_1D, 0, offset, count, GL_RG, GL_FLOAT, data)
+            self._written_column_count += count
+            columns = columns[count:]
+
     def destroy(self):
         glDeleteTextures(self._waveform_texture)
 
     @property
     def waveform_texture(self):
         return self._waveform_texture
+
+    # Whether each column holds a (min, max) range rather than a single sample
+    @property
+    def is_min_max(self):
+        return self._ring_column_count is not None
+
+    # Where the oldest column starts in texture coordinates. A ring texture fills from the left until it's full, then
+    # scrolls so that the newest column stays on the right.
+    @property
+    def texture_offset(self):
+        if self._ring_column_count is None or self._written_column_count < self._ring_column_count:
+            return 0.0
+        return (self._written_column_count % self._ring_column_count) / self._ring_column_count